@@ -0,0 +1,176 @@
+#!/usr/bin/env python3
+
+import re
+import ast
+import sys
+import time
+import signal
+import socket
+import selectors
+import tempfile
+import threading
+import subprocess
+from pathlib import Path
+
+from bench_fanout import HOST, PORT, join, percentile
+
+"""
+	メッセージのまとめ送り(BATCH_BYTES / BATCH_DELAY)の比較
+
+	使い方: bench_batching.py [クライアント数] [メッセージ/秒] [秒数]
+		例) bench_batching.py 10 10000 10
+
+	re02_ex29.pyの書き込みスレッドの設定を変えて起動し、同じ負荷をかける
+		per-message	- batch_bytes=0, batch_delay=0(1メッセージ1send、まとめ送りの前と同じ)
+		coalesce	- batch_bytes=64KB, batch_delay=0(書き込みスレッドが追いつく前に溜まった分だけまとめる)
+		window		- batch_bytes=64KB, batch_delay=2ms(re02_ex29.pyの既定値)
+	全員が送信者で受信者: 合計[メッセージ/秒]になるよう、各クライアントが10msごとに数行をまとめて送る
+	(1メッセージは「番号 送信時刻(ns)」の1行、全員に配られるので配送数はメッセージ数 × クライアント数)
+		msgs/s		- サーバーが受け取ったメッセージ数 / 秒
+		deliv/s		- クライアントに届いた行数 / 秒
+		p50 / p99	- 送ってから届くまで(ms)
+		recv/msg	- サーバーのrecvの回数 / 受け取ったメッセージ数
+		send/deliv	- サーバーのsendの回数 / 配送したメッセージ数
+	サーバーの回数は、終了時(SIGINT)にre02_ex29.pyが出力するreceive: / fanout: の行から読む
+"""
+
+HERE = Path(__file__).parent
+TICK = 0.01
+GRACE = 2.0
+MESSAGE = re.compile(rb'(\d+) (\d+)$')
+
+VARIANTS = (
+	('per-message', 0, 0.0),
+	('coalesce', 64 * 1024, 0.0),
+	('window', 64 * 1024, 0.002)
+)
+
+SERVER = '''
+import re02_ex29 as chat
+chat.fanout.batch_bytes = {batch_bytes}
+chat.fanout.batch_delay = {batch_delay}
+chat.run_server()
+'''
+
+def	start_server(batch_bytes, batch_delay, log):
+	code = SERVER.format(batch_bytes=batch_bytes, batch_delay=batch_delay)
+	proc = subprocess.Popen([sys.executable, '-c', code], cwd=HERE, stdout=log, stderr=log)
+	deadline = time.monotonic() + 10.0
+	while time.monotonic() < deadline:
+		try:
+			socket.create_connection((HOST, PORT), timeout=0.1).close()
+			return proc
+		except OSError:
+			time.sleep(0.1)
+	proc.kill()
+	raise RuntimeError('start_server: server did not start')
+
+# 全員分の送信をTICKごとに行う(1クライアント1回のsendallに数行)
+def	send_messages(socks, rate, duration, sent):
+	per_tick = rate * TICK / len(socks)
+	begin = time.perf_counter()
+	owed = 0.0
+	tick = 0
+	while time.perf_counter() - begin < duration:
+		delay = begin + tick * TICK - time.perf_counter()
+		if 0 < delay:
+			time.sleep(delay)
+		tick += 1
+		owed += per_tick
+		count = int(owed)
+		owed -= count
+		if not count:
+			continue
+		for sock in socks:
+			now = time.perf_counter_ns()
+			try:
+				sock.sendall(b''.join(b'%d %d\n' % (sent[0] + n, now) for n in range(count)))
+			except OSError as e:
+				# サーバーが追いつかず、送信キューがあふれて切断された場合
+				print(f'send_messages: {e}', file=sys.stderr)
+				return
+			sent[0] += count
+
+def	server_counts(log) -> dict:
+	log.seek(0)
+	text = log.read().decode('utf-8', errors='replace')
+	receive = re.search(r'receive: reads=(\d+) messages=(\d+)', text)
+	fanout = re.search(r'fanout: (\{.*\})', text)
+	if not receive or not fanout:
+		return {}
+	counts = ast.literal_eval(fanout.group(1))
+	counts.update(reads=int(receive.group(1)), messages=int(receive.group(2)))
+	return counts
+
+def	run_variant(name, batch_bytes, batch_delay, clients, rate, duration):
+	log = tempfile.TemporaryFile()
+	proc = start_server(batch_bytes, batch_delay, log)
+	try:
+		socks = [join(f'b{n}') for n in range(clients)]
+		selector = selectors.DefaultSelector()
+		for sock in socks:
+			selector.register(sock, selectors.EVENT_READ, bytearray())
+		while events := selector.select(timeout=0.5):		# 参加のメッセージを読み捨てる
+			for key, _ in events:
+				key.fileobj.recv(65536)
+		for sock in socks:
+			sock.setblocking(True)
+
+		sent = [0]
+		sender = threading.Thread(target=send_messages, args=(socks, rate, duration, sent), daemon=True)
+		latencies = []
+		begin = time.perf_counter()
+		sender.start()
+		end = None
+		while end is None or time.perf_counter() < end:
+			if end is None and not sender.is_alive():
+				end = time.perf_counter() + GRACE
+			for key, _ in selector.select(timeout=0.05):
+				data = key.fileobj.recv(262144)
+				now = time.perf_counter_ns()
+				if not data:
+					selector.unregister(key.fileobj)
+					continue
+				buffer = key.data
+				buffer += data
+				lines = buffer.split(b'\n')
+				buffer[:] = lines.pop()
+				for line in lines:
+					match = MESSAGE.search(line)
+					if match:
+						latencies.append((now - int(match.group(2))) / 1e6)
+		for sock in socks:
+			sock.close()
+		time.sleep(0.5)		# サーバーがログアウトを処理して受信の回数を足すまで待つ
+	finally:
+		proc.send_signal(signal.SIGINT)
+		try:
+			proc.wait(timeout=10.0)
+		except subprocess.TimeoutExpired:
+			proc.kill()
+			proc.wait()
+
+	counts = server_counts(log)
+	latencies.sort()
+	received = counts.get('messages', 0)
+	print(
+		f'{name:<12}{received / duration:>9.0f}{len(latencies) / duration:>10.0f}'
+		f'{percentile(latencies, 50):>8.1f}{percentile(latencies, 99):>8.1f}'
+		f'{counts.get("reads", 0) / max(received, 1):>10.3f}'
+		f'{counts.get("sends", 0) / max(counts.get("written", 0), 1):>12.3f}'
+		f'   sent {sent[0]}, delivered {len(latencies)}/{sent[0] * clients}'
+	)
+
+def	main():
+	clients = int(sys.argv[1]) if 1 < len(sys.argv) else 10
+	rate = float(sys.argv[2]) if 2 < len(sys.argv) else 10000.0
+	duration = float(sys.argv[3]) if 3 < len(sys.argv) else 10.0
+	print(f'clients={clients} offered={rate:g} msgs/s duration={duration:g}s')
+	print(f'{"variant":<12}{"msgs/s":>9}{"deliv/s":>10}{"p50":>8}{"p99":>8}{"recv/msg":>10}{"send/deliv":>12}')
+	for name, batch_bytes, batch_delay in VARIANTS:
+		run_variant(name, batch_bytes, batch_delay, clients, rate, duration)
+		time.sleep(0.5)
+	return 0
+
+if __name__ == '__main__':
+	sys.exit(main())
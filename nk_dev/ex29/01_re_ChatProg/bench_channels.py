@@ -0,0 +1,126 @@
+#!/usr/bin/env python3
+
+import re
+import sys
+import time
+import random
+import tempfile
+import selectors
+import threading
+from pathlib import Path
+
+from bench_fanout import join, percentile, start_server
+from bench_soak import cpu_seconds, drain
+
+"""
+	チャンネルごとのブロードキャストのコスト(全体の人数を変えて、1メッセージあたりのサーバーのCPU時間を比べる)
+
+	使い方: bench_channels.py [サーバー.py] [メッセージ/秒] [秒数] [ユーザー数:チャンネル数 ...]
+		例) bench_channels.py re03_ex29.py 200 10 1000:100 10000:1000 10000:100
+
+	サーバーを子プロセスとして起動し(ポート8080)、ユーザーを1人ずつ参加させて
+	c0, c1, ... に順番に振り分ける(/join cN してから /leave general)
+	チャンネル数が1の時はgeneralのまま(全員に届くので、チャンネルがない時のブロードキャストと同じ)
+	ランダムなユーザーが[メッセージ/秒]で「番号 送信時刻(ns)」の1行を送り、同じチャンネルのメンバーに届くまでの時間を測る
+		members		- 1チャンネルの人数
+		CPU us/msg	- 送っている間にサーバーが使ったCPU時間 / 送ったメッセージ数
+		deliv/s		- 届いた行数 / 秒
+		p50 / p99	- 送ってから届くまで(ms)
+"""
+
+HERE = Path(__file__).parent
+CHUNK = 100
+QUIET = 1.0
+GRACE = 2.0
+MESSAGE = re.compile(rb'(\d+) (\d+)$')
+CONFIGS = ('1000:100', '10000:1000', '10000:100')
+
+def	send_messages(socks, count, rate, sent):
+	begin = time.perf_counter()
+	for seq in range(count):
+		delay = begin + seq / rate - time.perf_counter()
+		if 0 < delay:
+			time.sleep(delay)
+		sock = random.choice(socks)
+		try:
+			sock.send(b'%d %d\n' % (seq, time.perf_counter_ns()))
+		except OSError as e:
+			print(f'send_messages: {e}', file=sys.stderr)
+			return
+		sent[0] += 1
+
+def	run(server, users, channel_count, rate, duration):
+	log = tempfile.TemporaryFile()
+	proc = start_server(server, log)
+	socks = []
+	try:
+		selector = selectors.DefaultSelector()
+		for n in range(users):
+			sock = join(f'u{n}')
+			if 1 < channel_count:
+				sock.sendall(b'/join c%d\n/leave general\n' % (n % channel_count))
+			selector.register(sock, selectors.EVENT_READ, bytearray())
+			socks.append(sock)
+			if n % CHUNK == CHUNK - 1:
+				drain(selector, 0)
+		while drain(selector, QUIET):		# 参加のメッセージを読み捨てる
+			pass
+
+		sent = [0]
+		sender = threading.Thread(target=send_messages, args=(socks, int(duration * rate), rate, sent), daemon=True)
+		latencies = []
+		cpu = cpu_seconds(proc.pid)
+		sender.start()
+		end = None
+		while end is None or time.perf_counter() < end:
+			if end is None and not sender.is_alive():
+				end = time.perf_counter() + GRACE
+			for key, _ in selector.select(timeout=0.05):
+				data = key.fileobj.recv(262144)
+				now = time.perf_counter_ns()
+				if not data:
+					selector.unregister(key.fileobj)
+					continue
+				buffer = key.data
+				buffer += data
+				lines = buffer.split(b'\n')
+				buffer[:] = lines.pop()
+				for line in lines:
+					match = MESSAGE.search(line)
+					if match:
+						latencies.append((now - int(match.group(2))) / 1e6)
+		cpu = cpu_seconds(proc.pid) - cpu
+	finally:
+		for sock in socks:
+			sock.close()
+		proc.terminate()
+		proc.wait()
+
+	members = users // channel_count
+	latencies.sort()
+	print(
+		f'{server.name:<14}{users:>7}{channel_count:>9}{members:>9}{sent[0] / duration:>8.0f}'
+		f'{cpu / max(sent[0], 1) * 1e6:>12.0f}{len(latencies) / duration:>10.0f}'
+		f'{percentile(latencies, 50):>8.1f}{percentile(latencies, 99):>8.1f}'
+		f'   delivered {len(latencies)}/{sent[0] * members}',
+		flush=True
+	)
+
+def	main():
+	server = Path(sys.argv[1]).resolve() if 1 < len(sys.argv) else HERE / 're03_ex29.py'
+	rate = float(sys.argv[2]) if 2 < len(sys.argv) else 200.0
+	duration = float(sys.argv[3]) if 3 < len(sys.argv) else 10.0
+	configs = sys.argv[4:] or CONFIGS
+	print(
+		f'{"server":<14}{"users":>7}{"channels":>9}{"members":>9}{"msgs/s":>8}'
+		f'{"CPU us/msg":>12}{"deliv/s":>10}{"p50":>8}{"p99":>8}',
+		flush=True
+	)
+	for config in configs:
+		users, channel_count = (int(value) for value in config.split(':'))
+		run(server, users, channel_count, rate, duration)
+		time.sleep(1.0)
+	return 0
+
+if __name__ == '__main__':
+	sys.exit(main())
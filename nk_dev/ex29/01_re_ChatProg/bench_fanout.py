@@ -0,0 +1,180 @@
+#!/usr/bin/env python3
+
+import re
+import sys
+import time
+import socket
+import tempfile
+import selectors
+import threading
+import subprocess
+from pathlib import Path
+
+"""
+	ブロードキャストの配送遅延の測定(一部のユーザーが読まない・読むのが遅い場合)
+
+	使い方: bench_fanout.py [サーバー.py] [クライアント数] [遅いクライアントの%] [秒数] [メッセージ/秒]
+		例) bench_fanout.py re02_ex29.py 1000 1 10 20
+
+	サーバーを子プロセスとして起動し(ポート8080)、クライアント数だけ接続してニックネームを登録する
+		遅いクライアント	- 受信バッファを小さくし(SO_RCVBUF)、1秒に1KBしか読まない
+		普通のクライアント	- 届いたらすぐ読む(全員を1つのselectorで読む)
+	参加のメッセージ(Say hello to ...)が届き終わるまで待ってから測り始める
+	送信用のクライアントが[メッセージ/秒]の間隔で「番号 送信時刻(ns) xxx...」の1行を送り、
+	普通のクライアントに届くまでの時間を測る(送信もこのプロセスなので時計は同じperf_counter)
+		delivered	- 普通のクライアントに届いた数 / 送った数 × 普通のクライアント数
+		latency		- 送ってから届くまで(p50 / p90 / p99 / max)
+		slow cut	- サーバーが送信キューあふれで切断した数(サーバーの出力の"outbox is full"を数える)
+	送り終えてからGRACE秒待って、届いていないものは届かなかったとする
+"""
+
+HERE = Path(__file__).parent
+HOST = '127.0.0.1'
+PORT = 8080
+PAD = 400				# 1メッセージの埋め草(バイト)
+SLOW_RCVBUF = 4096
+SLOW_READ = 1024		# 遅いクライアントが1秒に読むバイト数
+GRACE = 3.0
+QUIET = 0.5
+SEND_TIMEOUT = 5.0
+MESSAGE = re.compile(rb'(\d+) (\d+) x')
+
+def	start_server(path, log):
+	proc = subprocess.Popen([sys.executable, str(path)], cwd=path.parent, stdout=log, stderr=log)
+	deadline = time.monotonic() + 10.0
+	while time.monotonic() < deadline:
+		try:
+			socket.create_connection((HOST, PORT), timeout=0.1).close()
+			return proc
+		except OSError:
+			time.sleep(0.1)
+	proc.kill()
+	raise RuntimeError(f'start_server: {path} did not start')
+
+# ニックネームを登録した接続を返す(Helloが返ってくるまで待つ)
+def	join(nickname, slow=False) -> socket.socket:
+	sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+	if slow:
+		sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, SLOW_RCVBUF)
+	sock.settimeout(10.0)
+	sock.connect((HOST, PORT))
+	sock.sendall(nickname.encode('ascii') + b'\n')
+	data = b''
+	while b'Hello' not in data:
+		chunk = sock.recv(4096)
+		if not chunk:
+			raise RuntimeError(f'join: {nickname} was disconnected')
+		data += chunk
+	sock.setblocking(False)
+	return sock
+
+# サーバーが送信者のソケットを読まなくなったら(配送がどこかで止まっている)、SEND_TIMEOUTで諦める
+def	send_messages(sock, count, rate, sent):
+	pad = b'x' * PAD
+	begin = time.perf_counter()
+	sock.settimeout(SEND_TIMEOUT)
+	for seq in range(count):
+		delay = begin + seq / rate - time.perf_counter()
+		if 0 < delay:
+			time.sleep(delay)
+		try:
+			sock.sendall(b'%d %d ' % (seq, time.perf_counter_ns()) + pad + b'\n')
+		except socket.timeout:
+			print(f'send_messages: sender blocked after {len(sent)} messages', file=sys.stderr)
+			return
+		sent.append(seq)
+
+def	percentile(values, p) -> float:
+	if not values:
+		return 0.0
+	return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+def	main():
+	server = Path(sys.argv[1]).resolve() if 1 < len(sys.argv) else HERE / 're02_ex29.py'
+	total = int(sys.argv[2]) if 2 < len(sys.argv) else 1000
+	slow_percent = float(sys.argv[3]) if 3 < len(sys.argv) else 1.0
+	duration = float(sys.argv[4]) if 4 < len(sys.argv) else 10.0
+	rate = float(sys.argv[5]) if 5 < len(sys.argv) else 20.0
+	slow_count = int(total * slow_percent / 100)
+
+	log = tempfile.TemporaryFile()
+	proc = start_server(server, log)
+	try:
+		selector = selectors.DefaultSelector()
+		slow = []
+		for n in range(total):
+			if n < slow_count:
+				slow.append(join(f's{n}', slow=True))
+			else:
+				selector.register(join(f'u{n}'), selectors.EVENT_READ, bytearray())
+		sender = join('sender')
+		selector.register(sender, selectors.EVENT_READ, bytearray())		# 自分の発言も届くので読む
+
+		# 参加のメッセージを読み捨てる(QUIET秒届かなくなるまで)
+		while events := selector.select(timeout=QUIET):
+			for key, _ in events:
+				if not key.fileobj.recv(65536):
+					selector.unregister(key.fileobj)
+
+		count = int(duration * rate)
+		sent = []
+		thread = threading.Thread(target=send_messages, args=(sender, count, rate, sent), daemon=True)
+		latencies = []
+		closed = 0
+		begin = time.perf_counter()
+		thread.start()
+		next_slow_read = begin + 1.0
+		end = None
+		while end is None or time.perf_counter() < end:
+			if end is None and not thread.is_alive():
+				end = time.perf_counter() + GRACE
+			for key, _ in selector.select(timeout=0.05):
+				try:
+					data = key.fileobj.recv(65536)
+				except OSError:
+					data = b''
+				now = time.perf_counter_ns()
+				if not data:
+					selector.unregister(key.fileobj)
+					key.fileobj.close()
+					closed += 1
+					continue
+				buffer = key.data
+				buffer += data
+				lines = buffer.split(b'\n')
+				buffer[:] = lines.pop()
+				for line in lines:
+					# サーバーのrecvで2つのメッセージが1行につながっている場合もある
+					for match in MESSAGE.finditer(line):
+						latencies.append((now - int(match.group(2))) / 1e6)
+			if next_slow_read <= time.perf_counter():
+				next_slow_read += 1.0
+				for sock in slow:
+					try:
+						sock.recv(SLOW_READ)
+					except OSError:
+						pass
+		elapsed = time.perf_counter() - begin
+	finally:
+		proc.terminate()
+		proc.wait()
+	log.seek(0)
+	slow_cut = log.read().count(b'outbox is full')
+
+	normal = total - slow_count + 1		# 送信用のクライアントを含む
+	expected = len(sent) * normal
+	latencies.sort()
+	print(
+		f'{server.name}: clients={total} slow={slow_count} messages={len(sent)} ({rate:g}/s) '
+		f'fan-out={expected / elapsed:.0f} deliveries/s'
+	)
+	print(
+		f'  delivered {len(latencies)}/{expected} ({len(latencies) / expected * 100:.1f}%)  '
+		f'latency ms p50 {percentile(latencies, 50):.1f} p90 {percentile(latencies, 90):.1f} '
+		f'p99 {percentile(latencies, 99):.1f} max {percentile(latencies, 100):.1f}  '
+		f'slow cut {slow_cut}/{slow_count}  normal closed {closed}'
+	)
+	return 0
+
+if __name__ == '__main__':
+	sys.exit(main())
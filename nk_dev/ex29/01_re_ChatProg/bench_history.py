@@ -0,0 +1,217 @@
+#!/usr/bin/env python3
+
+import os
+import re
+import sys
+import time
+import socket
+import shutil
+import signal
+import tempfile
+import selectors
+import threading
+import subprocess
+from pathlib import Path
+
+from bench_fanout import HOST, PORT, join, percentile
+from bench_soak import drain
+from history import History, tail_lines
+
+"""
+	チャンネルの履歴(history.py)の測定
+
+	使い方: bench_history.py [サーバー.py] [秒数] [履歴の件数 ...]
+		例) bench_history.py re02_ex29.py 10 0 50 500
+
+	1. append	- Historyに1行120バイトを10チャンネルへ追記する速さ(メモリだけ / まとめてfsync / 1件ごとにsync()してfsync)
+	2. restart	- ログの行数を変えて、再起動後に初めて使ったチャンネルの最近HISTORY_SIZE行を読む時間
+				  (tail_linesで末尾から読む / 比較のためにファイル全体を読んで最後の行を取る)
+	3. replay	- サーバーの履歴の件数を変えて起動し、generalにCHATTERS人が合計RATE件/秒で発言している間に、
+				  別のクライアントが1人ずつ参加(Hello、履歴、Say hello)しては抜けるのを繰り返す
+			join		- 接続してから自分のSay helloが届くまで(ms)
+			lines / bytes	- 1回の参加で届いた[general]の行数とバイト数(送り直された履歴と、その間の発言)
+			chat p50/p99	- 発言してから他の発言者に届くまで(ms)。参加者への送り直しで発言が待たされていないか
+"""
+
+HERE = Path(__file__).parent
+CHATTERS = 20
+RATE = 200.0
+PAD = 150
+GRACE = 1.0
+MESSAGE = re.compile(rb'(\d+) (\d+) x')
+
+SERVER = '''
+import {module} as chat
+chat.history.size = {size}
+chat.run_server()
+'''
+
+def	bench_append(count=20000):
+	message = b'[general] alice: ' + b'x' * 100 + b'\n'
+	for label, directory, each in (('memory', False, False), ('disk, fsync/1s', True, False), ('disk, fsync each', True, True)):
+		path = tempfile.mkdtemp() if directory else None
+		history = History(50, path)
+		history.start()
+		n = count // 20 if each else count
+		begin = time.perf_counter()
+		for i in range(n):
+			history.append(f'c{i % 10}', message)
+			if each:
+				history.sync()
+		elapsed = time.perf_counter() - begin
+		history.close()
+		print(f'  {label:<18}{n / elapsed:>10.0f} appends/s   fsync {history.stats()["syncs"]}')
+		if path:
+			shutil.rmtree(path)
+
+def	bench_restart(size=50):
+	message = b'[general] alice: ' + b'x' * 100 + b'\n'
+	for lines in (10000, 1000000):
+		path = tempfile.mkdtemp()
+		with open(os.path.join(path, 'general.log'), 'wb') as f:
+			f.write(message * lines)
+		history = History(size, path)
+		begin = time.perf_counter()
+		recent = history.recent('general', history.load('general'))
+		tail = time.perf_counter() - begin
+		begin = time.perf_counter()
+		with open(os.path.join(path, 'general.log'), 'rb') as f:
+			whole = f.read().splitlines(keepends=True)[-size:]
+		full = time.perf_counter() - begin
+		assert recent == b''.join(whole) == b''.join(tail_lines(os.path.join(path, 'general.log'), size))
+		print(f'  {lines:>8} lines ({lines * len(message) / 1e6:>6.1f} MB)   tail {tail * 1000:>7.2f} ms   whole file {full * 1000:>8.1f} ms')
+		shutil.rmtree(path)
+
+def	start_server(server, size, log):
+	code = SERVER.format(module=server.stem, size=size)
+	proc = subprocess.Popen([sys.executable, '-c', code], cwd=server.parent, stdout=log, stderr=log)
+	deadline = time.monotonic() + 10.0
+	while time.monotonic() < deadline:
+		try:
+			socket.create_connection((HOST, PORT), timeout=0.1).close()
+			return proc
+		except OSError:
+			time.sleep(0.1)
+	proc.kill()
+	raise RuntimeError(f'start_server: {server} did not start')
+
+def	send_messages(socks, count, rate, sent):
+	pad = b'x' * PAD
+	begin = time.perf_counter()
+	for seq in range(count):
+		delay = begin + seq / rate - time.perf_counter()
+		if 0 < delay:
+			time.sleep(delay)
+		try:
+			socks[seq % len(socks)].send(b'%d %d ' % (seq, time.perf_counter_ns()) + pad + b'\n')
+		except OSError as e:
+			print(f'send_messages: {e}', file=sys.stderr)
+			return
+		sent[0] += 1
+
+# 1人ずつ参加しては抜ける(stopがセットされるまで)、参加ごとに届いたバイト数と[general]の行数を記録する
+def	join_repeatedly(stop, joins, replayed):
+	n = 0
+	while not stop.is_set():
+		nickname = f'j{n}'
+		begin = time.perf_counter()
+		sock = socket.create_connection((HOST, PORT), timeout=10.0)
+		sock.sendall(nickname.encode('ascii') + b'\n')
+		data = b''
+		end_marker = f'Say hello to {nickname} !\n'.encode('ascii')
+		while end_marker not in data:
+			chunk = sock.recv(262144)
+			if not chunk:
+				break
+			data += chunk
+		joins.append((time.perf_counter() - begin) * 1000)
+		replayed.append((data.count(b'[general] '), len(data)))
+		sock.close()
+		n += 1
+
+def	bench_replay(server, size, duration):
+	log = tempfile.TemporaryFile()
+	proc = start_server(server, size, log)
+	try:
+		socks = [join(f'chat{n}') for n in range(CHATTERS)]
+		selector = selectors.DefaultSelector()
+		for sock in socks:
+			selector.register(sock, selectors.EVENT_READ, bytearray())
+
+		# 先に履歴をいっぱいにしておく
+		send_messages(socks, size, 1000.0, [0])
+		while drain(selector, 0.5):
+			pass
+
+		sent = [0]
+		stop = threading.Event()
+		joins = []
+		replayed = []
+		sender = threading.Thread(target=send_messages, args=(socks, int(duration * RATE), RATE, sent), daemon=True)
+		joiner = threading.Thread(target=join_repeatedly, args=(stop, joins, replayed), daemon=True)
+		latencies = []
+		sender.start()
+		joiner.start()
+		end = None
+		while end is None or time.perf_counter() < end:
+			if end is None and not sender.is_alive():
+				stop.set()
+				end = time.perf_counter() + GRACE
+			for key, _ in selector.select(timeout=0.05):
+				data = key.fileobj.recv(262144)
+				now = time.perf_counter_ns()
+				if not data:
+					selector.unregister(key.fileobj)
+					continue
+				buffer = key.data
+				buffer += data
+				lines = buffer.split(b'\n')
+				buffer[:] = lines.pop()
+				for line in lines:
+					match = MESSAGE.search(line)
+					if match:
+						latencies.append((now - int(match.group(2))) / 1e6)
+		joiner.join()
+		for sock in socks:
+			sock.close()
+	finally:
+		proc.send_signal(signal.SIGINT)
+		try:
+			proc.wait(timeout=10.0)
+		except subprocess.TimeoutExpired:
+			proc.kill()
+			proc.wait()
+
+	latencies.sort()
+	joins.sort()
+	count = max(len(replayed), 1)
+	print(
+		f'  {size:>6}{len(joins) / duration:>9.1f}{percentile(joins, 50):>10.1f}{percentile(joins, 99):>10.1f}'
+		f'{sum(lines for lines, _ in replayed) / count:>10.0f}{sum(received for _, received in replayed) / count:>9.0f}'
+		f'{percentile(latencies, 50):>10.1f}{percentile(latencies, 99):>10.1f}'
+		f'   delivered {len(latencies)}/{sent[0] * CHATTERS}',
+		flush=True
+	)
+
+def	main():
+	server = Path(sys.argv[1]).resolve() if 1 < len(sys.argv) else HERE / 're02_ex29.py'
+	duration = float(sys.argv[2]) if 2 < len(sys.argv) else 10.0
+	sizes = [int(arg) for arg in sys.argv[3:]] or [0, 50, 500]
+
+	print('1. append', flush=True)
+	bench_append()
+	print('2. restart (last 50 lines)', flush=True)
+	bench_restart()
+	print(f'3. replay ({server.name}, {CHATTERS} chatters, {RATE:g} msgs/s, {duration:g}s)')
+	print(
+		f'  {"size":>6}{"joins/s":>9}{"join p50":>10}{"join p99":>10}{"lines":>10}{"bytes":>9}'
+		f'{"chat p50":>10}{"chat p99":>10}',
+		flush=True
+	)
+	for size in sizes:
+		bench_replay(server, size, duration)
+		time.sleep(0.5)
+	return 0
+
+if __name__ == '__main__':
+	sys.exit(main())
@@ -0,0 +1,107 @@
+#!/usr/bin/env python3
+
+import os
+import sys
+import time
+import tempfile
+import selectors
+from pathlib import Path
+
+from bench_fanout import join, start_server
+
+"""
+	何もしていない接続を大量に持った時のサーバーのメモリの測定(1クライアント1スレッド vs selector)
+
+	使い方: bench_soak.py [接続数] [サーバー.py ...]
+		例) bench_soak.py 10000 re02_ex29.py re03_ex29.py
+
+	サーバーを子プロセスとして起動し(ポート8080)、接続数だけ接続してニックネームを登録する
+	(1接続ずつHelloが返るまで待つ。参加のメッセージは全員に届くので、CHUNK人参加するごとに全員分を読み捨てる)
+	全員が参加し終えて、QUIET秒届くものがなくなってから、サーバーの/proc/<pid>/statusを読む
+		RSS			- 起動直後 → 全員が参加した後(MB)
+		KB/conn		- 増えたRSS / 接続数
+		threads		- サーバーのスレッド数
+		join		- 全員の参加にかかった秒数
+		idle CPU	- 全員が何もしないHOLD秒の間にサーバーが使ったCPU時間の割合
+	接続数の2倍程度のファイルディスクリプタが要る(ulimit -n)
+"""
+
+HERE = Path(__file__).parent
+CHUNK = 100
+QUIET = 1.0
+HOLD = 5.0
+
+def	proc_status(pid) -> dict:
+	status = {}
+	with open(f'/proc/{pid}/status') as f:
+		for line in f:
+			key, _, value = line.partition(':')
+			status[key] = value.split()[0] if value.split() else ''
+	return status
+
+def	cpu_seconds(pid) -> float:
+	with open(f'/proc/{pid}/stat') as f:
+		fields = f.read().rsplit(')', 1)[1].split()
+	return (int(fields[11]) + int(fields[12])) / os.sysconf('SC_CLK_TCK')		# utime + stime
+
+# 届いているもの(参加のメッセージ)を全部読み捨て、読んだバイト数を返す
+def	drain(selector, timeout) -> int:
+	received = 0
+	for key, _ in selector.select(timeout=timeout):
+		try:
+			data = key.fileobj.recv(262144)
+		except BlockingIOError:
+			continue
+		if not data:
+			raise RuntimeError(f'drain: {key.data} was disconnected')
+		received += len(data)
+	return received
+
+def	soak(server, total):
+	log = tempfile.TemporaryFile()
+	proc = start_server(server, log)
+	socks = []
+	try:
+		time.sleep(0.5)
+		base = proc_status(proc.pid)
+		selector = selectors.DefaultSelector()
+		begin = time.perf_counter()
+		for n in range(total):
+			sock = join(f'u{n}')
+			selector.register(sock, selectors.EVENT_READ, f'u{n}')
+			socks.append(sock)
+			if n % CHUNK == CHUNK - 1:
+				drain(selector, 0)
+		while drain(selector, QUIET):		# 残りの参加のメッセージを読み捨てる
+			pass
+		join_time = time.perf_counter() - begin
+
+		full = proc_status(proc.pid)
+		cpu = cpu_seconds(proc.pid)
+		time.sleep(HOLD)
+		idle_cpu = (cpu_seconds(proc.pid) - cpu) / HOLD
+	finally:
+		for sock in socks:
+			sock.close()
+		proc.terminate()
+		proc.wait()
+
+	base_rss = int(base['VmRSS']) / 1024
+	full_rss = int(full['VmRSS']) / 1024
+	print(
+		f'{server.name:<14}{total:>7}{join_time:>8.1f}{base_rss:>9.1f}{full_rss:>9.1f}'
+		f'{(full_rss - base_rss) * 1024 / total:>9.1f}{full["Threads"]:>9}{idle_cpu * 100:>9.1f}%',
+		flush=True
+	)
+
+def	main():
+	total = int(sys.argv[1]) if 1 < len(sys.argv) else 10000
+	servers = [Path(arg).resolve() for arg in sys.argv[2:]] or [HERE / 're02_ex29.py', HERE / 're03_ex29.py']
+	print(f'{"server":<14}{"conns":>7}{"join s":>8}{"RSS MB":>9}{"→ MB":>9}{"KB/conn":>9}{"threads":>9}{"idle CPU":>10}', flush=True)
+	for server in servers:
+		soak(server, total)
+		time.sleep(1.0)
+	return 0
+
+if __name__ == '__main__':
+	sys.exit(main())
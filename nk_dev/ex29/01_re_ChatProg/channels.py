@@ -0,0 +1,197 @@
+import threading
+
+"""
+	チャンネル(チャットルーム)
+	channels.py:
+		- channel_name関数(チャンネル名の確認)
+		- Channelsクラス(チャンネルごとのメンバー、ユーザーごとの参加チャンネル、コマンドの処理)
+
+	ログインしたユーザーはDEFAULT_CHANNELに入る。コマンド以外の行は、最後に参加した(発言先の)チャンネルに送る
+		/join <チャンネル>				- 参加して発言先にする(既に参加していれば発言先にするだけ)
+		/leave [チャンネル]				- 抜ける(省略時は発言先)。発言先は残りのうち最後に参加したものになる
+		/list							- チャンネルと人数の一覧
+		/msg <ニックネーム> <メッセージ>	- 1人にだけ送る(Registryの辞書で引く)
+
+	メッセージはチャンネルのメンバーにだけ送り、全ユーザーの一覧は見ない
+	(1メッセージのコストはチャンネルの人数で決まり、全体の人数には関係しない)
+	メンバーの変更はlockの下で行い、変わったチャンネルの送信先のtupleだけを作り直す
+	送信はlockを取らずにその時点のtupleを読む(Registryと同じ)
+	実際の送信のしかたはサーバーごとに違うので、deliver(message, users)を渡してもらう
+
+	history(history.History)を渡すと、チャンネルへの発言を覚えておき、参加したユーザーに送り直す
+		- 発言は、履歴への追加とメンバーのtupleの読み出しを同じlockの下で行う
+		- 参加は、メンバーへの追加と履歴の送信キューへの投入を同じlockの下で行う
+		  (参加と同時の発言も、履歴か通常の配送のどちらか一方で、履歴より後に1回だけ届く)
+		- 再起動後に初めて使うチャンネルの履歴(ディスク)は、lockを取る前にhistory.load()で読んでおく
+"""
+
+DEFAULT_CHANNEL = 'general'
+MAX_NAME = 20			# チャンネル名の上限文字数
+MAX_JOINED = 32			# 1ユーザーが参加できるチャンネル数
+
+# チャンネル名を確認して返す(先頭の#は取る)、不正ならNone
+def	channel_name(name) -> str | None:
+	name = name.strip().lstrip('#')
+	if not name or MAX_NAME < len(name) or any(c.isspace() for c in name):
+		return None
+	return name
+
+class Channels:
+	def	__init__(self, clients, deliver, history=None):
+		self.clients = clients		# Registry(ニックネーム → クライアント、/msgで引く)
+		self.deliver = deliver		# deliver(message, users): bytesをusersの送信キューに入れ、入れた数を返す
+		self.history = history		# History、Noneなら覚えない
+		self.lock = threading.Lock()
+		self.channels = {}			# チャンネル名 → {ニックネーム: クライアント}
+		self.snapshots = {}			# チャンネル名 → メンバーのtuple
+		self.joined = {}			# ニックネーム → 参加しているチャンネル名のリスト(最後が発言先)
+
+	def	__len__(self) -> int:
+		return len(self.snapshots)
+
+	# 参加したら、そのチャンネルの最近のメッセージをclientの送信キューに1回で入れる
+	# 戻り値: 0 参加した、1 既に参加している(発言先にした)、-1 参加数の上限
+	def	join(self, name, nickname, client) -> int:
+		loaded = self.history.load(name) if self.history is not None else None
+		with self.lock:
+			joined = self.joined.setdefault(nickname, [])
+			if name in joined:
+				joined.remove(name)
+				joined.append(name)
+				return 1
+			if MAX_JOINED <= len(joined):
+				return -1
+			joined.append(name)
+			members = self.channels.setdefault(name, {})
+			members[nickname] = client
+			self.snapshots[name] = tuple(members.values())
+			if self.history is not None:
+				backlog = self.history.recent(name, loaded)
+				if backlog:
+					self.deliver(backlog, (client,))
+		return 0
+
+	# 戻り値: 抜けたらTrue、参加していなければFalse
+	def	leave(self, name, nickname) -> bool:
+		with self.lock:
+			joined = self.joined.get(nickname)
+			if not joined or name not in joined:
+				return False
+			joined.remove(name)
+			self.remove_member(name, nickname)
+		return True
+
+	# 全チャンネルから抜ける、戻り値: 抜けたチャンネル名のリスト
+	def	leave_all(self, nickname) -> list:
+		with self.lock:
+			joined = self.joined.pop(nickname, [])
+			for name in joined:
+				self.remove_member(name, nickname)
+		return joined
+
+	# lockの下で呼ぶ。誰もいなくなったチャンネルは消す
+	def	remove_member(self, name, nickname):
+		members = self.channels[name]
+		del members[nickname]
+		if members:
+			self.snapshots[name] = tuple(members.values())
+		else:
+			del self.channels[name]
+			del self.snapshots[name]
+
+	def	members(self, name) -> tuple:
+		return self.snapshots.get(name, ())
+
+	# 発言先のチャンネル名、どこにも参加していなければNone
+	def	current(self, nickname) -> str | None:
+		with self.lock:
+			joined = self.joined.get(nickname)
+			return joined[-1] if joined else None
+
+	# (チャンネル名, 人数)のリスト
+	def	listing(self) -> list:
+		with self.lock:
+			return sorted((name, len(members)) for name, members in self.channels.items())
+
+	# チャンネルのメンバーにだけ送る(1回だけエンコード)、戻り値: 入れた送信キューの数
+	def	broadcast(self, name, message) -> int:
+		if isinstance(message, str):
+			message = message.encode('utf-8', errors='replace')
+		return self.deliver(message, self.members(name))
+
+	# ログイン: DEFAULT_CHANNELに入れて、そのメンバーに知らせる
+	def	login(self, nickname, client):
+		self.join(DEFAULT_CHANNEL, nickname, client)
+		self.broadcast(DEFAULT_CHANNEL, f'Say hello to {nickname} !\n')
+
+	# ログアウト: 全チャンネルから抜けて、同じチャンネルにいたユーザーに1回ずつ知らせる
+	def	logout(self, nickname):
+		left = self.leave_all(nickname)
+		users = dict.fromkeys(user for name in left for user in self.members(name))
+		if users:
+			self.deliver(f'{nickname} logout\n'.encode('utf-8', errors='replace'), tuple(users))
+
+	# 登録済みのユーザーの1行(空でない)を処理する。コマンド以外は発言先のチャンネルに送る
+	def	say(self, nickname, client, message):
+		if message.startswith('/'):
+			self.command(nickname, client, message)
+			return
+		name = self.current(nickname)
+		if name is None:
+			client.send_message('Warning: You are not in any channel (/join <channel>)\n')
+			return
+		message = f'[{name}] {nickname}: {message}\n'.encode('utf-8', errors='replace')
+		loaded = self.history.load(name) if self.history is not None else None
+		with self.lock:
+			if self.history is not None:
+				self.history.append(name, message, loaded)
+			users = self.snapshots.get(name, ())
+		self.deliver(message, users)
+
+	def	command(self, nickname, client, message):
+		command, _, argument = message.partition(' ')
+		argument = argument.strip()
+
+		# /join <チャンネル>
+		if command == '/join':
+			name = channel_name(argument)
+			if name is None:
+				client.send_message(f'Warning: Channel "{argument}" is invalid\n')
+				return
+			result = self.join(name, nickname, client)
+			if result == -1:
+				client.send_message(f'Warning: You can join up to {MAX_JOINED} channels\n')
+			elif result == 1:
+				client.send_message(f'[{name}] is now your channel\n')
+			else:
+				self.broadcast(name, f'[{name}] {nickname} joined\n')
+
+		# /leave [チャンネル]
+		elif command == '/leave':
+			name = channel_name(argument) if argument else self.current(nickname)
+			if name is None or not self.leave(name, nickname):
+				if argument:
+					client.send_message(f'Warning: You are not in "{argument}"\n')
+				else:
+					client.send_message('Warning: You are not in any channel\n')
+				return
+			client.send_message(f'You left [{name}]\n')
+			self.broadcast(name, f'[{name}] {nickname} left\n')
+
+		# /list
+		elif command == '/list':
+			lines = ''.join(f'[{name}] {count}\n' for name, count in self.listing())
+			client.send_message(f'Channels:\n{lines}')
+
+		# /msg <ニックネーム> <メッセージ>
+		elif command == '/msg':
+			target, _, text = argument.partition(' ')
+			text = text.strip()
+			user = self.clients.get(target)
+			if user is None or not text:
+				client.send_message(f'Warning: Cannot send to "{target}"\n')
+				return
+			self.deliver(f'[dm] {nickname}: {text}\n'.encode('utf-8', errors='replace'), (user,))
+
+		else:
+			client.send_message(f'Warning: Unknown command "{command}" (/join /leave /list /msg)\n')
@@ -0,0 +1,242 @@
+import time
+import socket
+import selectors
+import threading
+from collections import deque
+
+"""
+	ブロードキャストの配送(fan-out)
+	fanout.py:
+		- Outboxクラス(ユーザーごとの送信キュー)
+		- Fanoutクラス(全員のOutboxを1本の書き込みスレッドで送り出す)
+		- Registryクラス(ニックネーム → ClientData、全員の一覧はスナップショットで読む)
+
+	broadcastはメッセージを1回だけエンコードし、全員のOutboxに同じbytesを入れて書き込みスレッドを起こすだけで戻る
+	書き込みスレッドはMSG_DONTWAITで送れるだけ送り(受信スレッドのrecvはブロッキングのまま)、
+	送り切れなかったユーザーだけselectorで書き込めるようになるのを待つ
+	受信の遅いユーザーがいても、送信者や他のユーザーへの配送は止まらない
+	(1ユーザー1書き込みスレッドにすると、1メッセージごとに全員分のスレッドの切り替えが起きるので1本にする)
+
+	キューがlimit件を超え、ソケットの送信バッファも詰まっている(そのユーザーが読んでいない)時は、policyで
+		'disconnect'	- ソケットをshutdownして切断する(受信スレッドのrecvが空を返し、通常のログアウトになる)
+		'drop'			- 一番古いメッセージを捨てて新しいものを入れる(droppedに数える)
+	参加が続いた時など、書き込みスレッドが追いついていないだけの間はlimitの4倍まで待つ
+
+	まとめ送り: 書き込みスレッドは起こされてからbatch_delay秒待ち、その間に溜まったメッセージを
+	ユーザーごとにbatch_bytesまでb''.joinして1回のsendで送る(メッセージごとにsendすると、
+	全員 × メッセージ数のシステムコールになる)。待つ時間の分だけ配送は遅れる
+"""
+
+class Outbox:
+	def	__init__(self, client_socket):
+		self.client_socket = client_socket
+		self.queue = deque()		# 送っていないメッセージ(Fanout.lockで守る)
+		self.current = None			# 送信中のメッセージの残り(書き込みスレッドだけが触る)
+		self.scheduled = False		# 書き込みスレッドの処理待ち、または書き込み可能待ち
+		self.waiting = False		# 送信バッファが詰まってselectorに登録している(書き込みスレッドだけが変える)
+		self.closed = False
+		self.overflowed = False		# policyで切断した
+		self.dropped = 0
+		self.done = threading.Event()	# 書き込みスレッドがこのOutboxを手放した(ソケットを閉じてよい)
+
+	# 受信スレッドのrecvと、書き込み可能待ちを起こす
+	def	shutdown(self):
+		try:
+			self.client_socket.shutdown(socket.SHUT_RDWR)
+		except OSError:
+			pass
+
+class Fanout:
+	def	__init__(self, limit, policy='disconnect', batch_bytes=0, batch_delay=0.0):
+		self.limit = limit
+		self.policy = policy
+		self.batch_bytes = batch_bytes
+		self.batch_delay = batch_delay
+		self.lock = threading.Lock()
+		self.ready = deque()		# 送るものがあるOutbox
+		self.selector = selectors.DefaultSelector()
+		self.wakeup_recv, self.wakeup_send = socket.socketpair()
+		self.wakeup_recv.setblocking(False)
+		self.wakeup_send.setblocking(False)
+		self.selector.register(self.wakeup_recv, selectors.EVENT_READ)
+		self.published = 0
+		self.enqueued = 0
+		self.sends = 0				# sendのシステムコールの回数
+		self.written = 0			# sendに渡したメッセージの数
+		self.disconnected = 0
+		self.writer = threading.Thread(target=self.run, daemon=True)
+
+	def	start(self):
+		self.writer.start()
+
+	# messageをrecipients(Outboxのイテラブル)のキューに入れる
+	# 戻り値: 入れたOutboxの数
+	def	publish(self, message, recipients) -> int:
+		count = 0
+		overflowed = []
+		with self.lock:
+			self.published += 1
+			wake = not self.ready
+			for outbox in recipients:
+				if outbox.closed:
+					continue
+				backlog = len(outbox.queue)
+				if self.limit <= backlog and (outbox.waiting or self.limit * 4 <= backlog):
+					if self.policy == 'drop':
+						outbox.queue.popleft()
+						outbox.dropped += 1
+					else:
+						outbox.overflowed = True
+						outbox.closed = True
+						outbox.queue.clear()
+						overflowed.append(outbox)
+						continue
+				outbox.queue.append(message)
+				count += 1
+				if not outbox.scheduled:
+					outbox.scheduled = True
+					self.ready.append(outbox)
+			self.enqueued += count
+			self.disconnected += len(overflowed)
+		if wake:
+			self.wake()
+		for outbox in overflowed:
+			outbox.shutdown()
+		return count
+
+	# 書き込みスレッドにOutboxを手放させる(終わるとoutbox.doneがセットされる)
+	def	close(self, outbox):
+		# 書き込み可能待ちのまま止まっているソケットもあるので、処理待ちに入れて必ず書き込みスレッドに触らせる
+		with self.lock:
+			outbox.closed = True
+			outbox.queue.clear()
+			outbox.scheduled = True
+			self.ready.append(outbox)
+		self.wake()
+
+	def	wake(self):
+		try:
+			self.wakeup_send.send(b'\0')
+		except BlockingIOError:
+			pass		# 既に起こしてある
+
+	def	stats(self) -> dict:
+		with self.lock:
+			return {
+				'published': self.published,
+				'enqueued': self.enqueued,
+				'sends': self.sends,
+				'written': self.written,
+				'disconnected': self.disconnected
+			}
+
+	# 書き込みスレッド
+	def	run(self):
+		while True:
+			for key, _ in self.selector.select():
+				if key.fileobj is self.wakeup_recv:
+					try:
+						self.wakeup_recv.recv(4096)
+					except BlockingIOError:
+						pass
+					if self.batch_delay:
+						time.sleep(self.batch_delay)		# 続くメッセージを溜めてからまとめて送る
+				else:
+					self.flush(key.data)
+			while True:
+				with self.lock:
+					if not self.ready:
+						break
+					outbox = self.ready.popleft()
+				self.flush(outbox)
+
+	# キューの先頭からbatch_bytesまでのメッセージを1つにつなげて取り出す(lockの下で呼ぶ)
+	def	take(self, queue) -> bytes:
+		message = queue.popleft()
+		if not queue or not self.batch_bytes:
+			self.written += 1
+			return message
+		batch = [message]
+		size = len(message)
+		while queue and size + len(queue[0]) <= self.batch_bytes:
+			message = queue.popleft()
+			batch.append(message)
+			size += len(message)
+		self.written += len(batch)
+		return b''.join(batch)
+
+	# 送れるだけ送る。送り切るか閉じたら手放し、ブロックしそうならselectorで書き込み可能を待つ
+	def	flush(self, outbox):
+		while not outbox.closed:
+			if outbox.current is None:
+				with self.lock:
+					if not outbox.queue:
+						outbox.scheduled = False
+						break
+					outbox.current = memoryview(self.take(outbox.queue))
+			try:
+				sent = outbox.client_socket.send(outbox.current, socket.MSG_DONTWAIT)
+			except BlockingIOError:
+				if not outbox.waiting:
+					outbox.waiting = True
+					self.selector.register(outbox.client_socket, selectors.EVENT_WRITE, outbox)
+				return
+			except OSError as e:
+				print(f'ERROR flush/Fanout: {e}')
+				with self.lock:
+					outbox.closed = True
+				outbox.shutdown()
+				break
+			self.sends += 1
+			outbox.current = outbox.current[sent:] if sent < len(outbox.current) else None
+
+		if outbox.waiting:
+			outbox.waiting = False
+			self.selector.unregister(outbox.client_socket)
+		if outbox.closed:
+			outbox.current = None
+			with self.lock:
+				outbox.scheduled = False
+			outbox.done.set()
+
+class Registry:
+	# 変更(add / remove)はlockの下で行う。全員のtupleはmembers()が呼ばれた時に作り直す
+	# (ブロードキャストはチャンネルごとなので、参加・退出のたびに全員分を作り直さない)
+	def	__init__(self):
+		self.lock = threading.Lock()
+		self.clients = {}
+		self.snapshot = ()
+
+	def	__contains__(self, nickname) -> bool:
+		with self.lock:
+			return nickname in self.clients
+
+	def	__len__(self) -> int:
+		return len(self.clients)
+
+	# ニックネームからClientDataを引く、いなければNone
+	def	get(self, nickname):
+		with self.lock:
+			return self.clients.get(nickname)
+
+	# 戻り値: 追加したらTrue、同じニックネームが既にあればFalse
+	def	add(self, nickname, client) -> bool:
+		with self.lock:
+			if nickname in self.clients:
+				return False
+			self.clients[nickname] = client
+			self.snapshot = None
+		return True
+
+	def	remove(self, nickname) -> bool:
+		with self.lock:
+			if self.clients.pop(nickname, None) is None:
+				return False
+			self.snapshot = None
+		return True
+
+	def	members(self) -> tuple:
+		with self.lock:
+			if self.snapshot is None:
+				self.snapshot = tuple(self.clients.values())
+			return self.snapshot
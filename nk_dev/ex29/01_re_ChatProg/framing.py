@@ -0,0 +1,53 @@
+"""
+	チャットのメッセージの区切り(1メッセージ = 改行で終わる1行)
+	framing.py:
+		- LineBufferクラス(受信したバイト列を溜めて、完成した行を取り出す)
+		- LineReaderクラス(ブロッキングのソケットから1行ずつ読む)
+
+	TCPはメッセージの境界を保たないので、1回のrecvを1メッセージとして扱うと
+	長いメッセージは分かれ、続けて送られたメッセージはつながってしまう
+	受信側は接続ごとにLineBufferへ溜め、改行までを1メッセージとして取り出す(途中の行は次のrecvを待つ)
+	改行が来ないままMAX_LINEを超えたら、LineTooLongを投げる(相手の誤り、またはメモリを使わせる攻撃)
+"""
+
+MAX_LINE = 4096			# 1行(改行を含まない)の上限バイト数
+RECV_SIZE = 65536
+
+class LineTooLong(ValueError):
+	pass
+
+class LineBuffer:
+	def	__init__(self, max_line=MAX_LINE):
+		self.max_line = max_line
+		self.buffer = bytearray()
+
+	# dataを追加し、完成した行(改行を除いたbytes)のリストを返す
+	def	feed(self, data) -> list:
+		self.buffer += data
+		if b'\n' not in data:
+			if self.max_line < len(self.buffer):
+				raise LineTooLong(f'line exceeds {self.max_line} bytes')
+			return []
+		lines = self.buffer.split(b'\n')
+		self.buffer = bytearray(lines.pop())
+		if self.max_line < len(self.buffer) or any(self.max_line < len(line) for line in lines):
+			raise LineTooLong(f'line exceeds {self.max_line} bytes')
+		return [bytes(line) for line in lines]
+
+class LineReader:
+	def	__init__(self, client_socket, max_line=MAX_LINE):
+		self.client_socket = client_socket
+		self.line_buffer = LineBuffer(max_line)
+		self.lines = []
+		self.reads = 0		# recvの回数
+
+	# 1行読む(改行は除く)、相手が閉じたらNone
+	def	read_line(self) -> bytes | None:
+		while not self.lines:
+			data = self.client_socket.recv(RECV_SIZE)
+			self.reads += 1
+			if not data:
+				return None
+			self.lines = self.line_buffer.feed(data)
+			self.lines.reverse()		# 末尾からpopする
+		return self.lines.pop()
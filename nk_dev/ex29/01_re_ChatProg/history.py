@@ -0,0 +1,179 @@
+import os
+import time
+import threading
+from urllib.parse import quote
+from collections import deque, OrderedDict
+
+"""
+	チャンネルごとの最近のメッセージ(参加した時に送り直す)
+	history.py:
+		- tail_lines関数(ファイルの末尾から後ろ向きにn行を読む)
+		- Historyクラス(チャンネルごとのリングバッファと、ディスクへの追記ログ)
+
+	チャンネルごとに最近のsize件を、配ったままのbytes(エンコード済み)でdeque(maxlen=size)に持つ
+	覚えておくチャンネルはmax_channels個までで、一番長く使われていないものから忘れる
+	(1チャンネルのメモリは最大でsize行、1行はframing.MAX_LINEまでなので、全体でも上限がある)
+	参加したユーザーには、その時点の内容を1つのbytesにつなげて送信キューに1回入れるだけなので、
+	送り直す量が多くても他のユーザーの送信は待たない
+
+	directoryを指定すると、チャンネルごとのファイル(<directory>/<チャンネル名>.log)に1行ずつ追記する
+		- 追記はファイルのバッファに入れるだけで、同期スレッドがsync_interval秒ごとにまとめてflushし、lockの外でfsyncする
+		- 再起動した後に初めて使われたチャンネルは、ファイルの末尾から後ろ向きにsize行だけ読む
+		  (ファイルがどれだけ大きくても、読むのは最近のsize行分だけ。ファイルの末尾が索引の代わり)
+		- ディスクを読むのはload()だけで、呼び出し側がlockを取る前に呼ぶ
+		  (ディスクが遅くても、他のチャンネルの発言や参加を待たせない)
+"""
+
+HISTORY_SIZE = 50			# チャンネルごとに覚えておくメッセージ数
+MAX_CHANNELS = 1024			# 覚えておくチャンネル数
+SYNC_INTERVAL = 1.0			# まとめてfsyncする間隔(秒)
+TAIL_BLOCK = 8192			# 末尾から読む時の1回の読み込みサイズ
+
+# ファイルの末尾からcount行(改行を含むbytes)を読む
+# 書きかけの最後の行(書いている途中で落ちた場合)は捨てる
+def	tail_lines(path, count) -> list:
+	if not count:
+		return []
+	try:
+		f = open(path, 'rb')
+	except FileNotFoundError:
+		return []
+	with f:
+		position = f.seek(0, os.SEEK_END)
+		data = b''
+		while position and data.count(b'\n') <= count:
+			size = min(TAIL_BLOCK, position)
+			position -= size
+			f.seek(position)
+			data = f.read(size) + data
+	lines = data.split(b'\n')
+	lines.pop()				# 最後の改行の後ろ(空、または書きかけの行)
+	if position:
+		lines.pop(0)		# 途中から読んだ先頭の行
+	return [line + b'\n' for line in lines[-count:]]
+
+class History:
+	def	__init__(self, size=HISTORY_SIZE, directory=None, sync_interval=SYNC_INTERVAL, max_channels=MAX_CHANNELS):
+		self.size = size
+		self.directory = directory
+		self.sync_interval = sync_interval
+		self.max_channels = max_channels
+		self.lock = threading.Lock()
+		self.channels = OrderedDict()	# チャンネル名 → 最近のメッセージのdeque(使った順、先頭が一番古い)
+		self.files = {}					# チャンネル名 → 追記用のファイル
+		self.dirty = set()				# fsyncしていない書き込みがあるファイル
+		self.closing = []				# 忘れたチャンネルのファイル(同期スレッドがfsyncしてから閉じる)
+		self.appended = 0
+		self.replayed = 0
+		self.syncs = 0					# fsyncの回数
+		self.syncer = threading.Thread(target=self.run, daemon=True)
+
+	# ディスクに残す時だけ、同期スレッドを開始する
+	def	start(self):
+		if self.directory is None:
+			return
+		os.makedirs(self.directory, exist_ok=True)
+		self.syncer.start()
+
+	def	path(self, name) -> str:
+		return os.path.join(self.directory, quote(name, safe='') + '.log')
+
+	# まだ覚えていないチャンネルなら、ファイルの末尾からsize行を読んで返す(覚えていればNone)
+	# lockを取らずに呼び、戻り値をappend / recentのloadedに渡す
+	def	load(self, name) -> list | None:
+		if not self.size or self.directory is None or name in self.channels:
+			return None
+		return tail_lines(self.path(name), self.size)
+
+	# lockの下で呼ぶ。チャンネルのdequeを返す(初めてならloadedから作り、多すぎたら一番古いチャンネルを忘れる)
+	# load()の後に忘れられた場合はloadedがNoneのまま来るので、ディスクは読まずに空から始める
+	def	buffer(self, name, loaded=None) -> deque:
+		messages = self.channels.get(name)
+		if messages is not None:
+			self.channels.move_to_end(name)
+			return messages
+		messages = deque(loaded or (), maxlen=self.size)
+		self.channels[name] = messages
+		if self.max_channels < len(self.channels):
+			old, _ = self.channels.popitem(last=False)
+			f = self.files.pop(old, None)
+			if f is not None:
+				# 同じチャンネルを開き直した後に、古いバッファの中身が後から書かれないよう、ここでflushする
+				f.flush()
+				self.dirty.discard(f)
+				self.closing.append(f)
+		return messages
+
+	# メッセージ(エンコード済みの1行)を覚えて、ログに追記する(loadedはload()の戻り値)
+	def	append(self, name, message, loaded=None):
+		if not self.size:
+			return
+		with self.lock:
+			self.buffer(name, loaded).append(message)
+			self.appended += 1
+			if self.directory is None:
+				return
+			f = self.files.get(name)
+			if f is None:
+				f = self.files[name] = open(self.path(name), 'ab')
+			f.write(message)
+			self.dirty.add(f)
+
+	# 最近のメッセージを1つのbytesにつなげて返す(loadedはload()の戻り値)
+	def	recent(self, name, loaded=None) -> bytes:
+		if not self.size:
+			return b''
+		with self.lock:
+			messages = self.buffer(name, loaded)
+			self.replayed += len(messages)
+			return b''.join(messages)
+
+	def	stats(self) -> dict:
+		with self.lock:
+			return {
+				'channels': len(self.channels),
+				'appended': self.appended,
+				'replayed': self.replayed,
+				'syncs': self.syncs
+			}
+
+	# 同期スレッド
+	def	run(self):
+		while True:
+			time.sleep(self.sync_interval)
+			self.sync()
+
+	# 溜まった書き込みをまとめてflushし、lockの外でfsyncする
+	def	sync(self):
+		with self.lock:
+			files = list(self.dirty)
+			self.dirty.clear()
+			closing = self.closing
+			self.closing = []
+			for f in files:
+				f.flush()
+		for f in files + closing:
+			try:
+				os.fsync(f.fileno())
+			except (OSError, ValueError) as e:
+				print(f'ERROR sync/History: {e}')		# 終了時にclose()が先に閉じた場合など
+		for f in closing:
+			f.close()
+		with self.lock:
+			self.syncs += len(files) + len(closing)
+
+	# 全部のファイルをflush、fsyncして閉じる(サーバーの終了時)
+	def	close(self):
+		with self.lock:
+			files = list(self.files.values()) + self.closing
+			self.files.clear()
+			self.dirty.clear()
+			self.closing = []
+			for f in files:
+				try:
+					f.flush()
+					os.fsync(f.fileno())
+					f.close()
+				except (OSError, ValueError):
+					pass
+			self.syncs += len(files)
@@ -1,37 +1,69 @@
 #!/usr/bin/env python3
 
 """
+	チャットサーバー(1クライアント1スレッド)
 
+	メッセージは改行で終わる1行(ニックネームも1行で送る)
+	接続ごとのframing.LineReaderで、recvの区切りに関係なく1行ずつ取り出す
+
+	ユーザーはチャンネルに参加し、メッセージは発言先のチャンネルのメンバーにだけ届く(channels.py)
+		- ログインするとgeneralに入る。/join /leave /list /msg のコマンドはChannelsが処理する
+		- 送信先はチャンネルごとのメンバーのtupleで、全ユーザーの一覧は見ない
+
+	メッセージの配送はfanout.pyに任せる
+		- deliverは1回だけエンコードしたメッセージを、送信先の送信キュー(Outbox)に入れるだけ
+		- 1本の書き込みスレッドがブロックせずに送るので、読まないユーザーがいても他の配送は止まらない
+		- キューがOUTBOX_LIMITを超えたユーザーはSLOW_POLICYで切断(または古いメッセージを捨てる)
+		- 書き込みスレッドは起こされてからBATCH_DELAY秒待ち、ユーザーごとに溜まったメッセージを
+		  BATCH_BYTESまで1回のsendにまとめる
+
+	チャンネルごとに最近のHISTORY_SIZE件を覚えておき(history.py)、ニックネームが決まってgeneralに入った時や
+	/joinした時に、1つのbytesにつなげて送信キューに入れる(送るのは書き込みスレッドなので、他の発言は待たない)
+	HISTORY_DIRを指定すると、チャンネルごとのファイルにも追記し、再起動後はその末尾から読み直す
 """
 
 import sys
 import socket
 import threading
 
-MAX_ATTEMPT = 5
+from fanout import Outbox, Fanout, Registry
+from channels import Channels
+from history import History
+from framing import LineReader, LineTooLong
 
-clients = {}
-lock = threading.Lock()
+MAX_ATTEMPT = 5
+OUTBOX_LIMIT = 256				# ユーザーごとの送信キューの上限(件)
+SLOW_POLICY = 'disconnect'		# 上限を超えた時: 'disconnect'(切断)、'drop'(古いメッセージを捨てる)
+SEND_BUFFER = 32 * 1024			# ユーザーごとのカーネルの送信バッファ(SO_SNDBUF、0ならOSの自動調整に任せる)
+								# 読まないユーザーにはキューの前にここまで溜まる(ループバックでは自動調整で約4MBまで増える)
+BATCH_BYTES = 64 * 1024			# 1回のsendにまとめるメッセージの合計の上限(0ならまとめない)
+BATCH_DELAY = 0.002				# 書き込みスレッドが起こされてから、メッセージが溜まるのを待つ秒数
+HISTORY_SIZE = 50				# チャンネルごとに覚えておく最近のメッセージ数(参加した時に送り直す、0なら覚えない)
+HISTORY_DIR = None				# 履歴を追記するディレクトリ(Noneならディスクに残さない)
+
+clients = Registry()
+fanout = Fanout(OUTBOX_LIMIT, SLOW_POLICY, BATCH_BYTES, BATCH_DELAY)
+
+# 受信の統計(ログアウト時に接続ごとの値を足す、終了時に出力)
+received_reads = 0
+received_messages = 0
+stats_lock = threading.Lock()
 
 class ClientData:
-	# ニックネーム、ソケット、アドレスを保存
+	# ニックネーム、ソケット、アドレス、送信キューを保存
 	def	__init__(self, nickname, client_socket, client_address):
 		self.nickname = nickname
 		self.client_socket = client_socket
 		self.address = client_address
+		self.outbox = Outbox(client_socket)
+		self.farewell = None		# 切断の前に最後に送るメッセージ(書き込みスレッドが手放した後に直接送る)
 
-	# ユーザーにメッセージを送信
+	# ユーザーにメッセージを送信(送信キューに入れるだけで、実際の送信は書き込みスレッドが行う)
 	def	send_message(self, message) -> bool:
-		try:
-			# メッセージがstrだったらエンコード
-			if isinstance(message, str):
-				message = message.encode('utf-8', errors='replace')
-			# エンコード済みのメッセージをユーザーに送信
-			self.client_socket.sendall(message)
-			return True
-		except Exception as e:
-			print(f'ERROR send_message/ClientData: {e}')
-			return False
+		# メッセージがstrだったらエンコード
+		if isinstance(message, str):
+			message = message.encode('utf-8', errors='replace')
+		return fanout.publish(message, (self.outbox,)) == 1
 
 def	create_server_socket(host='127.0.0.1', port=8080):
 
@@ -55,36 +87,27 @@ def	conf_nickname(nickname: str) -> int:
 	# 空文字、20文字以内の確認
 	if not nickname or 20 < len(nickname):
 		return -1
-	# 排他制御下で重複を確認
-	with lock:
-		if nickname in clients:
-			return 1
+	# 重複を確認(Registryが排他制御する)
+	if nickname in clients:
+		return 1
 	return 0
 
-# 全ユーザーにメッセージを送信する関数
-def	broadcast(message) -> bool:
-	global	clients
+# エンコード済みのメッセージをusers(ClientData)の送信キューに入れる関数(Channelsが送る時に呼ぶ)
+# 送信キューがあふれたユーザーは切断するだけなので、ここでは止まらない
+def	deliver(message, users) -> int:
+	return fanout.publish(message, [user.outbox for user in users])
 
-	# str型ならエンコード
-	if isinstance(message, str):
-		message = message.encode('utf-8', errors='replace')
-	try:
-		# 全ユーザーソケットへ送信ループ
-		for user in clients.keys():
-			clients[user].send_message(message)
-		return True
-	except Exception as e:
-		print(f'ERROR broadcast: {e}')
-		return False
+history = History(HISTORY_SIZE, HISTORY_DIR)
+channels = Channels(clients, deliver, history)
 
 # ニックネーム受信のプロセス関数
-def	process_nickname(client_socket) -> str | None:
+def	process_nickname(client_socket, reader) -> str | None:
 	# マクロ回数までニックネームを受付
 	for attempt in range(MAX_ATTEMPT):
-		nickname_bytes = client_socket.recv(1024)
+		nickname_bytes = reader.read_line()
 
-		# 空文字なら切断として終了
-		if not nickname_bytes:
+		# Noneなら切断として終了
+		if nickname_bytes is None:
 			print('Client disconnected')
 			return None
 
@@ -120,13 +143,20 @@ def	process_nickname(client_socket) -> str | None:
 
 	return nickname
 
-# メッセージ受信プロセス関数
+# メッセージ受信プロセス関数(1行 = 1メッセージ)
 # 切断・エラー時はFalse、次のループへ行くならTrue
-def	receive_message(nickname, client_socket) -> bool:
-	message_bytes = client_socket.recv(1024)
+def	receive_message(client, reader) -> bool:
+	global	received_messages
 
-	# バイト列が空なら切断と判断
-	if not message_bytes:
+	try:
+		message_bytes = reader.read_line()
+	except LineTooLong as e:
+		print(f'ERROR receive_message: {client.nickname}: {e}')
+		client.farewell = 'ERROR: Message too long\nDisconnecting...\n'
+		return False
+
+	# Noneなら切断と判断
+	if message_bytes is None:
 		return False
 
 	# メッセージをデコード・空文字なら次のループへ
@@ -134,35 +164,44 @@ def	receive_message(nickname, client_socket) -> bool:
 	if not message:
 		return True
 
-	# メッセージをブロードキャスト
-	message = f'{nickname}: {message}\n'
-	if not broadcast(message):
-		return False
+	# コマンドを処理するか、発言先のチャンネルにブロードキャスト
+	with stats_lock:
+		received_messages += 1
+	channels.say(client.nickname, client, message)
 
 	return True
 
 def	handle_client(client_socket, client_address):
 	global	clients
 
+	global	received_reads
+
+	client = None
+	reader = LineReader(client_socket)
 	try:
+		if SEND_BUFFER:
+			client_socket.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, SEND_BUFFER)
+
 		# 1. 適格なニックネームの確認・ニックネーム作成ができなかった場合終了
-		nickname = process_nickname(client_socket)
+		nickname = process_nickname(client_socket, reader)
 		if not nickname:
 			return
 
-		# 2. 排他制御下でclientオブジェクトを作成
-		with lock:
-			clients[nickname] = ClientData(nickname, client_socket, client_address)
-
-		# ログインメッセージをブロードキャスト、失敗時は終了
-		login_message = f'Say hello to {nickname} !\n'
-		if not broadcast(login_message):
+		# 2. clientオブジェクトを作成して登録(確認の後に同じニックネームが先に登録された場合は終了)
+		client = ClientData(nickname, client_socket, client_address)
+		if not clients.add(nickname, client):
+			message = f'Warning: Nickname "{nickname}" is already used\n'
+			client_socket.sendall(message.encode('utf-8', errors='replace'))
+			client = None
 			return
 
+		# generalに入れて、ログインメッセージをブロードキャスト
+		channels.login(nickname, client)
+
 		# 3. メッセージ受信ループ
 		while True:
 			# クライアント切断・ブロードキャスト失敗時は終了
-			if not receive_message(nickname, client_socket):
+			if not receive_message(client, reader):
 				return
 			# 問題がなければ受信待ちへ戻る
 			else:
@@ -172,14 +211,24 @@ def	handle_client(client_socket, client_address):
 		print(f'ERROR handle_client: {e}')
 		return
 	finally:
-		# クライアント辞書に存在を確認し、排他制御下でクライアントデータを削除
-		if nickname in clients:
-			with lock:
-				del clients[nickname]
-				print(f'{nickname} logout')
-
-				message = f'{nickname} logout\n'
-				broadcast(message)
+		with stats_lock:
+			received_reads += reader.reads
+
+		# チャンネルから抜けてログアウトをブロードキャストし、登録を削除して書き込みスレッドを止める
+		# (チャンネルはニックネームで覚えているので、同じニックネームを次のユーザーが使えるのは抜けた後)
+		if client is not None:
+			channels.logout(client.nickname)
+			clients.remove(client.nickname)
+			fanout.close(client.outbox)
+			client.outbox.done.wait()		# 書き込みスレッドがソケットを手放してから閉じる
+			if client.farewell and not client.outbox.overflowed:
+				try:
+					client_socket.sendall(client.farewell.encode('utf-8', errors='replace'))
+				except OSError:
+					pass
+			if client.outbox.overflowed:
+				print(f'{client.nickname} disconnected: outbox is full (slow reader)')
+			print(f'{client.nickname} logout')
 
 		# クライアントソケットを閉じる
 		try:
@@ -190,8 +239,10 @@ def	handle_client(client_socket, client_address):
 # サーバーのメイン関数
 def	run_server(host='127.0.0.1', port=8080):
 
-	# ソケットを作成
+	# ソケットを作成し、書き込みスレッドと履歴の同期スレッドを開始
 	server_socket = create_server_socket(host, port)
+	fanout.start()
+	history.start()
 	print(f'Server listening {host}:{port}')
 	print('Press Ctrl + C to stop')
 	print()
@@ -218,6 +269,10 @@ def	run_server(host='127.0.0.1', port=8080):
 			server_socket.close()
 		except:
 			pass
+		print(f'receive: reads={received_reads} messages={received_messages}')
+		print(f'fanout: {fanout.stats()}')
+		history.close()
+		print(f'history: {history.stats()}')
 		print('Server stopped')
 
 if __name__ == '__main__':
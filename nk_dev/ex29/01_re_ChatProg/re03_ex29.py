@@ -0,0 +1,350 @@
+#!/usr/bin/env python3
+
+"""
+	チャットサーバー(selectorsによる1スレッドのイベントループ)
+
+	re02_ex29.pyと同じプロトコル(1行 = 1メッセージ、最初の行がニックネーム)で、
+	1クライアント1スレッドの代わりに、全員のソケットを1つのselector(Linuxではepoll)で待つ
+	何もしていないユーザーはConnection(接続ごとの状態)とソケットだけになり、スレッドのスタックを持たない
+
+	接続ごとの状態(Connection):
+		nickname is None	- ニックネームの入力待ち(process_nicknameを1行ごとに呼び、MAX_ATTEMPT回まで)
+		nickname			- 登録済み、1行ごとにreceive_messageでブロードキャスト
+		closing				- 送信キューを送り切ったら閉じる(試行回数の超過・長すぎる行)
+
+	メッセージは発言先のチャンネルのメンバーにだけ届く(channels.py、re02_ex29.pyと同じ)
+	参加した時に、チャンネルの最近のHISTORY_SIZE件が送り直される(history.py、fsyncは同期スレッドが行う)
+
+	送信はすべてノンブロッキング
+		- deliverは1回だけエンコードしたメッセージを、送信先の送信キューに入れるだけ
+		- 最初のメッセージがキューに入ってからBATCH_DELAY秒待ち、ユーザーごとにBATCH_BYTESまでまとめて1回のsendで送る
+		  (ニックネームへの返事だけはすぐに送る。re02_ex29.pyと同じく、続けて参加があっても参加のメッセージはまとめて送られる)
+		- 人数が多く、全員に送るのにBATCH_DELAYより時間がかかる時は、前回のまとめ送りが終わってから
+		  それにかかった時間が経つまで待つ(ループの半分以上の時間を送信に使わない)
+		  (1つのスレッドで送るので、待たないとメッセージ1件ごとに全員分のsendになり、受信が止まる)
+		- 送り切れなかったユーザーだけEVENT_WRITEを待つ
+		- キューがOUTBOX_LIMITを超え、送信バッファも詰まっているユーザーはSLOW_POLICYで切断(または古いものを捨てる)
+"""
+
+import time
+import socket
+import selectors
+from collections import deque
+
+from fanout import Registry
+from channels import Channels
+from history import History
+from framing import LineBuffer, LineTooLong, RECV_SIZE
+
+MAX_ATTEMPT = 5
+OUTBOX_LIMIT = 256				# ユーザーごとの送信キューの上限(件)
+SLOW_POLICY = 'disconnect'		# 上限を超えた時: 'disconnect'(切断)、'drop'(古いメッセージを捨てる)
+SEND_BUFFER = 32 * 1024			# ユーザーごとのカーネルの送信バッファ(SO_SNDBUF、0ならOSの自動調整に任せる)
+BATCH_BYTES = 64 * 1024			# 1回のsendにまとめるメッセージの合計の上限
+BATCH_DELAY = 0.002				# 最初のメッセージがキューに入ってから、まとめて送るまで待つ秒数
+HISTORY_SIZE = 50				# チャンネルごとに覚えておく最近のメッセージ数(参加した時に送り直す、0なら覚えない)
+HISTORY_DIR = None				# 履歴を追記するディレクトリ(Noneならディスクに残さない)
+BACKLOG = 1024					# listen()の接続待ちキュー長
+
+clients = Registry()
+selector = selectors.DefaultSelector()
+dirty = []			# 送信キューに入って、まとめて送るのを待っているConnection
+doomed = []			# 送信キューがあふれて、まとめて送る時に切断するConnection
+stats = {'reads': 0, 'messages': 0, 'sends': 0, 'written': 0, 'disconnected': 0}
+
+class Connection:
+	# 接続ごとの状態(数万接続を持つので__slots__で小さくする)
+	__slots__ = (
+		'client_socket', 'address', 'line_buffer', 'nickname', 'attempts',
+		'outbox', 'current', 'waiting', 'dirty', 'closing', 'closed', 'overflowed', 'dropped'
+	)
+
+	def	__init__(self, client_socket, client_address):
+		self.client_socket = client_socket
+		self.address = client_address
+		self.line_buffer = LineBuffer()
+		self.nickname = None		# 登録するまでNone
+		self.attempts = 0
+		self.outbox = deque()		# 送っていないメッセージ(bytes)
+		self.current = None			# 送信中のメッセージの残り(memoryview)
+		self.waiting = False		# 送信バッファが詰まってEVENT_WRITEを待っている
+		self.dirty = False			# dirtyに入っている
+		self.closing = False
+		self.closed = False
+		self.overflowed = False
+		self.dropped = 0
+
+	# ユーザーにメッセージを送信(送信キューに入れるだけで、BATCH_DELAY秒後にまとめて送る)
+	def	send_message(self, message) -> bool:
+		# メッセージがstrだったらエンコード
+		if isinstance(message, str):
+			message = message.encode('utf-8', errors='replace')
+		if self.closed or self.overflowed:
+			return False
+		backlog = len(self.outbox)
+		if OUTBOX_LIMIT <= backlog and (self.waiting or OUTBOX_LIMIT * 4 <= backlog):
+			if SLOW_POLICY == 'drop':
+				self.outbox.popleft()
+				self.dropped += 1
+			else:
+				self.overflowed = True
+				self.outbox.clear()
+				doomed.append(self)
+				return False
+		self.outbox.append(message)
+		if not self.dirty and not self.waiting:
+			self.dirty = True
+			dirty.append(self)
+		return True
+
+def	create_server_socket(host='127.0.0.1', port=8080):
+
+	# IPv4, TCPでソケットを作成
+	server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+
+	# 再起動時にアドレスの再利用を許可
+	server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+
+	# IPアドレスとポートを紐付ける
+	server_socket.bind((host, port))
+
+	# 接続待ち状態にする(多数の接続が一度に来ても取りこぼさないようBACKLOGまで)
+	server_socket.listen(BACKLOG)
+	server_socket.setblocking(False)
+
+	return server_socket
+
+def	conf_nickname(nickname: str) -> int:
+	# 空文字、20文字以内の確認
+	if not nickname or 20 < len(nickname):
+		return -1
+	# 重複を確認
+	if nickname in clients:
+		return 1
+	return 0
+
+# エンコード済みのメッセージをusers(Connection)の送信キューに入れる関数(Channelsが送る時に呼ぶ)
+def	deliver(message, users) -> int:
+	count = 0
+	for user in users:
+		if user.send_message(message):
+			count += 1
+	return count
+
+history = History(HISTORY_SIZE, HISTORY_DIR)
+channels = Channels(clients, deliver, history)
+
+# ニックネームの1回の入力を処理する(MAX_ATTEMPT回を超えたら閉じる)
+def	process_nickname(conn, line):
+	nickname = line.decode('utf-8', errors='replace').strip()
+	conn.attempts += 1
+
+	# conf_nicknameの結果を保存
+	result = conf_nickname(nickname)
+
+	# 適格なニックネームなら登録して、ログインメッセージをブロードキャスト
+	if result == 0:
+		conn.send_message(f'Hello {nickname} !\n')
+		flush(conn)
+		if conn.closed:
+			return		# 送れずに閉じた(登録していないので、disconnectで外すものはない)
+		conn.nickname = nickname
+		clients.add(nickname, conn)
+		channels.login(nickname, conn)
+		return
+
+	# ニックネームが空文字・20文字以上、または重複
+	if result == -1:
+		conn.send_message(f'Warning: Nickname "{nickname}" is invalid\n')
+	else:
+		conn.send_message(f'Warning: Nickname "{nickname}" is already used\n')
+
+	# 試行回数を超過したら、送り終えてから閉じる
+	if MAX_ATTEMPT <= conn.attempts:
+		conn.send_message('ERROR: Too many attempt\nDisconnecting...\n')
+		conn.closing = True
+	flush(conn)
+
+# 登録済みのユーザーの1行を、コマンドとして処理するか発言先のチャンネルにブロードキャスト
+def	receive_message(conn, line):
+	# メッセージをデコード・空文字なら無視
+	message = line.decode('utf-8', errors='replace').strip()
+	if not message:
+		return
+	stats['messages'] += 1
+	channels.say(conn.nickname, conn, message)
+
+# 読めるようになった接続を処理する
+def	handle_readable(conn):
+	try:
+		data = conn.client_socket.recv(RECV_SIZE)
+	except BlockingIOError:
+		return
+	except OSError as e:
+		print(f'ERROR handle_readable: {e}')
+		disconnect(conn)
+		return
+	stats['reads'] += 1
+
+	# 空ならクライアントの切断
+	if not data:
+		disconnect(conn)
+		return
+	if conn.closing:
+		return		# 閉じる前の送信中は読み捨てる
+
+	try:
+		lines = conn.line_buffer.feed(data)
+	except LineTooLong as e:
+		print(f'ERROR handle_readable: {conn.nickname or conn.address}: {e}')
+		conn.send_message('ERROR: Message too long\nDisconnecting...\n')
+		conn.closing = True
+		return
+	for line in lines:
+		if conn.closing or conn.closed:
+			return
+		if conn.nickname is None:
+			process_nickname(conn, line)
+		else:
+			receive_message(conn, line)
+
+# 送信キューの先頭からBATCH_BYTESまでのメッセージを1つにつなげて取り出す
+def	take(outbox) -> bytes:
+	message = outbox.popleft()
+	if not outbox:
+		stats['written'] += 1
+		return message
+	batch = [message]
+	size = len(message)
+	while outbox and size + len(outbox[0]) <= BATCH_BYTES:
+		message = outbox.popleft()
+		batch.append(message)
+		size += len(message)
+	stats['written'] += len(batch)
+	return b''.join(batch)
+
+# 送れるだけ送る。詰まったらEVENT_WRITEを待ち、送り切ったら待つのをやめる
+def	flush(conn):
+	while conn.current is not None or conn.outbox:
+		if conn.current is None:
+			conn.current = memoryview(take(conn.outbox))
+		try:
+			sent = conn.client_socket.send(conn.current)
+		except BlockingIOError:
+			if not conn.waiting:
+				conn.waiting = True
+				selector.modify(conn.client_socket, selectors.EVENT_READ | selectors.EVENT_WRITE, conn)
+			return
+		except OSError as e:
+			print(f'ERROR flush: {e}')
+			disconnect(conn)
+			return
+		stats['sends'] += 1
+		conn.current = conn.current[sent:] if sent < len(conn.current) else None
+
+	if conn.waiting:
+		conn.waiting = False
+		selector.modify(conn.client_socket, selectors.EVENT_READ, conn)
+	if conn.closing:
+		disconnect(conn)
+
+# 接続を閉じ、登録済みならチャンネルから抜けてログアウトをブロードキャストし、登録を削除する
+def	disconnect(conn):
+	if conn.closed:
+		return
+	conn.closed = True
+	selector.unregister(conn.client_socket)
+	try:
+		conn.client_socket.close()
+	except OSError:
+		pass
+	if conn.nickname is not None:
+		channels.logout(conn.nickname)
+		clients.remove(conn.nickname)
+		if conn.overflowed:
+			stats['disconnected'] += 1
+			print(f'{conn.nickname} disconnected: outbox is full (slow reader)')
+		print(f'{conn.nickname} logout')
+
+def	accept_clients(server_socket):
+	# 待っている接続をまとめて受け付ける
+	while True:
+		try:
+			client_socket, client_address = server_socket.accept()
+		except BlockingIOError:
+			return
+		except OSError as e:
+			print(f'ERROR accept_clients: {e}')		# EMFILEなど、次のループでもう一度
+			return
+		client_socket.setblocking(False)
+		if SEND_BUFFER:
+			client_socket.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, SEND_BUFFER)
+		conn = Connection(client_socket, client_address)
+		selector.register(client_socket, selectors.EVENT_READ, conn)
+
+# 送信キューに入った分をまとめて送り、あふれたユーザーを切断する
+def	flush_dirty():
+	while dirty or doomed:
+		while dirty:
+			conn = dirty.pop()
+			conn.dirty = False
+			if not conn.closed and not conn.waiting:
+				flush(conn)
+		while doomed:
+			disconnect(doomed.pop())		# ログアウトのブロードキャストで、dirtyが増えることもある
+
+# サーバーのメイン関数
+def	run_server(host='127.0.0.1', port=8080):
+
+	# ソケットを作成
+	server_socket = create_server_socket(host, port)
+	selector.register(server_socket, selectors.EVENT_READ, None)
+	history.start()
+	print(f'Server listening {host}:{port} (selector)')
+	print('Press Ctrl + C to stop')
+	print()
+
+	flush_at = None		# 次にまとめて送る時刻
+	flush_time = 0.0	# 前回のまとめ送りにかかった秒数
+	flushed_at = 0.0	# 前回のまとめ送りが終わった時刻
+
+	try:
+		# イベントループ
+		while True:
+			timeout = None if flush_at is None else max(0.0, flush_at - time.monotonic())
+			for key, events in selector.select(timeout):
+				conn = key.data
+				if conn is None:
+					accept_clients(server_socket)
+					continue
+				if events & selectors.EVENT_READ and not conn.closed:
+					handle_readable(conn)
+				if events & selectors.EVENT_WRITE and not conn.closed:
+					flush(conn)
+			if not dirty and not doomed:
+				continue
+			now = time.monotonic()
+			if flush_at is None:
+				# 前回のまとめ送りが終わってから、それにかかった時間が経つまでは送らない(その間に届いた分を次にまとめる)
+				flush_at = max(now + BATCH_DELAY, flushed_at + flush_time)
+			if flush_at <= now:
+				flush_dirty()
+				flushed_at = time.monotonic()
+				flush_time = flushed_at - now
+				flush_at = None
+
+	except KeyboardInterrupt:
+		print('run_server: shuting down server')
+	finally:
+		try:
+			server_socket.close()
+		except:
+			pass
+		print(f'receive: reads={stats["reads"]} messages={stats["messages"]}')
+		print(f'fanout: {stats}')
+		history.close()
+		print(f'history: {history.stats()}')
+		print('Server stopped')
+
+if __name__ == '__main__':
+	run_server()
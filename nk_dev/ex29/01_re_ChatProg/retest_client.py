@@ -4,9 +4,13 @@ import sys
 import threading
 import socket
 
+from framing import LineReader
+
 """
 	01-14:	完成
 			設計上、サーバーが接続を切ると警告を出した後、input()で待つ状態となる
+	10-18:	メッセージを改行で区切るように変更(サーバーと同じ、1行 = 1メッセージ)
+			受信はframing.LineReaderで1行ずつ取り出す(recvの区切りとメッセージの区切りは一致しない)
 
 
 """
@@ -17,14 +21,15 @@ shutdown_flag = threading.Event()
 # サーバーからのメッセージを受信するサブスレッド関数
 # サブスレッドなのでループは関数内で行う
 def	receive_message(client_socket):
+	reader = LineReader(client_socket)
 	# サーバーからのメッセージを受信
 	try:
 		# フラグがfalseな限り継続
 		while not shutdown_flag.is_set():
-			message_bytes = client_socket.recv(1024)
+			message_bytes = reader.read_line()
 
-			# 受信が空ならサーバー切断とみなしプログラムを終了
-			if not message_bytes:
+			# Noneならサーバー切断とみなしプログラムを終了
+			if message_bytes is None:
 				print('\nWarning: Server disconnected')
 				shutdown_flag.set()
 				break
@@ -63,7 +68,7 @@ def	send_message(client_socket):
 
 			# 送信時点でサーバーが閉じている可能性がある
 			try:
-				client_socket.sendall(message.encode('utf-8', errors='replace'))
+				client_socket.sendall((message + '\n').encode('utf-8', errors='replace'))
 			except:
 				# 送信が失敗した場合、サーバーが切断しているとみなし、フラグをたてる
 				shutdown_flag.set()
@@ -98,7 +103,7 @@ def	main(host='127.0.0.1', port=8080):
 				continue
 
 		# ニックネームを送信
-		client_socket.sendall(nickname.encode('utf-8', errors='replace'))
+		client_socket.sendall((nickname.strip() + '\n').encode('utf-8', errors='replace'))
 
 		# receive_message関数をデーモンとして作成
 		receive_thread = threading.Thread(
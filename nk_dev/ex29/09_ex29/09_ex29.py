@@ -1,14 +1,26 @@
 #!/usr/bin/env python3
 
 import sys
+import time
+import signal
 import socket
 import logging
 import threading
 
 import config
-from http import Request, get_request, print_request
-from route import routes, static_search, handle_post_method
-from error import handle_400, handle_404, handle_408, handle_500
+from http import Request, RequestReader, get_request, print_request, wants_keep_alive
+from route import log_routes, set_connection_header, response_cache
+from error import handle_408, handle_500, handle_503, handle_rejected
+from dispatch import dispatch
+from static_cache import static_cache
+from event_server import create_listener, run_event_server
+from worker_pool import WorkerPool, shed
+from async_server import run_async_server
+from prefork import run_prefork_server
+from metrics import metrics, finish_request
+from limits import connection_limiter
+from restart import Handoff, inherited_listener, notify_ready
+from tls import create_context, handshake
 
 """
 	POST, GETメソッドに対応したサーバー
@@ -20,79 +32,113 @@ from error import handle_400, handle_404, handle_408, handle_500
 			2. multipart/form-data;の場合、専用関数に移行(get_form_data)
 			3. 各パートに分割し、保存・出力
 
+	起動モード:
+		thread	- 1接続1スレッド(従来の方式)
+		event	- selectors(epoll)による単一スレッドのイベントループ
+		pool	- 固定数のワーカーと有限キュー、あふれたら503で即座に断る
+		async	- asyncioのイベントループ、async defのハンドラーをそのままawaitする
+		prefork	- eventモードのワーカープロセスをコア数だけfork(GILに縛られず全コアを使う)
+	TLS_CERTを設定するとthread / pool / asyncモードはHTTPSで受け付ける(tls.py)
+
 """
 
+ACCEPT_POLL = 1.0		# acceptを抜けてSIGUSR2のフラグを確認する間隔(秒)
+
 client_count = 0
+active_clients = 0		# 処理中の接続数(受付をやめた後、これが0になるまで待つ)
+draining = False		# 受付をやめた後は、処理中のリクエストを最後にkeep-aliveを切る
+tls_context = None		# TLSを話す時のSSLContext(mainで作る、Noneなら平文)
 lock = threading.Lock()
 config.setup_logging()
 
 
-def	handle_client(client_socket, client_address):
-	global client_count
+# accepted: acceptした時刻(time.perf_counter)、計測のaccept段階に使う
+# connection_limiter.acquireに成功した接続を受け取り、終わったらreleaseする
+# active_clientsはスレッドに渡す前にaccept_clientで数えてあり、終わったらここで減らす
+def	handle_client(client_socket, client_address, accepted=None):
+	global client_count, active_clients
+	request_obj = None
 	try:
+		if accepted is not None:
+			metrics.record_accept(time.perf_counter() - accepted)
 		client_socket.settimeout(config.TIMEOUT_INT)	# timeoutの設定
+		# keep-aliveやパイプラインで、ヘッダーとボディの小さな書き込みがNagleで遅延ACK待ちにならないようにする
+		try:
+			client_socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+		except OSError as e:
+			logging.debug(f'handle_client: {e}')		# acceptした直後に切られた場合
+			return
+		if tls_context is not None:
+			# ハンドシェイクはacceptのループを止めないよう、このスレッドで行う
+			tls_socket = handshake(client_socket, tls_context)
+			if tls_socket is None:
+				return
+			client_socket = tls_socket
 		with lock:
 			client_count += 1
 			client_id = client_count	# ユーザーIDの付与
-		logging.info('')
-		logging.info('handle_client: Connection detected')
-		logging.info(f'\t{client_address[0]}:{client_address[1]} id={client_id}')
-
-		# get_request関数でリクエスト情報を保存
-		request_obj = Request()
-		if get_request(client_socket, request_obj) == -1:
-			logging.error('get_request/handle_client: returned error')
-			raise ValueError
-
-		# リクエスト情報を出力
-		print_request(request_obj)
-
-		# POSTならhandle_post関数でレスポンス
-		if request_obj.method == 'POST':
-			response_obj = handle_post_method(request_obj)
-			response_bytes = response_obj.to_bytes()
-			client_socket.sendall(response_bytes)
-			return
+		logging.debug(f'handle_client: Connection detected {client_address[0]}:{client_address[1]} id={client_id}')
 
-		# 静的ファイルの捜索
-		static_data = static_search(request_obj.path)
-		if static_data:
-			response_obj = static_data
-			response_bytes = response_obj.to_bytes()
-			client_socket.sendall(response_bytes)
-			return
+		# keep-alive: 1接続で複数のリクエストを順番に処理する
+		# パイプラインで先に届いた分はreaderのバッファに残り、次のget_requestで使われる
+		reader = RequestReader(client_socket)
+		if accepted is not None:
+			# 1件目の期限はacceptした時から数える(poolモードではキューで待った時間も含める)
+			reader.budget.begin -= time.perf_counter() - accepted
+		for served in range(config.MAX_KEEPALIVE_REQUESTS):
+			# 2件目以降はアイドルタイムアウトで次のリクエストを待つ
+			if served and not reader.pending():
+				client_socket.settimeout(config.KEEPALIVE_TIMEOUT)
+				try:
+					received = reader.fill()
+				except socket.timeout:
+					logging.debug(f'handle_client: keep-alive idle timeout id={client_id}')
+					return
+				if not received:	# クライアントが接続を閉じた
+					return
+			if served:
+				reader.budget.restart()		# 次のリクエストの期限は最初のバイトから数える
 
-		# パスがstatic_dirになければハンドラーを探す
-		for pattern, handler in routes:
-			matched = pattern.match(request_obj.path)
-			if matched:
-				kwargs = matched.groupdict()
-				kwargs['request_obj'] = request_obj	# Requestを使うハンドラーのために辞書に追加
-				response_obj = handler(**kwargs)
-				response_bytes = response_obj.to_bytes()
-				client_socket.sendall(response_bytes)
-				return
+			# get_request関数でリクエスト情報を保存
+			# (ヘッダーの期限・ボディの転送速度を下回るとsocket.timeoutで408)
+			request_obj = Request()
+			if get_request(client_socket, request_obj, reader) == -1:
+				logging.error('get_request/handle_client: returned error')
+				raise ValueError
+			client_socket.settimeout(config.TIMEOUT_INT)	# 送信のタイムアウトは受信の期限と別にする
+
+			# リクエスト情報を出力
+			print_request(request_obj)
+
+			# 上限に達したら最後のレスポンスで接続を閉じる
+			keep_alive = wants_keep_alive(request_obj) and served < config.MAX_KEEPALIVE_REQUESTS - 1 and not draining
+
+			# router → static_search → 404 の順でレスポンスを決定
+			response_obj = dispatch(request_obj)
+			keep_alive = set_connection_header(response_obj, keep_alive)
+			response_obj.send(client_socket)	# FileResponseならsendfileで送る
+			finish_request(request_obj, response_obj, client_address)
+			request_obj.close()		# アップロードの一時ファイルを削除
 
-		# ハンドラーも見つからなければ404処理
-		response_obj = handle_404()
-		response_bytes = response_obj.to_bytes()
-		client_socket.sendall(response_bytes)
-		return
+			if not keep_alive:
+				return
 
 	except ValueError as e:
 		logging.exception(f'ValueError handle_client:')
 
-		# 400 Bad Request
-		response_obj = handle_400()
-		response_bytes = response_obj.to_bytes()
-		client_socket.sendall(response_bytes)
+		# 400 Bad Request(上限を超えたものは413 / 414 / 431)
+		response_obj = handle_rejected(request_obj.error if request_obj else None)
+		response_obj.send(client_socket)
+		if request_obj:
+			finish_request(request_obj, response_obj, client_address)
 	except socket.timeout:
 		logging.warning('handle_client: Client timeout', exc_info=True)
 
 		# 408 Request Timeout
 		response_obj = handle_408()
-		response_bytes = response_obj.to_bytes()
-		client_socket.sendall(response_bytes)
+		response_obj.send(client_socket)
+		if request_obj:
+			finish_request(request_obj, response_obj, client_address)
 	except ConnectionError as e:
 		logging.exception('handle_client: Client connection error')
 	except Exception as e:
@@ -101,38 +147,169 @@ def	handle_client(client_socket, client_address):
 
 		# 500 Internal Error
 		response_obj = handle_500()
-		response_bytes = response_obj.to_bytes()
-		client_socket.sendall(response_bytes)
+		response_obj.send(client_socket)
+		if request_obj:
+			finish_request(request_obj, response_obj, client_address)
 	finally:
 		client_socket.close()
+		connection_limiter.release(client_address[0])
+		with lock:
+			active_clients -= 1
+
+# 断る接続に送る503(TLSではハンドシェイクの前に平文は送れないので、何も送らずに閉じる)
+def	rejected_response() -> bytes:
+	if tls_context is not None:
+		return b''
+	return handle_503(config.RETRY_AFTER).to_bytes()
+
+# 同じIPアドレスからの接続が多すぎる時は、スレッドを作らずに503で断る
+def	accept_limited(client_socket, client_address, rejected_bytes) -> bool:
+	if connection_limiter.acquire(client_address[0]):
+		return True
+	logging.warning(f'accept_limited: too many connections from {client_address[0]}, 503')
+	shed(client_socket, rejected_bytes)
+	return False
+
+# スレッドやキューに渡す前に処理中の接続として数える
+# (スレッドの中で数えると、受付をやめた直後のwait_drainedが、まだ数えていない接続を見落として0で終わる)
+def	accept_client():
+	global active_clients
+	with lock:
+		active_clients += 1
+
+def	reject_client():
+	global active_clients
+	with lock:
+		active_clients -= 1
+
+
+# 古いプロセスから受け継いだソケットがあればそれを使う
+def	listen(host, port, backlog) -> socket.socket:
+	server_socket = inherited_listener() or create_listener(host, port, backlog)
+	server_socket.settimeout(ACCEPT_POLL)
+	return server_socket
+
+# SIGHUPで設定を読み直し、SIGUSR2で新しいプロセスへ受付を引き継ぐ
+def	install_signals(handoff):
+	signal.signal(signal.SIGHUP, lambda signum, frame: config.load_config(reload=True))
+	signal.signal(signal.SIGUSR2, handoff.request)
+
+# 新しいプロセスへ受付を引き継ぐまで、acceptした接続をon_acceptに渡す
+def	accept_loop(server_socket, handoff, on_accept):
+	notify_ready()
+	while not handoff.poll(server_socket):
+		try:
+			client_socket, client_address = server_socket.accept()
+		except (socket.timeout, BlockingIOError):
+			continue		# 引き継ぎ中に新しいプロセスが先に受け付けた場合もここ
+		on_accept(client_socket, client_address)
 
+# 受付をやめた後、処理中の接続が終わるまで待つ(最長DRAIN_TIMEOUT)
+# pending: 残っている接続の数を返す関数
+def	wait_drained(pending):
+	global draining
+	draining = True
+	logging.info('wait_drained: draining')
+	deadline = time.monotonic() + config.DRAIN_TIMEOUT
+	while pending() and time.monotonic() < deadline:
+		time.sleep(0.1)
+	if pending():
+		logging.error(f'wait_drained: {pending()} connections did not finish')
 
-def	run_server(host=config.LOCAL_HOST, port=config.PORT):
-	server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-	server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-	server_socket.bind((host, port))
-	server_socket.listen(5)
+def	run_server(host=config.LOCAL_HOST, port=config.PORT, backlog=config.BACKLOG):
+	server_socket = listen(host, port, backlog)
 	logging.info('')
 	logging.info(f'Server Listening {host}:{port}')
-	logging.info('routes:')
-	for pattern, handler in routes:
-		logging.info(f'\t{pattern.pattern:<30}:{handler.__name__:>10}')
+	log_routes()
+	rejected_bytes = rejected_response()
+	handoff = Handoff()
+	install_signals(handoff)
 
+	def	on_accept(client_socket, client_address):
+		if not accept_limited(client_socket, client_address, rejected_bytes):
+			return
+		client_thread = threading.Thread(
+			target=handle_client,
+			args=(client_socket, client_address, time.perf_counter()),
+			daemon=True
+		)
+		accept_client()
+		client_thread.start()
 
 	try:
-		while True:
-			client_socket, client_address = server_socket.accept()
-			client_thread = threading.Thread(
-				target=handle_client,
-				args=(client_socket, client_address),
-				daemon=True
-			)
-			client_thread.start()
+		accept_loop(server_socket, handoff, on_accept)
+		server_socket.close()
+		wait_drained(lambda: active_clients)
+	except KeyboardInterrupt:
+		logging.info('Server closing')
+	finally:
+		server_socket.close()
+		logging.info(f'static cache: {static_cache.stats()}')
+		logging.info(f'response cache: {response_cache.stats()}')
+		logging.info('Server closed')
+
+def	run_pool_server(host=config.LOCAL_HOST, port=config.PORT, backlog=config.BACKLOG):
+	server_socket = listen(host, port, backlog)
+	logging.info('')
+	logging.info(f'Pool Server Listening {host}:{port} workers={config.POOL_WORKERS} queue={config.POOL_QUEUE}')
+	log_routes()
+
+	pool = WorkerPool(handle_client, config.POOL_WORKERS, config.POOL_QUEUE)
+	pool.start()
+	metrics.register('worker_pool', pool.stats)
+	rejected_bytes = rejected_response()	# 過負荷時に作り直さないよう先に用意
+	handoff = Handoff()
+	install_signals(handoff)
+
+	def	on_accept(client_socket, client_address):
+		if not accept_limited(client_socket, client_address, rejected_bytes):
+			return
+		accept_client()
+		if not pool.submit(client_socket, client_address):
+			reject_client()
+			logging.warning('run_pool_server: queue is full, 503')
+			shed(client_socket, rejected_bytes)
+			connection_limiter.release(client_address[0])
+
+	try:
+		accept_loop(server_socket, handoff, on_accept)
+		server_socket.close()
+		wait_drained(pool.pending)		# キューで待っている接続も処理してから終わる
 	except KeyboardInterrupt:
 		logging.info('Server closing')
 	finally:
 		server_socket.close()
+		logging.info(f'worker pool: {pool.stats()}')
+		logging.info(f'static cache: {static_cache.stats()}')
+		logging.info(f'response cache: {response_cache.stats()}')
 		logging.info('Server closed')
 
+def	main():
+	# 使い方: 09_ex29.py [thread|event|pool|async|prefork] [port] [preforkのワーカー数]
+	mode = sys.argv[1] if 1 < len(sys.argv) else config.SERVER_MODE
+	port = int(sys.argv[2]) if 2 < len(sys.argv) else config.PORT
+	workers = int(sys.argv[3]) if 3 < len(sys.argv) else None
+
+	global tls_context
+	tls_context = create_context()
+	if tls_context is not None and mode in ('event', 'prefork'):
+		print(f'TLS is not supported in {mode} mode (thread|pool|async)', file=sys.stderr)
+		return 1
+
+	if mode == 'thread':
+		run_server(port=port)
+	elif mode == 'event':
+		run_event_server(port=port)
+	elif mode == 'pool':
+		run_pool_server(port=port)
+	elif mode == 'async':
+		run_async_server(port=port, ssl_context=tls_context)
+	elif mode == 'prefork':
+		run_prefork_server(port=port, workers=workers)
+	else:
+		print(f'Unknown mode: {mode} (thread|event|pool|async|prefork)', file=sys.stderr)
+		return 1
+	return 0
+
 if __name__ == '__main__':
-	run_server()
+	sys.exit(main())
@@ -0,0 +1,313 @@
+import time
+import signal
+import asyncio
+import logging
+
+import config
+from http import Request, MultipartParser, has_body, parse_header, parse_body, print_request, wants_keep_alive
+from route import log_routes, set_connection_header, response_cache, FileResponse
+from error import handle_408, handle_500, handle_503, handle_rejected
+from dispatch import dispatch_async
+from static_cache import static_cache
+from metrics import finish_request
+from serialize import HeaderError
+from limits import LimitExceeded, RequestBudget, connection_limiter
+from restart import inherited_listener, notify_ready, spawn_successor
+from tls import tls_stats
+
+"""
+	asyncioによるサーバー
+	async_server.py:
+		- read_request関数
+		- send_response関数
+		- handle_connection関数(接続ごとのコルーチン)
+		- run_async_server関数
+
+	asyncio.start_serverのStreamReader / StreamWriterで1接続を1コルーチンとして書く
+	event_serverと同じく1スレッドで多重化するが、状態機械を手で書かずに済む
+	リクエストの解釈は http.py の parse_header / parse_body、
+	レスポンスの決定は dispatch.py の dispatch_async を他のモードと共有する
+
+	タイムアウトは接続ごとにasyncio.timeout_atで掛けるので、遅いクライアントがいてもスレッドは増えない
+		- keep-aliveで次のリクエストの最初の1バイトを待つ間: KEEPALIVE_TIMEOUTで静かに閉じる
+		- リクエストの読み込み: limits.RequestBudgetの期限(1件目は接続から)を過ぎたら408
+		  ボディは受信するたびに期限を延ばし直す
+	同じIPアドレスからの接続がMAX_CONNECTIONS_PER_IPを超えたら503で閉じる
+	ssl_contextを渡すとTLSで受け付ける(ハンドシェイクはHEADER_TIMEOUTまで、asyncioが接続ごとに行う)
+
+	SIGHUPで設定を読み直し、SIGUSR2で新しいプロセスへ受付を引き継いだら、
+	処理中の接続が終わるまで(最長DRAIN_TIMEOUT)待ってから終了する
+"""
+
+STREAM_CHUNK = 64 * 1024	# multipartをパーサーへ渡す単位
+
+active_connections = 0		# 処理中の接続数(受付をやめた後、これが0になるまで待つ)
+draining = False			# 受付をやめた後は、処理中のリクエストを最後にkeep-aliveを切る
+
+# ボディを少しずつ受信し、受信するたびに期限を延ばす(MIN_BODY_RATEより遅いと期限が来て408)
+# timeout: read_requestを囲むasyncio.timeout_atのコンテキスト
+async def	read_body(reader, length: int, budget: RequestBudget, timeout) -> bytearray:
+	body = bytearray()
+	while len(body) < length:
+		chunk = await reader.read(min(length - len(body), STREAM_CHUNK))
+		if not chunk:
+			raise asyncio.IncompleteReadError(bytes(body), length)
+		body += chunk
+		budget.add(len(chunk))
+		timeout.reschedule(time.monotonic() + budget.remaining())
+	return body
+
+# Transfer-Encoding: chunked のボディを復元する
+async def	read_chunked(reader, budget: RequestBudget, timeout) -> bytearray:
+	body = bytearray()
+	while True:
+		line = await reader.readuntil(b'\r\n')
+		size = int(line.split(b';')[0].strip(), 16)	# 不正な値はValueError
+		if size == 0:
+			break
+		if config.MAX_READ < len(body) + size:
+			raise LimitExceeded(413, 'read_chunked: body is too long')
+		chunk = await read_body(reader, size + 2, budget, timeout)	# データ + \r\n
+		body += memoryview(chunk)[:size]
+
+	# トレーラーを空行まで読み飛ばす
+	while await reader.readuntil(b'\r\n') != b'\r\n':
+		pass
+	return body
+
+# first: 待ち受け中に受信した最初の1バイト
+# 途中で切断されたらasyncio.IncompleteReadError(EOFError)、上限を超えたらLimitExceeded
+async def	read_request(reader, request_obj: Request, first: bytes, budget: RequestBudget, timeout) -> int:
+	try:
+		headers = first + await reader.readuntil(b'\r\n\r\n')
+	except asyncio.LimitOverrunError:
+		raise LimitExceeded(431, 'read_request: Request header is too long')
+
+	# ヘッダーをパース(他のモードと共通)
+	result = parse_header(headers[:-4], request_obj)
+	request_obj.timer.mark('header')
+	if result == -1:
+		return -1
+
+	# GETメソッド・ボディのないリクエストならここで終了
+	if request_obj.method == 'GET' or not has_body(request_obj):
+		return 0
+	budget.start_body()
+	timeout.reschedule(time.monotonic() + budget.remaining())
+
+	# multipart/form-dataは届いた分からパーサーへ渡し、ボディ全体をメモリに持たない
+	if request_obj.type == 'multipart/form-data;' and not request_obj.chunked:
+		parser = MultipartParser(request_obj.boundary)
+		remaining = int(request_obj.length)
+		try:
+			while remaining:
+				chunk = await reader.read(min(remaining, STREAM_CHUNK))
+				if not chunk:
+					raise asyncio.IncompleteReadError(b'', remaining)
+				parser.feed(chunk)
+				remaining -= len(chunk)
+				budget.add(len(chunk))
+				timeout.reschedule(time.monotonic() + budget.remaining())
+		except ValueError:
+			logging.exception('read_request: Invalid multipart body')
+			parser.close()
+			return -1
+		except BaseException:
+			parser.close()		# 一時ファイルを残さない
+			raise
+		if not parser.close():
+			logging.error('read_request: multipart body is not terminated')
+			return -1
+		request_obj.body = parser.parts
+		request_obj.timer.mark('body')
+		return 0
+
+	try:
+		if request_obj.chunked:
+			body_part = await read_chunked(reader, budget, timeout)
+			request_obj.length = str(len(body_part))
+		else:
+			body_part = await read_body(reader, int(request_obj.length), budget, timeout)
+	except (ValueError, asyncio.LimitOverrunError):
+		logging.error('read_request: Invalid chunked body')
+		return -1
+
+	try:
+		return parse_body(body_part, request_obj)
+	except ValueError:
+		logging.exception('read_request: Invalid request body')
+		return -1
+	finally:
+		request_obj.timer.mark('body')
+
+# FileResponseのボディはloop.sendfile(Linuxではos.sendfile)で送る
+# それ以外はframesの単位で書き込み、ストリーミングのボディは送れた分だけ次を作る
+async def	send_response(writer, response_obj):
+	if not isinstance(response_obj, FileResponse):
+		for frame in response_obj.frames():
+			writer.writelines(frame)
+			await writer.drain()
+		return
+
+	writer.write(response_obj.head_bytes())
+	loop = asyncio.get_running_loop()
+	with open(response_obj.file_path, 'rb') as file:
+		for segment in response_obj.segments:
+			if isinstance(segment, tuple):
+				offset, count = segment
+				await loop.sendfile(writer.transport, file, offset, count)
+			else:
+				writer.write(segment)
+	await writer.drain()
+
+async def	handle_connection(reader, writer):
+	global active_connections
+	client_address = writer.get_extra_info('peername')
+	ssl_object = writer.get_extra_info('ssl_object')
+	if ssl_object is not None:
+		tls_stats.record(ssl_object)		# ハンドシェイクはstart_serverが済ませてから呼ぶ
+	logging.debug(f'handle_connection: Connection detected {client_address[0]}:{client_address[1]}')
+	if not connection_limiter.acquire(client_address[0]):
+		logging.warning(f'handle_connection: too many connections from {client_address[0]}, 503')
+		writer.write(handle_503(config.RETRY_AFTER).to_bytes())
+		writer.close()
+		return
+
+	request_obj = Request()
+	budget = RequestBudget()		# 1件目は接続した時から数える
+	served = 0
+	active_connections += 1
+	try:
+		while True:
+			# 次のリクエストの最初の1バイトを待つ
+			try:
+				if served:
+					async with asyncio.timeout(config.KEEPALIVE_TIMEOUT):
+						first = await reader.readexactly(1)
+					budget.restart()
+				else:
+					async with asyncio.timeout_at(budget.deadline()):
+						first = await reader.readexactly(1)
+			except TimeoutError:
+				if served:
+					logging.debug('handle_connection: keep-alive idle timeout')
+				else:
+					logging.warning('handle_connection: Client timeout')
+					await send_response(writer, handle_408())
+				return
+			except asyncio.IncompleteReadError:
+				return		# クライアントが閉じた
+
+			request_obj = Request()
+			try:
+				async with asyncio.timeout_at(budget.deadline()) as timeout:
+					result = await read_request(reader, request_obj, first, budget, timeout)
+			except TimeoutError:
+				logging.warning('handle_connection: Client timeout')
+				response_obj = handle_408()
+				await send_response(writer, response_obj)
+				finish_request(request_obj, response_obj, client_address)
+				return
+			except LimitExceeded as e:
+				logging.error(f'handle_connection: {e}')
+				request_obj.error = e.status
+				result = -1
+			if result == -1:
+				logging.error('read_request/handle_connection: returned error')
+				response_obj = handle_rejected(request_obj.error)
+				await send_response(writer, response_obj)
+				finish_request(request_obj, response_obj, client_address)
+				return
+			served += 1
+			keep_alive = wants_keep_alive(request_obj) and served < config.MAX_KEEPALIVE_REQUESTS and not draining
+			try:
+				print_request(request_obj)
+				response_obj = await dispatch_async(request_obj)
+				keep_alive = set_connection_header(response_obj, keep_alive)
+			except Exception:
+				logging.exception('Exception handle_connection:')
+				keep_alive = False
+				response_obj = handle_500()
+			try:
+				await send_response(writer, response_obj)
+			except HeaderError:
+				# ヘッダーは何も書き込む前に作るので、まだ500を返せる
+				logging.exception('handle_connection: Invalid response header')
+				keep_alive = False
+				response_obj = handle_500()
+				await send_response(writer, response_obj)
+			finish_request(request_obj, response_obj, client_address)
+			request_obj.close()		# アップロードの一時ファイルを削除
+			if not keep_alive:
+				return
+	except (ConnectionError, asyncio.IncompleteReadError):
+		logging.exception('handle_connection: Client connection error')
+	finally:
+		active_connections -= 1
+		connection_limiter.release(client_address[0])
+		request_obj.close()
+		writer.close()
+		try:
+			await writer.wait_closed()
+		except (ConnectionError, OSError):
+			pass
+
+# ssl_context: TLSを話す時のSSLContext(ハンドシェイクはasyncioが接続ごとに非同期で行う)
+async def	serve(host, port, backlog, ssl_context=None):
+	global draining
+	# limit: readuntilでバッファできる上限(ヘッダーの長さの上限、超えたら431)
+	options = {'backlog': backlog, 'limit': config.MAX_HEADER_SIZE}
+	if ssl_context is not None:
+		options.update(ssl=ssl_context, ssl_handshake_timeout=config.HEADER_TIMEOUT)
+	server_socket = inherited_listener()
+	if server_socket is not None:
+		server = await asyncio.start_server(handle_connection, sock=server_socket, **options)
+	else:
+		server = await asyncio.start_server(handle_connection, host, port, reuse_address=True, **options)
+	logging.info('')
+	logging.info(f'Async Server Listening {host}:{port}')
+	log_routes()
+
+	loop = asyncio.get_running_loop()
+	handed_off = asyncio.Event()
+	spawning = None		# 新しいプロセスを起動しているタスク
+
+	# 新しいプロセスの起動と準備の待ち合わせはブロックするので、別スレッドで行う
+	async def	handoff():
+		nonlocal spawning
+		try:
+			if await asyncio.to_thread(spawn_successor, server.sockets[0]):
+				handed_off.set()
+		finally:
+			spawning = None
+
+	def	request_handoff():
+		nonlocal spawning
+		if spawning is None and not handed_off.is_set():
+			spawning = loop.create_task(handoff())
+
+	loop.add_signal_handler(signal.SIGHUP, config.load_config, True)
+	loop.add_signal_handler(signal.SIGUSR2, request_handoff)
+	notify_ready()
+
+	async with server:
+		await handed_off.wait()
+		# 新しいプロセスが受付を始めたので、受付をやめて処理中の接続を待つ
+		logging.info('serve: draining')
+		draining = True
+		server.close()
+		deadline = time.monotonic() + config.DRAIN_TIMEOUT
+		while active_connections and time.monotonic() < deadline:
+			await asyncio.sleep(0.1)
+		if active_connections:
+			logging.error(f'serve: {active_connections} connections did not finish')
+
+def	run_async_server(host=config.LOCAL_HOST, port=config.PORT, backlog=config.BACKLOG, ssl_context=None):
+	try:
+		asyncio.run(serve(host, port, backlog, ssl_context))
+	except KeyboardInterrupt:
+		logging.info('Server closing')
+	finally:
+		logging.info(f'static cache: {static_cache.stats()}')
+		logging.info(f'response cache: {response_cache.stats()}')
+		logging.info('Server closed')
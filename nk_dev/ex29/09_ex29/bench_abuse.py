@@ -0,0 +1,217 @@
+#!/usr/bin/env python3
+
+import sys
+import time
+import socket
+import select
+import threading
+
+import config
+from bench_common import HOST, start_server, stop_server, percentile
+from bench_overload import PORT
+
+"""
+	遅い・行儀の悪いクライアントへの耐性の確認
+
+	使い方: bench_abuse.py [モード,...] [秒数]
+		例) bench_abuse.py thread,event,async 5
+
+	モードごとにサーバーを子プロセスで起動し、
+		1. 行儀のよいクライアント(127.0.0.1から /about を1件ずつ)だけで[秒数]の間レイテンシを測る
+		2. 下の攻撃を同時に始め、その間も行儀のよいクライアントのレイテンシを測る
+			slowloris	- ヘッダーを1秒に1バイトずつ送り続ける(127.0.0.2〜3から計SLOWLORIS本)
+			slow body	- ボディを1秒に10バイトずつ送る(127.0.0.4からSLOW_BODY本)
+			oversized	- 大きすぎるヘッダー・ヘッダーの数・URL・Content-Length(127.0.0.5から)
+			flood		- 何も送らない接続を1つのIPアドレスから大量に張る(127.0.0.6からFLOOD本)
+	攻撃ごとに、サーバーが返したステータス(閉じられただけなら closed)と、切られるまでの秒数を表示し、
+	期待どおりか(408 / 413 / 414 / 431 / 503)と、行儀のよいクライアントのp99が悪化していないかを判定する
+
+	送信元のアドレスを変えるため、127.0.0.0/8がループバックに向いている環境(Linux)で動かすこと
+
+	poolモードは省略時には含めない: 遅いクライアントもHEADER_TIMEOUTで切られるが、
+	それまでの間はワーカーを占有し続けるので、POOL_WORKERS本を超える攻撃で行儀のよいクライアントも503になる
+"""
+
+SLOWLORIS = 100
+SLOW_BODY = 20
+FLOOD = config.MAX_CONNECTIONS_PER_IP + 36
+GIVE_UP = config.HEADER_TIMEOUT + config.BODY_GRACE + 10.0	# これを過ぎても切られなければ失敗
+P99_SLACK_MS = 5.0		# 攻撃中のp99は、平常時の2倍かこの値を足したもののどちらか大きい方まで許す
+
+def	connect(source: str) -> socket.socket:
+	sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+	sock.bind((source, 0))
+	sock.connect((HOST, PORT))
+	return sock
+
+# レスポンスのステータス、読めなければ'closed'
+def	read_status(sock, timeout) -> str:
+	sock.settimeout(timeout)
+	try:
+		data = sock.recv(65536)
+	except socket.timeout:
+		return 'open'
+	except OSError:
+		return 'closed'
+	if data.startswith(b'HTTP/'):
+		return data[9:12].decode('ascii')
+	return 'closed'
+
+# pieceを1つずつinterval秒おきに送り、その間にサーバーが応答・切断したらそのステータスを返す
+def	trickle(sock, pieces, interval) -> str:
+	for piece in pieces:
+		readable, _, _ = select.select([sock], [], [], interval)
+		if readable:
+			return read_status(sock, 1.0)
+		try:
+			sock.sendall(piece)
+		except OSError:
+			return read_status(sock, 1.0)
+	return read_status(sock, GIVE_UP)
+
+def	slowloris(source):
+	sock = connect(source)
+	request_line = b'GET /about HTTP/1.1\r\nHost: a\r\nX-Slow: '
+	pieces = [request_line] + [b'a'] * int(GIVE_UP)
+	try:
+		return trickle(sock, pieces, 1.0)
+	finally:
+		sock.close()
+
+def	slow_body(source):
+	sock = connect(source)
+	header = b'POST /x HTTP/1.1\r\nHost: a\r\nContent-Type: application/x-www-form-urlencoded\r\nContent-Length: 100000\r\n\r\n'
+	pieces = [header] + [b'a=aaaaaaaa'] * int(GIVE_UP)
+	try:
+		return trickle(sock, pieces, 1.0)
+	finally:
+		sock.close()
+
+def	oversized(kind):
+	def	attack(source):
+		if kind == 'header size':
+			request = b'GET / HTTP/1.1\r\nX-Big: ' + b'a' * (config.MAX_HEADER_SIZE + 1024) + b'\r\n\r\n'
+		elif kind == 'header count':
+			request = b'GET / HTTP/1.1\r\n' + b''.join(f'X-{n}: a\r\n'.encode() for n in range(config.MAX_HEADER_COUNT + 10)) + b'\r\n'
+		elif kind == 'url':
+			request = b'GET /' + b'a' * (config.MAX_URL_LENGTH + 10) + b' HTTP/1.1\r\n\r\n'
+		else:
+			request = (
+				b'POST /x HTTP/1.1\r\nContent-Type: application/x-www-form-urlencoded\r\n'
+				+ f'Content-Length: {config.MAX_READ + 1}\r\n\r\n'.encode()
+			)
+		sock = connect(source)
+		try:
+			sock.sendall(request)
+			return read_status(sock, 5.0)
+		except OSError:
+			return 'closed'
+		finally:
+			sock.close()
+	return attack
+
+def	idle(source):
+	sock = connect(source)
+	try:
+		return read_status(sock, GIVE_UP)
+	finally:
+		sock.close()
+
+# (名前, 関数, 送信元, 本数, 期待するステータス)
+ATTACKS = (
+	('slowloris', slowloris, ('127.0.0.2', '127.0.0.3'), SLOWLORIS, {'408'}),
+	('slow body', slow_body, ('127.0.0.4',), SLOW_BODY, {'408'}),
+	('header size', oversized('header size'), ('127.0.0.5',), 1, {'431'}),
+	('header count', oversized('header count'), ('127.0.0.5',), 1, {'431'}),
+	('url', oversized('url'), ('127.0.0.5',), 1, {'414'}),
+	('content-length', oversized('content-length'), ('127.0.0.5',), 1, {'413'}),
+	('flood', idle, ('127.0.0.6',), FLOOD, {'408', '503'})
+)
+
+def	run_attack(attack, source, results):
+	begin = time.monotonic()
+	try:
+		status = attack(source)
+	except OSError as e:
+		status = type(e).__name__
+	results.append((status, time.monotonic() - begin))
+
+# 行儀のよいクライアント: duration秒の間、1件ずつGETしてレイテンシ(秒)を集める
+def	well_behaved(duration, latencies, errors):
+	request = f'GET /about HTTP/1.1\r\nHost: {HOST}\r\nConnection: close\r\n\r\n'.encode('ascii')
+	end = time.monotonic() + duration
+	while time.monotonic() < end:
+		begin = time.perf_counter()
+		try:
+			with socket.create_connection((HOST, PORT), timeout=10.0) as sock:
+				sock.sendall(request)
+				data = b''
+				while chunk := sock.recv(65536):
+					data += chunk
+		except OSError:
+			errors.append(1)
+			continue
+		if data.startswith(b'HTTP/1.1 200'):
+			latencies.append(time.perf_counter() - begin)
+		else:
+			errors.append(1)
+		time.sleep(0.01)
+
+def	run_mode(mode, duration) -> bool:
+	proc = start_server(mode, PORT)
+	ok = True
+	try:
+		base, base_errors = [], []
+		well_behaved(duration, base, base_errors)
+
+		threads = []
+		results = {}
+		for name, attack, sources, count, _ in ATTACKS:
+			results[name] = []
+			for n in range(count):
+				thread = threading.Thread(target=run_attack, args=(attack, sources[n % len(sources)], results[name]), daemon=True)
+				thread.start()
+				threads.append(thread)
+		time.sleep(0.5)		# 攻撃の接続が揃ってから測る
+		attacked, attacked_errors = [], []
+		well_behaved(duration, attacked, attacked_errors)
+		for thread in threads:
+			thread.join()
+	finally:
+		stop_server(proc)
+
+	print(f'--- {mode}')
+	for name, _, _, count, expected in ATTACKS:
+		statuses = {}
+		for status, _ in results[name]:
+			statuses[status] = statuses.get(status, 0) + 1
+		seconds = [elapsed for _, elapsed in results[name]]
+		good = all(status in expected for status, _ in results[name])
+		ok = ok and good
+		summary = ', '.join(f'{status} x{n}' for status, n in sorted(statuses.items()))
+		print(f'{name:<16}{count:>5}  {summary:<22}cut after {percentile(seconds, 50):5.1f}s (max {max(seconds):5.1f}s)  {"ok" if good else "UNEXPECTED"}')
+
+	base_p99 = percentile(base, 99) * 1000
+	attacked_p99 = percentile(attacked, 99) * 1000
+	allowed = max(base_p99 * 2, base_p99 + P99_SLACK_MS)
+	good = attacked_p99 <= allowed and not attacked_errors
+	ok = ok and good
+	print(
+		f'well-behaved    base: {len(base)} req p50 {percentile(base, 50) * 1000:.1f} ms p99 {base_p99:.1f} ms errors {len(base_errors)}'
+		f' | under attack: {len(attacked)} req p50 {percentile(attacked, 50) * 1000:.1f} ms p99 {attacked_p99:.1f} ms'
+		f' errors {len(attacked_errors)}  {"ok" if good else "DEGRADED"}'
+	)
+	return ok
+
+def	main():
+	modes = sys.argv[1].split(',') if 1 < len(sys.argv) else ['thread', 'event', 'async']
+	duration = float(sys.argv[2]) if 2 < len(sys.argv) else 5.0
+	print(
+		f'HEADER_TIMEOUT={config.HEADER_TIMEOUT}s BODY_GRACE={config.BODY_GRACE}s MIN_BODY_RATE={config.MIN_BODY_RATE}B/s'
+		f' MAX_CONNECTIONS_PER_IP={config.MAX_CONNECTIONS_PER_IP}'
+	)
+	results = [run_mode(mode, duration) for mode in modes]
+	return 0 if all(results) else 1
+
+if __name__ == '__main__':
+	sys.exit(main())
@@ -0,0 +1,82 @@
+#!/usr/bin/env python3
+
+import sys
+import time
+import socket
+
+from bench_common import HOST, start_server, stop_server
+from bench_overload import run_load, PORT
+
+"""
+	遅いクライアントを抱えた時の thread / event / async モードの比較
+
+	使い方: bench_async.py [保持する接続数,...] [秒数] [パス]
+		例) bench_async.py 100,1000,5000 5 /about
+
+	各モードのサーバーを子プロセスで起動し、
+		1. リクエストラインだけを送って止まる接続を指定数だけ張る(TIMEOUT_INTまでは切られない)
+		2. その状態でのサーバーのRSS・スレッド数を /proc から読む
+		3. 並列32のクローズドループで req/s と p99 を測る
+		4. 保持していた接続の残りを送り、200が返った数を数える
+	を比較する
+
+	接続数が多い時は ulimit -n を十分に上げておくこと
+"""
+
+def	read_status(pid) -> dict:
+	status = {}
+	with open(f'/proc/{pid}/status') as file:
+		for line in file:
+			label, _, value = line.partition(':')
+			status[label] = value.strip()
+	return status
+
+def	hold_connections(count) -> list:
+	held = []
+	for _ in range(count):
+		sock = socket.create_connection((HOST, PORT))
+		sock.sendall(b'GET /about HTTP/1.1\r\n')
+		held.append(sock)
+	return held
+
+# 残りのヘッダーを送り、200が返った接続の数を返す
+def	release_connections(held) -> int:
+	for sock in held:
+		sock.sendall(b'Host: bench\r\nConnection: close\r\n\r\n')
+	ok = 0
+	for sock in held:
+		sock.settimeout(10.0)
+		try:
+			if sock.recv(12).startswith(b'HTTP/1.1 200'):
+				ok += 1
+		except OSError:
+			pass
+		sock.close()
+	return ok
+
+def	main():
+	counts = [int(n) for n in sys.argv[1].split(',')] if 1 < len(sys.argv) else [100, 1000, 5000]
+	duration = float(sys.argv[2]) if 2 < len(sys.argv) else 5.0
+	path = sys.argv[3] if 3 < len(sys.argv) else '/about'
+
+	print(f'{"mode":<8}{"held":>7}{"RSS MB":>9}{"threads":>9}{"req/s":>8}{"p99 ms":>9}{"held 200":>10}')
+	for count in counts:
+		for mode in ('thread', 'event', 'async'):
+			proc = start_server(mode, PORT)
+			try:
+				held = hold_connections(count)
+				time.sleep(1)		# acceptし終わるのを待つ
+				status = read_status(proc.pid)
+				result = run_load(path, duration)
+				ok = release_connections(held)
+			finally:
+				stop_server(proc)
+			print(
+				f'{mode:<8}{count:>7}{int(status["VmRSS"].split()[0]) / 1024:>9.1f}{status["Threads"]:>9}'
+				f'{result["throughput"]:>8.0f}{result["p99"]:>9.1f}{ok:>10}'
+			)
+			time.sleep(1)	# TIME_WAITのポートが減るのを待つ
+	return 0
+
+if __name__ == '__main__':
+	sys.exit(main())
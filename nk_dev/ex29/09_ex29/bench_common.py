@@ -0,0 +1,92 @@
+import sys
+import time
+import socket
+import subprocess
+from pathlib import Path
+
+"""
+	ベンチマークの共通部分(bench_*.pyと、ex29のbench_load.py / bench_compare.pyから使う)
+	bench_common.py:
+		- launch関数(サーバーを子プロセスで起動し、接続できるまで待つ)
+		- start_server関数(09_ex29.pyをモードとポートを指定して起動する)
+		- stop_server関数
+		- percentile関数
+		- parse_head関数(ステータス行とヘッダーを分ける、bench_load.pyのasyncio版と共有)
+		- ResponseClosedクラス
+		- read_response関数(Content-Length分までレスポンスを1件読む)
+"""
+
+SERVER = Path(__file__).parent / '09_ex29.py'
+HOST = '127.0.0.1'
+START_TIMEOUT = 10.0		# 接続できるようになるまで待つ秒数
+
+# commandを起動し、portに接続できるようになったらPopenを返す(先に終了したり、間に合わなければRuntimeError)
+# output: 標準出力・標準エラーの行き先(ファイルを渡すとログを残せる)
+def	launch(command, port, cwd=None, env=None, output=subprocess.DEVNULL) -> subprocess.Popen:
+	proc = subprocess.Popen(command, cwd=cwd, env=env, stdout=output, stderr=output)
+	deadline = time.monotonic() + START_TIMEOUT
+	while time.monotonic() < deadline:
+		if proc.poll() is not None:
+			break
+		try:
+			socket.create_connection((HOST, port), timeout=0.1).close()
+			return proc
+		except OSError:
+			time.sleep(0.1)
+	proc.kill()
+	proc.wait()
+	raise RuntimeError(f'launch: {command[1:]} did not start (port {port})')
+
+# extra: ポートの後ろに渡す引数(preforkのワーカー数など)
+def	start_server(mode, port, *extra, **options) -> subprocess.Popen:
+	return launch([sys.executable, str(SERVER), mode, str(port), *extra], port, **options)
+
+def	stop_server(proc):
+	proc.terminate()
+	try:
+		proc.wait(timeout=10.0)
+	except subprocess.TimeoutExpired:
+		proc.kill()
+		proc.wait()
+
+def	percentile(values, p) -> float:
+	if not values:
+		return 0.0
+	values = sorted(values)
+	return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+# ステータス行とヘッダー(空行の前まで)のbytes → (バージョン, ステータス, ヘッダー(小文字の名前 → 値))
+def	parse_head(head) -> tuple:
+	lines = head.decode('latin-1').split('\r\n')
+	version, status = lines[0].split(' ', 2)[:2]
+	headers = {}
+	for line in lines[1:]:
+		label, _, detail = line.partition(':')
+		headers[label.strip().lower()] = detail.strip()
+	return version, int(status), headers
+
+# レスポンスを読み終える前に閉じられた(received: それまでに受け取ったバイト数)
+class ResponseClosed(ConnectionError):
+	def	__init__(self, message, received):
+		super().__init__(message)
+		self.received = received
+
+# レスポンスを1件読み、(ステータス, ヘッダー(小文字の名前 → 値), 残りのバッファ)を返す
+# buffer: 前のレスポンスの後ろに届いていた分(パイプライン)
+def	read_response(sock, buffer=b'') -> tuple:
+	while b'\r\n\r\n' not in buffer:
+		chunk = sock.recv(65536)
+		if not chunk:
+			raise ResponseClosed('read_response: closed before header end', len(buffer))
+		buffer += chunk
+
+	header_end = buffer.find(b'\r\n\r\n')
+	_, status, headers = parse_head(buffer[:header_end])
+
+	end = header_end + 4 + int(headers.get('content-length', 0))
+	while len(buffer) < end:
+		chunk = sock.recv(65536)
+		if not chunk:
+			raise ResponseClosed('read_response: closed before body end', len(buffer))
+		buffer += chunk
+	return status, headers, buffer[end:]
@@ -0,0 +1,67 @@
+#!/usr/bin/env python3
+
+import sys
+import gzip
+import time
+import mimetypes
+from pathlib import Path
+
+import config
+from compress import CODINGS, is_compressible, compress
+from route import STATIC_DIR
+
+"""
+	圧縮のCPUコストと削減できるバイト数
+
+	使い方: bench_compress.py [ファイル ...]
+		例) bench_compress.py static/*.html
+		省略時はstatic/の全ファイル
+
+	ファイルごと・圧縮形式ごとに、1回の圧縮にかかるCPU時間と圧縮後のサイズを測る
+	gzipはレベル1 / GZIP_LEVEL / 9 を比べ、brotli / zstdはモジュールが入っていれば設定のレベルで測る
+	served列は、サーバーがそのファイルをその場で圧縮するか(テキスト系かつCOMPRESS_MIN_SIZE以上)
+"""
+
+MIN_DURATION = 0.2		# 1ケースをこの秒数以上くり返して平均する
+
+def	measure(body: bytes, encode) -> tuple[float, int]:
+	count = 0
+	begin = time.process_time()
+	while True:
+		encoded = encode(body)
+		count += 1
+		elapsed = time.process_time() - begin
+		if MIN_DURATION <= elapsed:
+			return elapsed / count, len(encoded)
+
+def	encoders() -> list:
+	cases = []
+	for level in sorted({1, config.GZIP_LEVEL, 9}):
+		cases.append((f'gzip-{level}', lambda body, level=level: gzip.compress(body, compresslevel=level, mtime=0)))
+	for coding in CODINGS:
+		if coding != 'gzip':
+			cases.append((coding, lambda body, coding=coding: compress(body, coding)))
+	return cases
+
+def	main():
+	paths = [Path(arg) for arg in sys.argv[1:]] or sorted(path for path in STATIC_DIR.iterdir() if path.is_file())
+	print(f'codings available: {", ".join(CODINGS)}, COMPRESS_MIN_SIZE={config.COMPRESS_MIN_SIZE}')
+	print(f'{"file":<22}{"served":>7}{"coding":>9}{"bytes":>10}{"encoded":>10}{"saved %":>9}{"cpu us":>10}{"MB/s":>8}{"us/KB saved":>13}')
+	for path in paths:
+		body = path.read_bytes()
+		if not body:
+			continue
+		mime_type = mimetypes.guess_type(str(path))[0] or 'application/octet-stream'
+		served = 'yes' if is_compressible(mime_type) and config.COMPRESS_MIN_SIZE <= len(body) else 'no'
+		for name, encode in encoders():
+			seconds, size = measure(body, encode)
+			saved = len(body) - size
+			per_kb = seconds * 1e6 / (saved / 1024) if 0 < saved else float('inf')
+			print(
+				f'{path.name:<22}{served:>7}{name:>9}{len(body):>10}{size:>10}{saved / len(body) * 100:>9.1f}'
+				f'{seconds * 1e6:>10.0f}{len(body) / seconds / 1e6:>8.1f}{per_kb:>13.1f}'
+			)
+	return 0
+
+if __name__ == '__main__':
+	sys.exit(main())
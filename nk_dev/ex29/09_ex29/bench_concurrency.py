@@ -0,0 +1,111 @@
+#!/usr/bin/env python3
+
+import sys
+import time
+import socket
+import selectors
+
+from bench_common import HOST, start_server, stop_server, percentile
+
+"""
+	thread / event モードの同時接続ベンチマーク
+
+	使い方: bench_concurrency.py [並列数,...] [総リクエスト数] [パス]
+		例) bench_concurrency.py 1000,10000 20000 /about
+
+	各モードのサーバーを子プロセスで起動し、指定した並列数の接続を
+	selectorsで同時に張り続けて req/s と p50/p99 レイテンシを計測する
+	(1リクエスト = connect から レスポンス受信完了まで)
+
+	10k並列では ulimit -n を十分に上げておくこと
+"""
+
+PORT = 8090
+
+def	run_load(concurrency, total, path):
+	# keep-aliveだと接続が残りEOFが来ないので、1リクエストごとに閉じてもらう
+	request_bytes = f'GET {path} HTTP/1.1\r\nHost: {HOST}\r\nConnection: close\r\n\r\n'.encode('ascii')
+	selector = selectors.DefaultSelector()
+	latencies = []
+	errors = 0
+	started = 0
+	finished = 0
+
+	def	open_one():
+		nonlocal started, errors
+		sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+		sock.setblocking(False)
+		sock.connect_ex((HOST, PORT))
+		started += 1
+		# [開始時刻, 送信済みか]
+		selector.register(sock, selectors.EVENT_WRITE, [time.perf_counter(), False])
+
+	begin = time.perf_counter()
+	for _ in range(min(concurrency, total)):
+		open_one()
+
+	while finished < total:
+		events = selector.select(timeout=5.0)
+		if not events:
+			break
+		for key, mask in events:
+			sock = key.fileobj
+			state = key.data
+			done = False
+			try:
+				if not state[1]:
+					sock.sendall(request_bytes)
+					state[1] = True
+					selector.modify(sock, selectors.EVENT_READ, state)
+					continue
+				data = sock.recv(65536)
+				if not data:
+					latencies.append(time.perf_counter() - state[0])
+					done = True
+			except (BlockingIOError, InterruptedError):
+				continue
+			except OSError:
+				errors += 1
+				done = True
+
+			if done:
+				selector.unregister(sock)
+				sock.close()
+				finished += 1
+				if started < total:
+					open_one()
+
+	elapsed = time.perf_counter() - begin
+	for key in list(selector.get_map().values()):
+		key.fileobj.close()
+	selector.close()
+
+	return {
+		'ok': len(latencies),
+		'errors': errors + (total - finished),
+		'rps': len(latencies) / elapsed if elapsed else 0.0,
+		'p50': percentile(latencies, 50) * 1000,
+		'p99': percentile(latencies, 99) * 1000
+	}
+
+def	main():
+	levels = [int(n) for n in sys.argv[1].split(',')] if 1 < len(sys.argv) else [1000, 10000]
+	total = int(sys.argv[2]) if 2 < len(sys.argv) else 20000
+	path = sys.argv[3] if 3 < len(sys.argv) else '/about'
+
+	print(f'{"mode":<8}{"conc":>8}{"ok":>8}{"err":>6}{"req/s":>10}{"p50 ms":>10}{"p99 ms":>10}')
+	for mode in ('thread', 'event'):
+		proc = start_server(mode, PORT)
+		try:
+			for concurrency in levels:
+				result = run_load(concurrency, max(total, concurrency), path)
+				print(
+					f'{mode:<8}{concurrency:>8}{result["ok"]:>8}{result["errors"]:>6}'
+					f'{result["rps"]:>10.0f}{result["p50"]:>10.1f}{result["p99"]:>10.1f}'
+				)
+		finally:
+			stop_server(proc)
+	return 0
+
+if __name__ == '__main__':
+	sys.exit(main())
@@ -0,0 +1,105 @@
+#!/usr/bin/env python3
+
+import sys
+import time
+import socket
+import threading
+
+from bench_common import HOST, start_server, stop_server, read_response
+
+"""
+	keep-alive / パイプラインの負荷テスト
+
+	使い方: bench_keepalive.py [thread|event] [クライアント数] [1クライアントのリクエスト数] [パス]
+		例) bench_keepalive.py thread 20 500 /index.html
+
+	小さな静的ファイルに対して3通りの方法でリクエストし、req/s を比較する
+		close		- 1リクエストごとに接続し直す(Connection: close)
+		keep-alive	- 1接続で順番に送受信
+		pipeline	- 1接続でPIPELINE_DEPTH件まとめて送ってから受信
+"""
+
+PORT = 8092
+PIPELINE_DEPTH = 10
+
+def	client_close(path, count, result):
+	request_bytes = f'GET {path} HTTP/1.1\r\nHost: {HOST}\r\nConnection: close\r\n\r\n'.encode('ascii')
+	for _ in range(count):
+		with socket.create_connection((HOST, PORT)) as sock:
+			sock.sendall(request_bytes)
+			status, _, _ = read_response(sock)
+			result.append(status)
+
+def	client_keep_alive(path, count, result):
+	request_bytes = f'GET {path} HTTP/1.1\r\nHost: {HOST}\r\n\r\n'.encode('ascii')
+	sock = None
+	buffer = b''
+	for served in range(count):
+		if sock is None:
+			sock = socket.create_connection((HOST, PORT))
+			buffer = b''
+		sock.sendall(request_bytes)
+		status, _, buffer = read_response(sock, buffer)
+		result.append(status)
+		# サーバー側のMAX_KEEPALIVE_REQUESTSに達したら張り直す
+		if (served + 1) % 100 == 0:
+			sock.close()
+			sock = None
+	if sock:
+		sock.close()
+
+def	client_pipeline(path, count, result):
+	request_bytes = f'GET {path} HTTP/1.1\r\nHost: {HOST}\r\n\r\n'.encode('ascii')
+	sent = 0
+	while sent < count:
+		with socket.create_connection((HOST, PORT)) as sock:
+			buffer = b''
+			# 1接続でMAX_KEEPALIVE_REQUESTS(100)件まで
+			for _ in range(100 // PIPELINE_DEPTH):
+				depth = min(PIPELINE_DEPTH, count - sent)
+				if depth <= 0:
+					break
+				sock.sendall(request_bytes * depth)
+				for _ in range(depth):
+					status, _, buffer = read_response(sock, buffer)
+					result.append(status)
+				sent += depth
+
+def	run_load(client, clients, count, path):
+	result = []
+	threads = [
+		threading.Thread(target=client, args=(path, count, result), daemon=True)
+		for _ in range(clients)
+	]
+	begin = time.perf_counter()
+	for thread in threads:
+		thread.start()
+	for thread in threads:
+		thread.join()
+	elapsed = time.perf_counter() - begin
+	ok = sum(1 for status in result if status == 200)
+	return ok, len(result) - ok, ok / elapsed
+
+def	main():
+	mode = sys.argv[1] if 1 < len(sys.argv) else 'thread'
+	clients = int(sys.argv[2]) if 2 < len(sys.argv) else 20
+	count = int(sys.argv[3]) if 3 < len(sys.argv) else 500
+	path = sys.argv[4] if 4 < len(sys.argv) else '/index.html'
+
+	proc = start_server(mode, PORT)
+	try:
+		print(f'server={mode} clients={clients} requests/client={count} path={path}')
+		print(f'{"method":<12}{"ok":>8}{"err":>6}{"req/s":>10}')
+		for name, client in (
+			('close', client_close),
+			('keep-alive', client_keep_alive),
+			('pipeline', client_pipeline)
+		):
+			ok, errors, rps = run_load(client, clients, count, path)
+			print(f'{name:<12}{ok:>8}{errors:>6}{rps:>10.0f}')
+	finally:
+		stop_server(proc)
+	return 0
+
+if __name__ == '__main__':
+	sys.exit(main())
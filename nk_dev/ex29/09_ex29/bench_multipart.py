@@ -0,0 +1,123 @@
+#!/usr/bin/env python3
+
+import re
+import sys
+import time
+import socket
+import logging
+import resource
+import threading
+import subprocess
+
+from http import Request, RequestReader, get_request
+
+"""
+	multipart/form-dataアップロードのピークRSSベンチマーク
+
+	使い方: bench_multipart.py [サイズMB,...]
+		例) bench_multipart.py 10,100,500
+
+	ケースごとに子プロセスを起動し、socketpairへ送ったアップロードを
+		legacy	- ボディ全体を受信してからsplitする旧get_form_data
+		stream	- RequestReader + MultipartParser(一時ファイルへ書き出し)
+	で処理して、処理時間とピークRSS(ru_maxrss)を比較する
+	legacyはボディの数倍のメモリを使うので100MBまでにしている
+"""
+
+BOUNDARY = '----benchBoundary7MA4YWxk'
+CHUNK = 64 * 1024
+LEGACY_LIMIT_MB = 100
+
+# 比較用: 変更前のget_form_data(ボディ全体を2回split)
+def	legacy_get_form_data(body_part: bytes) -> dict:
+	result = {}
+	parts = body_part.split(BOUNDARY.encode('utf-8'))
+	for boundary_part in parts[1:]:
+		line = boundary_part.split(b'\r\n\r\n')
+		line[0] = line[0].decode('utf-8', errors='replace').strip('\r\n')
+		if line[0].strip('\r\n') == '--':
+			break
+		matched = re.search(r'name="(\w+)"', line[0])
+		if matched:
+			result[matched.group(1)] = line[1]
+	return result
+
+def	upload_parts(size):
+	head = (
+		f'--{BOUNDARY}\r\n'
+		'Content-Disposition: form-data; name="title"\r\n\r\n'
+		'benchmark\r\n'
+		f'--{BOUNDARY}\r\n'
+		'Content-Disposition: form-data; name="file"; filename="big.bin"\r\n'
+		'Content-Type: application/octet-stream\r\n\r\n'
+	).encode('ascii')
+	tail = f'\r\n--{BOUNDARY}--\r\n'.encode('ascii')
+	return head, tail, len(head) + size + len(tail)
+
+# アップロード全体をメモリに作らず、CHUNKずつ送る
+def	send_upload(client_side, size):
+	head, tail, length = upload_parts(size)
+	request_head = (
+		'POST /upload HTTP/1.1\r\n'
+		f'Content-Type: multipart/form-data; boundary={BOUNDARY}\r\n'
+		f'Content-Length: {length}\r\n\r\n'
+	).encode('ascii')
+	block = b'\xab' * CHUNK
+	try:
+		client_side.sendall(request_head + head)
+		sent = 0
+		while sent < size:
+			n = min(CHUNK, size - sent)
+			client_side.sendall(block[:n])
+			sent += n
+		client_side.sendall(tail)
+	except OSError:
+		pass
+
+def	run_child(parser, size_mb):
+	logging.disable(logging.CRITICAL)
+	size = size_mb * 1024 * 1024
+	server_side, client_side = socket.socketpair()
+	writer = threading.Thread(target=send_upload, args=(client_side, size), daemon=True)
+	begin = time.perf_counter()
+	writer.start()
+
+	if parser == 'legacy':
+		reader = RequestReader(server_side)
+		headers = reader.read_header()
+		length = int(re.search(rb'Content-Length: (\d+)', headers).group(1))
+		body = reader.read_exact(length)
+		fields = legacy_get_form_data(bytes(body))
+		got = len(fields['file']) - 4		# 旧実装は末尾の\r\n--を含む
+	else:
+		request_obj = Request()
+		get_request(server_side, request_obj)
+		got = request_obj.body['file'].size
+		request_obj.close()
+
+	elapsed = time.perf_counter() - begin
+	writer.join()
+	peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss	# Linuxでは KB
+	print(f'{elapsed:.3f} {peak} {got}')
+
+def	main():
+	if 1 < len(sys.argv) and sys.argv[1] == 'child':
+		run_child(sys.argv[2], int(sys.argv[3]))
+		return 0
+
+	sizes = [int(n) for n in sys.argv[1].split(',')] if 1 < len(sys.argv) else [10, 100, 500]
+	print(f'{"parser":<8}{"upload MB":>10}{"sec":>8}{"peak RSS MB":>13}{"file bytes":>13}')
+	for size_mb in sizes:
+		for parser in ('legacy', 'stream'):
+			if parser == 'legacy' and LEGACY_LIMIT_MB < size_mb:
+				continue
+			output = subprocess.run(
+				[sys.executable, __file__, 'child', parser, str(size_mb)],
+				capture_output=True, text=True, check=True
+			).stdout.split()
+			elapsed, peak, got = float(output[0]), int(output[1]), int(output[2])
+			print(f'{parser:<8}{size_mb:>10}{elapsed:>8.2f}{peak / 1024:>13.1f}{got:>13}')
+	return 0
+
+if __name__ == '__main__':
+	sys.exit(main())
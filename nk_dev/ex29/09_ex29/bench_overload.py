@@ -0,0 +1,149 @@
+#!/usr/bin/env python3
+
+import sys
+import time
+import socket
+import selectors
+
+from bench_common import HOST, start_server, stop_server, percentile
+
+"""
+	過負荷時の thread / pool モードの比較
+
+	使い方: bench_overload.py [倍率] [秒数] [パス]
+		例) bench_overload.py 5 10 /about
+
+	1. threadモードに並列数を固定したクローズドループで負荷をかけ、処理能力(req/s)を測る
+	2. 各モードのサーバーを子プロセスで起動し、処理能力の[倍率]倍の到着率で
+	   応答を待たずに新しい接続を張り続ける(オープンループ)
+	3. 200の p50/p99 レイテンシ、503の件数、エラー(タイムアウト・接続失敗)を比較する
+
+	クライアントも同じマシンで動くので、実際に出せた到着率も合わせて表示する
+	高い到着率では ulimit -n を十分に上げておくこと
+"""
+
+PORT = 8091
+TIMEOUT = 10.0		# これを超えた接続はエラーとして数える
+
+# rateがNoneなら並列数concurrencyのクローズドループ、数値ならその到着率のオープンループ
+def	run_load(path, duration, rate=None, concurrency=32):
+	request_bytes = f'GET {path} HTTP/1.1\r\nHost: {HOST}\r\nConnection: close\r\n\r\n'.encode('ascii')
+	selector = selectors.DefaultSelector()
+	latencies = []
+	statuses = {}
+	errors = 0
+	opened = 0
+
+	def	open_one():
+		nonlocal opened, errors
+		try:
+			sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+		except OSError:		# ファイルディスクリプタが足りない
+			errors += 1
+			return
+		sock.setblocking(False)
+		if sock.connect_ex((HOST, PORT)) not in (0, 115):	# 115: EINPROGRESS
+			sock.close()
+			errors += 1
+			return
+		opened += 1
+		# [開始時刻, 送信済みか, 受信データ]
+		selector.register(sock, selectors.EVENT_WRITE, [time.perf_counter(), False, bytearray()])
+
+	def	finish(sock, state):
+		nonlocal errors
+		selector.unregister(sock)
+		sock.close()
+		response = bytes(state[2])
+		if response.startswith(b'HTTP/'):
+			status = int(response[9:12])
+			statuses[status] = statuses.get(status, 0) + 1
+			if status == 200:
+				latencies.append(time.perf_counter() - state[0])
+		else:
+			errors += 1
+		if rate is None and time.perf_counter() < end:
+			open_one()
+
+	begin = time.perf_counter()
+	end = begin + duration
+	if rate is None:
+		for _ in range(concurrency):
+			open_one()
+
+	while True:
+		now = time.perf_counter()
+		if rate is not None and now < end:
+			# 予定の到着時刻を過ぎた分だけ接続を張る(応答は待たない)
+			while opened + errors < (now - begin) * rate:
+				open_one()
+		elif not selector.get_map():
+			break
+		if end + TIMEOUT < now:
+			break
+
+		for key, mask in selector.select(timeout=0.001):
+			sock = key.fileobj
+			state = key.data
+			try:
+				if not state[1]:
+					sock.send(request_bytes)
+					state[1] = True
+					selector.modify(sock, selectors.EVENT_READ, state)
+					continue
+				chunk = sock.recv(65536)
+				if chunk:
+					state[2] += chunk
+					continue
+			except BlockingIOError:
+				continue
+			except OSError:
+				pass
+			finish(sock, state)
+
+	# タイムアウトした接続
+	for key in list(selector.get_map().values()):
+		selector.unregister(key.fileobj)
+		key.fileobj.close()
+		errors += 1
+
+	elapsed = time.perf_counter() - begin
+	return {
+		'offered': opened / min(elapsed, duration),
+		'ok': statuses.get(200, 0),
+		'rejected': statuses.get(503, 0),
+		'errors': errors,
+		'throughput': statuses.get(200, 0) / elapsed,
+		'p50': percentile(latencies, 50) * 1000,
+		'p99': percentile(latencies, 99) * 1000
+	}
+
+def	main():
+	factor = float(sys.argv[1]) if 1 < len(sys.argv) else 5.0
+	duration = float(sys.argv[2]) if 2 < len(sys.argv) else 10.0
+	path = sys.argv[3] if 3 < len(sys.argv) else '/about'
+
+	proc = start_server('thread', PORT)
+	try:
+		capacity = run_load(path, duration)['throughput']
+	finally:
+		stop_server(proc)
+	rate = capacity * factor
+	print(f'capacity: {capacity:.0f} req/s, target rate: {rate:.0f} req/s ({factor:g}x)')
+
+	print(f'{"mode":<8}{"offered/s":>10}{"200":>8}{"503":>8}{"errors":>8}{"200/s":>8}{"p50 ms":>9}{"p99 ms":>9}')
+	for mode in ('thread', 'pool'):
+		proc = start_server(mode, PORT)
+		try:
+			result = run_load(path, duration, rate=rate)
+		finally:
+			stop_server(proc)
+		print(
+			f'{mode:<8}{result["offered"]:>10.0f}{result["ok"]:>8}{result["rejected"]:>8}{result["errors"]:>8}'
+			f'{result["throughput"]:>8.0f}{result["p50"]:>9.1f}{result["p99"]:>9.1f}'
+		)
+		time.sleep(1)	# TIME_WAITのポートが減るのを待つ
+	return 0
+
+if __name__ == '__main__':
+	sys.exit(main())
@@ -0,0 +1,135 @@
+#!/usr/bin/env python3
+
+import sys
+import time
+import socket
+import logging
+import threading
+
+import config
+from http import Request, get_request
+
+"""
+	リクエストパーサーのマイクロベンチマーク
+
+	使い方: bench_parser.py [繰り返し回数]
+
+	socketpairの片側からリクエストを送り、もう片側で
+		legacy	- 旧get_request(buffer += recv、ボディは1回のrecv)
+		reader	- RequestReader(recv_into + 探索位置の記録 + Content-Length分のループ)
+	を実行して1リクエストあたりの時間と、受け取れたボディ長を比較する
+
+	ケース:
+		body 1KB / 64KB / 10MB	- POSTのボディサイズ
+		header 4KB / 15KB		- 大量のヘッダー(旧実装はヘッダー探索が二乗になる)
+								  MAX_HEADER_SIZE / MAX_HEADER_COUNTに収まる大きさにして、両方とも最後まで解析させる
+
+	上限の確認(パーサー同士の比較ではない):
+		header 64KB / 1MB		- MAX_HEADER_SIZEを超えるヘッダー。readerが431で断るまでの時間と、
+								  比較のために旧実装が全部を読み込んで解析する時間
+"""
+
+# 比較用: 変更前のget_requestのヘッダー・ボディ読み込み部分
+def	legacy_get_request(client_socket) -> int:
+	buffer = b''
+	while not b'\r\n\r\n' in buffer:
+		buffer += client_socket.recv(config.BUFFER_SIZE)
+		if buffer == b'':
+			break
+		if config.MAX_READ < len(buffer):
+			return -1
+	header_end = buffer.find(b'\r\n\r\n')
+	headers = buffer[:header_end].decode('utf-8', errors='replace')
+	body_part = buffer[header_end + 4:]
+
+	length = None
+	for header in headers.split('\r\n')[1:]:
+		if 'Content-Length' in header:
+			length = header.split(':')[1].strip()
+	if length is None:
+		return 0
+	body_part += client_socket.recv(int(length) - len(body_part))
+	return len(body_part)
+
+def	reader_get_request(client_socket) -> int:
+	request_obj = Request()
+	if get_request(client_socket, request_obj) == -1:
+		return -1
+	return int(request_obj.length)
+
+# 上限の確認用: 断った時のステータス(断らなければ0)
+def	reader_rejected(client_socket) -> int:
+	request_obj = Request()
+	if get_request(client_socket, request_obj) == -1:
+		return request_obj.error or -1
+	return 0
+
+# filler: 埋め草のヘッダー1行の値の長さ(行数をMAX_HEADER_COUNTに収める時は長くする)
+def	build_request(body_size, header_size=0, filler=48):
+	lines = ['POST /upload HTTP/1.1', 'Host: 127.0.0.1']
+	tail = ['Content-Type: application/octet-stream', f'Content-Length: {body_size}']
+	index = 0
+	while sum(len(line) + 2 for line in lines + tail) + 2 + len(f'X-Filler-{index}: ') + filler + 2 <= header_size:
+		lines.append(f'X-Filler-{index}: {"x" * filler}')
+		index += 1
+	lines += tail
+	head = ('\r\n'.join(lines) + '\r\n\r\n').encode('ascii')
+	return head + b'b' * body_size
+
+# 旧実装はボディを読み切らずに戻るので、送信側の失敗は無視する
+def	send_request(client_side, request_bytes):
+	try:
+		client_side.sendall(request_bytes)
+	except OSError:
+		pass
+
+def	measure(parser, request_bytes, repeat):
+	elapsed = 0.0
+	received = 0
+	for _ in range(repeat):
+		server_side, client_side = socket.socketpair()
+		writer = threading.Thread(target=send_request, args=(client_side, request_bytes), daemon=True)
+		begin = time.perf_counter()
+		writer.start()
+		received = parser(server_side)
+		elapsed += time.perf_counter() - begin
+		server_side.close()
+		writer.join()
+		client_side.close()
+	return elapsed / repeat * 1000, received
+
+def	main():
+	repeat = int(sys.argv[1]) if 1 < len(sys.argv) else 20
+	logging.disable(logging.CRITICAL)	# ログ出力のコストを計測から外す
+
+	cases = [
+		('body 1KB', build_request(1024)),
+		('body 64KB', build_request(64 * 1024)),
+		('body 10MB', build_request(10 * 1024 * 1024 - 1024)),
+		('header 4KB', build_request(0, 4 * 1024, filler=160)),
+		('header 15KB', build_request(0, config.MAX_HEADER_SIZE - 1024, filler=160))
+	]
+	limits = [
+		('header 64KB', build_request(0, 64 * 1024)),
+		('header 1MB', build_request(0, 1024 * 1024))
+	]
+
+	print(f'{"case":<14}{"parser":<8}{"ms/req":>10}{"body got":>12}{"expected":>12}')
+	for name, request_bytes in cases:
+		expected = len(request_bytes) - request_bytes.find(b'\r\n\r\n') - 4
+		for label, parser in (('legacy', legacy_get_request), ('reader', reader_get_request)):
+			ms, received = measure(parser, request_bytes, repeat)
+			print(f'{name:<14}{label:<8}{ms:>10.3f}{received:>12}{expected:>12}')
+
+	print()
+	print(f'limit checks (MAX_HEADER_SIZE={config.MAX_HEADER_SIZE}): reader rejects, legacy parses everything')
+	print(f'{"case":<14}{"parser":<8}{"ms/req":>10}{"result":>12}')
+	for name, request_bytes in limits:
+		ms, received = measure(legacy_get_request, request_bytes, repeat)
+		print(f'{name:<14}{"legacy":<8}{ms:>10.3f}{f"body {received}":>12}')
+		ms, status = measure(reader_rejected, request_bytes, repeat)
+		print(f'{name:<14}{"reader":<8}{ms:>10.3f}{status:>12}')
+	return 0
+
+if __name__ == '__main__':
+	sys.exit(main())
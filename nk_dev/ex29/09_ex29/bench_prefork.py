@@ -0,0 +1,55 @@
+#!/usr/bin/env python3
+
+import sys
+import time
+import multiprocessing
+
+from bench_common import start_server, stop_server
+from bench_overload import run_load, PORT
+from prefork import cpu_count
+
+"""
+	preforkモードのワーカー数によるスケーリング
+
+	使い方: bench_prefork.py [ワーカー数,...] [秒数] [パス] [クライアントのプロセス数]
+		例) bench_prefork.py 1,2,4 5 /about 4
+
+	ワーカー数ごとにpreforkモードのサーバーを子プロセスで起動し、
+	複数のクライアントプロセス(それぞれ並列32のクローズドループ)で負荷をかけて
+	合計の req/s と p99 を測る
+	省略時はワーカー数 1〜コア数(/proc/cpuinfoのsiblings)、クライアントはコア数と同じ
+
+	クライアントも同じマシンで動くので、コア数が少ないとクライアントとワーカーがCPUを取り合う
+"""
+
+def	client(args):
+	path, duration = args
+	return run_load(path, duration)
+
+def	main():
+	cores = cpu_count()
+	counts = [int(n) for n in sys.argv[1].split(',')] if 1 < len(sys.argv) else list(range(1, cores + 1))
+	duration = float(sys.argv[2]) if 2 < len(sys.argv) else 5.0
+	path = sys.argv[3] if 3 < len(sys.argv) else '/about'
+	clients = int(sys.argv[4]) if 4 < len(sys.argv) else cores
+
+	print(f'cores: {cores}, client processes: {clients}')
+	print(f'{"workers":>8}{"req/s":>9}{"p99 ms":>9}{"speedup":>9}')
+	base = None
+	for count in counts:
+		proc = start_server('prefork', PORT, str(count))
+		try:
+			time.sleep(0.5)		# 全ワーカーがbindし終わるのを待つ
+			with multiprocessing.Pool(clients) as pool:
+				results = pool.map(client, [(path, duration)] * clients)
+		finally:
+			stop_server(proc)
+		throughput = sum(result['throughput'] for result in results)
+		p99 = max(result['p99'] for result in results)
+		base = base or throughput
+		print(f'{count:>8}{throughput:>9.0f}{p99:>9.1f}{throughput / base:>8.2f}x')
+		time.sleep(1)	# TIME_WAITのポートが減るのを待つ
+	return 0
+
+if __name__ == '__main__':
+	sys.exit(main())
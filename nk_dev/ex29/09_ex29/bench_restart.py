@@ -0,0 +1,270 @@
+#!/usr/bin/env python3
+
+import os
+import sys
+import json
+import time
+import signal
+import socket
+import tempfile
+import threading
+import subprocess
+from pathlib import Path
+
+from bench_common import SERVER, HOST, ResponseClosed, read_response
+
+"""
+	設定の読み直し(SIGHUP)と再起動(SIGUSR2)の間も、リクエストを1件も落とさないことの確認
+
+	使い方: bench_restart.py [モード,...] [秒数]
+		例) bench_restart.py thread,event,pool,async,prefork 12
+
+	モードごとに、一時ディレクトリの設定ファイル(SERVER_CONFIG)でサーバーを子プロセスとして起動し、
+	[秒数]の間 CLIENTS本のクライアントで負荷をかけ続けながら
+		1. 設定ファイルを書き換えてSIGHUP(読み直されたことをログで確認)
+		2. SIGUSR2で再起動をRESTARTS回(PID_FILEのpidが変わり、古いプロセスが終了することを確認)
+	を行う。再起動の直前には、ボディを2秒かけて送る遅いPOSTを始めておき、
+	古いプロセスが処理中のリクエストを最後まで返すことを確かめる
+
+	クライアント:
+		close		- 1リクエストごとに接続する(接続の拒否・リセットはすぐ失敗として数える)
+		keep-alive	- 1接続で続けて送る。再利用した接続が応答の1バイト目より前に閉じられた場合だけ、
+					  新しい接続で1回やり直す(HTTPクライアントの通常の動作、retriesとして数える)
+	失敗(接続エラー・200以外・応答の途中で切れたもの)が1件でもあれば終了コード1
+"""
+
+PORT = 8093
+CLIENTS = 8				# 半分はclose、半分はkeep-alive
+RESTARTS = 2
+SLOW_BODY_SECONDS = 2.0
+TIMEOUT = 10.0
+
+CONFIG = '''
+pid_file = "{pid_file}"
+access_log = false
+log_level = "INFO"
+drain_timeout = 15.0
+max_keepalive_requests = {keepalive}
+'''
+
+class Results:
+	def	__init__(self):
+		self.lock = threading.Lock()
+		self.ok = 0
+		self.retries = 0
+		self.failures = []
+
+	def	add(self, ok=0, retries=0, failure=None):
+		with self.lock:
+			self.ok += ok
+			self.retries += retries
+			if failure:
+				self.failures.append(failure)
+
+def	close_client(stop, results):
+	request = f'GET /about HTTP/1.1\r\nHost: {HOST}\r\nConnection: close\r\n\r\n'.encode('ascii')
+	while not stop.is_set():
+		try:
+			with socket.create_connection((HOST, PORT), timeout=TIMEOUT) as sock:
+				sock.sendall(request)
+				status, _, _ = read_response(sock)
+		except OSError as e:
+			results.add(failure=f'close: {type(e).__name__}: {e}')
+			continue
+		if status == 200:
+			results.add(ok=1)
+		else:
+			results.add(failure=f'close: status {status}')
+
+def	keepalive_client(stop, results):
+	request = f'GET /about HTTP/1.1\r\nHost: {HOST}\r\n\r\n'.encode('ascii')
+	sock = None
+	reused = False
+	while not stop.is_set():
+		retried = False
+		while True:
+			try:
+				if sock is None:
+					reused = False
+					sock = socket.create_connection((HOST, PORT), timeout=TIMEOUT)
+				sock.sendall(request)
+				status, headers, _ = read_response(sock)
+			except ResponseClosed as e:
+				status, received = None, e.received
+				error = 'closed'
+			except OSError as e:
+				status, received = None, 0
+				error = f'{type(e).__name__}: {e}'
+			if status is None:
+				if sock is not None:
+					sock.close()
+				sock = None
+				if reused and not received and not retried:
+					retried = True		# アイドルの接続を閉じられただけ: やり直してよい
+					results.add(retries=1)
+					continue
+				results.add(failure=f'keep-alive: {error} (received {received} bytes)')
+			elif status == 200:
+				results.add(ok=1)
+				reused = True
+				if headers.get('connection', '').lower() == 'close':		# 上限・drainで閉じると言われた接続は使わない
+					sock.close()
+					sock = None
+			else:
+				results.add(failure=f'keep-alive: status {status}')
+			break
+	if sock is not None:
+		sock.close()
+
+# ボディを少しずつSLOW_BODY_SECONDSかけて送るPOST(再起動の間も処理中のままにする)
+def	slow_post(results):
+	body = b'slow=' + b'a' * 995
+	head = (
+		f'POST /x HTTP/1.1\r\nHost: {HOST}\r\nConnection: close\r\n'
+		f'Content-Type: application/x-www-form-urlencoded\r\nContent-Length: {len(body)}\r\n\r\n'
+	).encode('ascii')
+	pieces = 10
+	try:
+		with socket.create_connection((HOST, PORT), timeout=TIMEOUT) as sock:
+			sock.sendall(head)
+			for n in range(pieces):
+				time.sleep(SLOW_BODY_SECONDS / pieces)
+				sock.sendall(body[n * 100:(n + 1) * 100])
+			status, _, _ = read_response(sock)
+	except OSError as e:
+		results.add(failure=f'slow post: {type(e).__name__}: {e}')
+		return
+	if status == 200:
+		results.add(ok=1)
+	else:
+		results.add(failure=f'slow post: status {status}')
+
+def	alive(pid) -> bool:
+	try:
+		with open(f'/proc/{pid}/stat') as file:
+			return file.read().rsplit(')', 1)[1].split()[0] != 'Z'
+	except OSError:
+		return False
+
+def	read_pid(pid_file) -> int:
+	try:
+		return int(Path(pid_file).read_text())
+	except (OSError, ValueError):
+		return 0
+
+# 条件が満たされるまで待つ(満たされればTrue)
+def	wait_for(condition, timeout) -> bool:
+	deadline = time.monotonic() + timeout
+	while time.monotonic() < deadline:
+		if condition():
+			return True
+		time.sleep(0.05)
+	return False
+
+def	stats_pid() -> int:
+	request = f'GET /__stats HTTP/1.1\r\nHost: {HOST}\r\nConnection: close\r\n\r\n'.encode('ascii')
+	with socket.create_connection((HOST, PORT), timeout=TIMEOUT) as sock:
+		sock.sendall(request)
+		data = b''
+		while chunk := sock.recv(65536):
+			data += chunk
+	return json.loads(data.partition(b'\r\n\r\n')[2])['pid']
+
+def	run_mode(mode, duration) -> bool:
+	workdir = Path(tempfile.mkdtemp(prefix='bench_restart_'))
+	pid_file = workdir / 'server.pid'
+	config_file = workdir / 'server.toml'
+	log_file = workdir / 'server.log'
+	config_file.write_text(CONFIG.format(pid_file=pid_file, keepalive=100))
+	env = dict(os.environ, SERVER_CONFIG=str(config_file))
+	extra = ['2'] if mode == 'prefork' else []
+
+	problems = []
+	with open(log_file, 'wb') as log:
+		proc = subprocess.Popen([sys.executable, str(SERVER), mode, str(PORT), *extra], env=env, stdout=log, stderr=log)
+	if not wait_for(lambda: read_pid(pid_file) == proc.pid, 10.0):
+		proc.kill()
+		print(f'--- {mode}: server did not start, see {log_file}')
+		return False
+
+	results = Results()
+	stop = threading.Event()
+	clients = [
+		threading.Thread(target=close_client if n % 2 else keepalive_client, args=(stop, results), daemon=True)
+		for n in range(CLIENTS)
+	]
+	for thread in clients:
+		thread.start()
+	begin = time.monotonic()
+	pids = [proc.pid]
+
+	# 1. 設定の読み直し
+	time.sleep(min(1.0, duration / 4))
+	config_file.write_text(CONFIG.format(pid_file=pid_file, keepalive=50))
+	os.kill(pids[-1], signal.SIGHUP)
+	if not wait_for(lambda: b'MAX_KEEPALIVE_REQUESTS=50' in log_file.read_bytes(), 5.0):
+		problems.append('SIGHUP: reload was not logged')
+
+	# 2. 再起動
+	slow_posts = []
+	for n in range(RESTARTS):
+		time.sleep(max(0.5, (duration - (time.monotonic() - begin)) / (RESTARTS + 1 - n) - 2.0))
+		slow = threading.Thread(target=slow_post, args=(results,))
+		slow.start()
+		slow_posts.append(slow)
+		time.sleep(0.3)		# 遅いPOSTが古いプロセスに受け付けられてから
+		old = pids[-1]
+		restarted = time.monotonic()
+		os.kill(old, signal.SIGUSR2)
+		if not wait_for(lambda: read_pid(pid_file) not in (0, old), 15.0):
+			problems.append(f'restart {n + 1}: new process did not become ready')
+			break
+		pids.append(read_pid(pid_file))
+		ready = time.monotonic() - restarted
+		if not wait_for(lambda: not alive(old), 30.0):
+			problems.append(f'restart {n + 1}: old process {old} did not exit')
+		print(f'{mode}: restart {n + 1} pid {old} -> {pids[-1]}, ready in {ready:.2f}s, old exited after {time.monotonic() - restarted:.2f}s')
+
+	time.sleep(max(0.0, duration - (time.monotonic() - begin)))
+	stop.set()
+	for thread in clients + slow_posts:
+		thread.join()
+	elapsed = time.monotonic() - begin
+
+	served_by = 0
+	try:
+		served_by = stats_pid()
+	except (OSError, ValueError, KeyError):
+		problems.append('final /__stats failed')
+	if mode != 'prefork' and served_by != pids[-1]:
+		problems.append(f'/__stats answered by pid {served_by}, expected {pids[-1]}')
+
+	os.kill(pids[-1], signal.SIGTERM)
+	wait_for(lambda: not alive(pids[-1]), 30.0)
+	if proc.poll() is None:
+		proc.kill()
+	proc.wait()
+
+	failures = results.failures
+	ok = not failures and not problems
+	print(
+		f'--- {mode}: {results.ok} ok in {elapsed:.1f}s ({results.ok / elapsed:.0f} req/s), '
+		f'{len(failures)} failed, {results.retries} keep-alive retries, {len(pids) - 1} restarts, '
+		f'{len(slow_posts)} slow posts  {"ok" if ok else "FAILED"}'
+	)
+	for problem in problems:
+		print(f'  {problem}')
+	for failure in sorted(set(failures)):
+		print(f'  {failures.count(failure)} x {failure}')
+	if not ok:
+		print(f'  server log: {log_file}')
+	return ok
+
+def	main():
+	modes = sys.argv[1].split(',') if 1 < len(sys.argv) else ['thread', 'event', 'pool', 'async', 'prefork']
+	duration = float(sys.argv[2]) if 2 < len(sys.argv) else 12.0
+	results = [run_mode(mode, duration) for mode in modes]
+	return 0 if all(results) else 1
+
+if __name__ == '__main__':
+	sys.exit(main())
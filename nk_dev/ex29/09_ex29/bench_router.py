@@ -0,0 +1,73 @@
+#!/usr/bin/env python3
+
+import re
+import sys
+import time
+import random
+import logging
+
+from route import Router
+
+"""
+	ルーターのベンチマーク
+
+	使い方: bench_router.py [ルート数,...] [検索回数]
+		例) bench_router.py 10,100,1000 100000
+
+	/api/v1/res<N>/<item_id> 形式のルートをN個登録し、
+		regex	- 変更前の方式(正規表現のリストを先頭から順にmatch)
+		trie	- Router(セグメント単位のトライ木)
+	で、ランダムなパスを引いた時の1回あたりの時間を比較する
+"""
+
+# 比較用: 変更前のroute関数と同じ正規表現のリスト
+def	build_regex(paths):
+	routes = []
+	for path in paths:
+		pattern = re.sub(r'<(\w+)>', r'(?P<\1>[^/]+)', path)
+		routes.append((re.compile(f'^{pattern}$'), path))
+	return routes
+
+def	find_regex(routes, path):
+	for pattern, handler in routes:
+		matched = pattern.match(path)
+		if matched:
+			return handler, matched.groupdict()
+	return None
+
+def	build_trie(paths):
+	router = Router()
+	for path in paths:
+		router.add(path, ('GET',), path)
+	return router
+
+def	measure(find, lookups):
+	begin = time.perf_counter()
+	for path in lookups:
+		find(path)
+	return (time.perf_counter() - begin) / len(lookups) * 1e6
+
+def	main():
+	counts = [int(n) for n in sys.argv[1].split(',')] if 1 < len(sys.argv) else [10, 100, 1000]
+	repeat = int(sys.argv[2]) if 2 < len(sys.argv) else 100000
+	logging.disable(logging.CRITICAL)
+	random.seed(0)
+
+	print(f'{"routes":>8}{"regex us":>12}{"trie us":>12}{"speedup":>10}')
+	for count in counts:
+		paths = [f'/api/v1/res{index}/<item_id>' for index in range(count)]
+		lookups = [f'/api/v1/res{random.randrange(count)}/{random.randrange(10000)}' for _ in range(repeat)]
+
+		routes = build_regex(paths)
+		router = build_trie(paths)
+		# 結果が一致することを確認してから計測
+		for path in lookups[:100]:
+			assert find_regex(routes, path)[1] == router.find(path)[1]
+
+		regex_us = measure(lambda path: find_regex(routes, path), lookups)
+		trie_us = measure(router.find, lookups)
+		print(f'{count:>8}{regex_us:>12.2f}{trie_us:>12.2f}{regex_us / trie_us:>9.1f}x')
+	return 0
+
+if __name__ == '__main__':
+	sys.exit(main())
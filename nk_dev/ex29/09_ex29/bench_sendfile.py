@@ -0,0 +1,104 @@
+#!/usr/bin/env python3
+
+import os
+import sys
+import time
+import socket
+import logging
+import resource
+import threading
+import subprocess
+
+from route import STATIC_DIR, Response, static_search
+
+"""
+	静的ファイル送信のスループット・ピークRSSベンチマーク
+
+	使い方: bench_sendfile.py [サイズMB,...]
+		例) bench_sendfile.py 1,1024
+
+	static/にベンチマーク用のファイルを作り、ケースごとに子プロセスで
+		legacy		- read_bytes → to_bytesでヘッダーと連結 → sendall(変更前の経路)
+		sendfile	- static_search → FileResponse.send(ヘッダーをsendall、ボディはsendfile)
+	を実行し、ループバックTCPで受信し切るまでの時間とピークRSSを比較する
+"""
+
+def	bench_file(size_mb):
+	return STATIC_DIR / f'_bench_{size_mb}mb.bin'
+
+def	create_file(size_mb):
+	file_path = bench_file(size_mb)
+	block = os.urandom(1024 * 1024)
+	with open(file_path, 'wb') as file:
+		for _ in range(size_mb):
+			file.write(block)
+	return file_path
+
+# 受信側: 固定バッファに読み捨てる
+def	drain(sock, result):
+	buffer = bytearray(1024 * 1024)
+	total = 0
+	while True:
+		received = sock.recv_into(buffer)
+		if not received:
+			break
+		total += received
+	result.append(total)
+
+def	run_child(path, size_mb):
+	logging.disable(logging.CRITICAL)
+	file_path = bench_file(size_mb)
+
+	listener = socket.create_server(('127.0.0.1', 0))
+	client_side = socket.create_connection(listener.getsockname())
+	server_side, _ = listener.accept()
+	result = []
+	reader = threading.Thread(target=drain, args=(client_side, result), daemon=True)
+	reader.start()
+
+	begin = time.perf_counter()
+	if path == 'legacy':
+		body = file_path.read_bytes()
+		response_obj = Response(
+			status=200,
+			reason='OK',
+			headers={'Content-Type': 'application/octet-stream', 'Content-Length': len(body)},
+			body=body
+		)
+		server_side.sendall(response_obj.to_bytes())
+	else:
+		response_obj = static_search(f'/{file_path.name}')
+		response_obj.send(server_side)
+	server_side.shutdown(socket.SHUT_WR)
+	reader.join()
+	elapsed = time.perf_counter() - begin
+
+	peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss	# Linuxでは KB
+	print(f'{elapsed:.3f} {peak} {result[0]}')
+
+def	main():
+	if 1 < len(sys.argv) and sys.argv[1] == 'child':
+		run_child(sys.argv[2], int(sys.argv[3]))
+		return 0
+
+	sizes = [int(n) for n in sys.argv[1].split(',')] if 1 < len(sys.argv) else [1, 1024]
+	print(f'{"path":<10}{"file MB":>8}{"sec":>8}{"MB/s":>9}{"peak RSS MB":>13}{"bytes sent":>13}')
+	for size_mb in sizes:
+		file_path = create_file(size_mb)
+		try:
+			for path in ('legacy', 'sendfile'):
+				output = subprocess.run(
+					[sys.executable, __file__, 'child', path, str(size_mb)],
+					capture_output=True, text=True, check=True
+				).stdout.split()
+				elapsed, peak, sent = float(output[0]), int(output[1]), int(output[2])
+				print(
+					f'{path:<10}{size_mb:>8}{elapsed:>8.3f}{size_mb / elapsed:>9.0f}'
+					f'{peak / 1024:>13.1f}{sent:>13}'
+				)
+		finally:
+			file_path.unlink()
+	return 0
+
+if __name__ == '__main__':
+	sys.exit(main())
@@ -0,0 +1,109 @@
+#!/usr/bin/env python3
+
+import sys
+import time
+import socket
+import logging
+
+from route import Response, sendmsg_all
+
+"""
+	レスポンス1件あたりのシリアライズ・送信のオーバーヘッド
+
+	使い方: bench_serialize.py [ボディのバイト数,...]
+		例) bench_serialize.py 512,16384,262144
+
+	典型的な動的ページのヘッダー(Content-Type / Content-Length / keep-alive / Vary)で
+		legacy	- 変更前のto_bytes(文字列の += でヘッダーを作り、bytesの += でボディを連結)→ sendall
+		buffers	- serialize_head(検証・キャッシュ)→ [ヘッダー, ボディ] をsendmsg
+	を比べる
+		serialize	- バイト列(バッファのリスト)を作るだけの時間
+		send		- ループバックTCPへ送信し、同じスレッドで受信し切るまで
+					  (受信側を別スレッド・別プロセスにすると、1CPUでは切り替えの間隔で結果が大きく揺れるため)
+"""
+
+MIN_DURATION = 0.3		# 1ケースをこの秒数以上くり返して平均する
+
+def	make_response(size) -> Response:
+	body = 'a' * size
+	return Response(
+		status=200,
+		reason='OK',
+		headers={
+			'Content-Type': 'text/html; charset=utf-8',
+			'Content-Length': size,
+			'Connection': 'keep-alive',
+			'Keep-Alive': 'timeout=5, max=100',
+			'Vary': 'Accept-Encoding'
+		},
+		body=body
+	)
+
+# 変更前のResponse.to_bytes
+def	legacy_to_bytes(response_obj) -> bytes:
+	response = f'HTTP/1.1 {response_obj.status} {response_obj.reason}\r\n'
+	for label, detail in response_obj.headers.items():
+		response += f'{label}: {detail}\r\n'
+	response += '\r\n'
+	response = response.encode('utf-8', errors='replace')
+	if isinstance(response_obj.body, bytes):
+		response += response_obj.body
+	else:
+		response += response_obj.body.encode('utf-8', errors='replace')
+	return response
+
+def	measure(run) -> float:
+	count = 0
+	begin = time.perf_counter()
+	while True:
+		for _ in range(100):
+			run()
+		count += 100
+		elapsed = time.perf_counter() - begin
+		if MIN_DURATION <= elapsed:
+			return elapsed / count
+
+# 送った分を読み捨てる
+def	drain(sock, buffer, size):
+	while size:
+		size -= sock.recv_into(buffer)
+
+def	main():
+	logging.disable(logging.CRITICAL)
+	sizes = [int(n) for n in sys.argv[1].split(',')] if 1 < len(sys.argv) else [512, 16384, 262144]
+
+	# 1レスポンス分をブロックせずに書き切れるよう、バッファを大きくする
+	listener = socket.create_server(('127.0.0.1', 0))
+	client_side = socket.create_connection(listener.getsockname())
+	client_side.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4 * 1024 * 1024)
+	server_side, _ = listener.accept()
+	server_side.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, 4 * 1024 * 1024)
+	buffer = bytearray(4 * 1024 * 1024)
+
+	print(f'{"body bytes":>11}{"path":>9}{"serialize us":>14}{"send us":>10}')
+	for size in sizes:
+		response_obj = make_response(size)
+		wire_size = len(legacy_to_bytes(response_obj))
+		assert legacy_to_bytes(response_obj) == response_obj.to_bytes()
+
+		def	send_legacy():
+			server_side.sendall(legacy_to_bytes(response_obj))
+			drain(client_side, buffer, wire_size)
+
+		def	send_buffers():
+			sendmsg_all(server_side, response_obj.buffers())
+			drain(client_side, buffer, wire_size)
+
+		cases = (
+			('legacy', lambda: legacy_to_bytes(response_obj), send_legacy),
+			('buffers', response_obj.buffers, send_buffers)
+		)
+		for name, serialize, send in cases:
+			print(f'{size:>11}{name:>9}{measure(serialize) * 1e6:>14.2f}{measure(send) * 1e6:>10.2f}')
+
+	for sock in (server_side, client_side, listener):
+		sock.close()
+	return 0
+
+if __name__ == '__main__':
+	sys.exit(main())
@@ -0,0 +1,114 @@
+#!/usr/bin/env python3
+
+import sys
+import time
+import socket
+import logging
+import resource
+import threading
+import subprocess
+
+from route import Response, create_html, stream_html
+
+"""
+	動的ページのストリーミング送信のTTFB・ピークRSSベンチマーク
+
+	使い方: bench_stream.py [サイズMB,...]
+		例) bench_stream.py 5,50
+
+	サイズMB分の<li>行を持つ一覧ページを、ケースごとに子プロセスで
+		legacy	- 文字列を += で組み立て → create_html → to_bytesでヘッダーと連結 → sendall(変更前の経路)
+		stream	- ジェネレーターをResponseのボディに渡す → send(chunked, sendmsgでまとめて送信)
+	の経路で送り、ループバックTCPで最初の1バイトが届くまでの時間(TTFB)、
+	受信し切るまでの時間とピークRSSを比較する
+"""
+
+LINE = '\t\t<li><a href="/item/{0:08d}">item {0:08d}</a> - generated listing entry</li>\n'
+
+def	line_count(size_mb):
+	return size_mb * 1024 * 1024 // len(LINE.format(0))
+
+def	listing(count):
+	for number in range(count):
+		yield LINE.format(number)
+
+# 受信側: 最初の1バイトの時刻を記録して、固定バッファに読み捨てる
+def	drain(sock, result):
+	buffer = bytearray(1024 * 1024)
+	total = 0
+	while True:
+		received = sock.recv_into(buffer)
+		if not received:
+			break
+		if not total:
+			result.append(time.perf_counter())
+		total += received
+	result.append(total)
+
+def	run_child(path, size_mb):
+	logging.disable(logging.CRITICAL)
+	count = line_count(size_mb)
+
+	listener = socket.create_server(('127.0.0.1', 0))
+	client_side = socket.create_connection(listener.getsockname())
+	server_side, _ = listener.accept()
+	result = []
+	reader = threading.Thread(target=drain, args=(client_side, result), daemon=True)
+	reader.start()
+
+	begin = time.perf_counter()
+	if path == 'legacy':
+		content = '\t<ul>\n'
+		for line in listing(count):
+			content += line
+		content += '\t</ul>\n'
+		body = create_html('Listing', 'Listing', content)
+		length = len(body.encode('utf-8', errors='replace'))
+		response_obj = Response(
+			status=200,
+			reason='OK',
+			headers={'Content-Type': 'text/html; charset=utf-8', 'Content-Length': length},
+			body=body
+		)
+		server_side.sendall(response_obj.to_bytes())
+	else:
+		def	content():
+			yield '\t<ul>\n'
+			yield from listing(count)
+			yield '\t</ul>\n'
+		response_obj = Response(
+			status=200,
+			reason='OK',
+			headers={'Content-Type': 'text/html; charset=utf-8'},
+			body=stream_html('Listing', 'Listing', content())
+		)
+		response_obj.send(server_side)
+	server_side.shutdown(socket.SHUT_WR)
+	reader.join()
+	elapsed = time.perf_counter() - begin
+
+	peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss	# Linuxでは KB
+	print(f'{result[0] - begin:.4f} {elapsed:.3f} {peak} {result[1]}')
+
+def	main():
+	if 1 < len(sys.argv) and sys.argv[1] == 'child':
+		run_child(sys.argv[2], int(sys.argv[3]))
+		return 0
+
+	sizes = [int(n) for n in sys.argv[1].split(',')] if 1 < len(sys.argv) else [5, 50]
+	print(f'{"path":<8}{"page MB":>8}{"TTFB ms":>10}{"sec":>8}{"MB/s":>8}{"peak RSS MB":>13}{"bytes sent":>12}')
+	for size_mb in sizes:
+		for path in ('legacy', 'stream'):
+			output = subprocess.run(
+				[sys.executable, __file__, 'child', path, str(size_mb)],
+				capture_output=True, text=True, check=True
+			).stdout.split()
+			ttfb, elapsed, peak, sent = float(output[0]), float(output[1]), int(output[2]), int(output[3])
+			print(
+				f'{path:<8}{size_mb:>8}{ttfb * 1000:>10.1f}{elapsed:>8.3f}{size_mb / elapsed:>8.0f}'
+				f'{peak / 1024:>13.1f}{sent:>12}'
+			)
+	return 0
+
+if __name__ == '__main__':
+	sys.exit(main())
@@ -0,0 +1,80 @@
+#!/usr/bin/env python3
+
+import sys
+import html
+import time
+import logging
+import tracemalloc
+
+from route import create_html
+from template import Template
+
+"""
+	ユーザーページのレンダリング時間とメモリ確保量の比較
+
+	使い方: bench_template.py [user_idの種類数,...]
+		例) bench_template.py 1,100,10000
+
+	/user/<user_id> のボディ(bytes)を作るまでを
+		legacy		- html.escape → create_html(リストを'\\n'.join)→ encode(変更前のhandle_user)
+		template	- コンパイル済みのTemplate.render(スロットだけエスケープ・エンコードしてb''.join)
+	で比べる。user_idは[種類数]個の値(<>&を含むものもある)を順に使い回す
+	(同じuser_idの2回目以降はhandle_userのcacheableが返すので、ここで測るのはキャッシュに無い時)
+		us/render	- 1回あたりの時間
+		peak bytes	- 1回のレンダリング中に一時的に確保したメモリの最大(tracemallocで測る、結果のbytesを含む)
+"""
+
+MIN_DURATION = 0.3
+CONTENT = '\t<p>これはユーザーページのダミーです</p>\n'
+SOURCE = create_html('User Page', 'Welcome {{user_id}} !', CONTENT)
+
+def	legacy(user_id) -> bytes:
+	user_id = html.escape(user_id)
+	body = create_html('User Page', f'Welcome {user_id} !', CONTENT)
+	return body.encode('utf-8', errors='replace')
+
+def	measure(render, ids) -> float:
+	count = 0
+	begin = time.perf_counter()
+	while True:
+		for user_id in ids:
+			render(user_id)
+		count += len(ids)
+		elapsed = time.perf_counter() - begin
+		if MIN_DURATION <= elapsed:
+			return elapsed / count
+
+# 1回のレンダリング中に確保したメモリの最大(先頭の100個のidの平均)
+def	peak_bytes(render, ids) -> float:
+	total = 0
+	samples = ids[:100]
+	tracemalloc.start()
+	for user_id in samples:
+		before = tracemalloc.get_traced_memory()[0]
+		tracemalloc.reset_peak()
+		render(user_id)
+		total += tracemalloc.get_traced_memory()[1] - before
+	tracemalloc.stop()
+	return total / len(samples)
+
+def	main():
+	logging.disable(logging.CRITICAL)
+	kinds = [int(n) for n in sys.argv[1].split(',')] if 1 < len(sys.argv) else [1, 100, 10000]
+	print(f'{"ids":>7}{"path":>10}{"us/render":>11}{"peak bytes":>12}')
+	for kind in kinds:
+		ids = [f'user{n}' if n % 3 else f'<user&{n}>' for n in range(kind)]
+		template = Template('bench', SOURCE)
+		assert legacy(ids[-1]) == template.render(user_id=ids[-1])
+
+		cases = (
+			('legacy', legacy),
+			('template', lambda user_id: template.render(user_id=user_id))
+		)
+		for name, render in cases:
+			elapsed = measure(render, ids)
+			peak = peak_bytes(render, ids)
+			print(f'{kind:>7}{name:>10}{elapsed * 1e6:>11.3f}{peak:>12.0f}')
+	return 0
+
+if __name__ == '__main__':
+	sys.exit(main())
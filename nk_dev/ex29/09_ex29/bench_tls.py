@@ -0,0 +1,149 @@
+#!/usr/bin/env python3
+
+import os
+import ssl
+import sys
+import json
+import time
+import socket
+import tempfile
+import subprocess
+from pathlib import Path
+
+import tls
+from bench_common import SERVER, HOST
+
+"""
+	TLSのフルハンドシェイクとセッション再開の比較
+
+	使い方: bench_tls.py [モード,...] [秒数]
+		例) bench_tls.py thread,pool,async 3
+
+	一時ディレクトリに自己署名証明書(tls.generate_self_signed、ECDSA P-256)と設定ファイル(SERVER_CONFIG)を作り、
+	モードごとにサーバーを子プロセスとして起動して、TLS 1.3 / TLS 1.2 のそれぞれで
+		full	- 毎回セッションを持たずに接続する(証明書の検証・署名・鍵交換を毎回行う)
+		resumed	- 前の接続で受け取ったセッション(チケット)を渡して接続する
+	を[秒数]ずつ、1本のクライアントで繰り返す。1回は 接続 → ハンドシェイク → GET /about(Connection: close)→ 閉じる
+		conn/s		- 1秒あたりの接続数(ハンドシェイク + 1リクエスト)
+		hs ms		- クライアントから見たハンドシェイクの平均時間
+		resumed		- 実際に再開できた割合(SSLSocket.session_reused)
+	最後にサーバーの/__statsのtls(サーバー側で測ったハンドシェイクの平均時間、asyncモードは測らない)を出す
+
+	クライアントも同じマシンで動くので、1コアの環境では両方の暗号処理の合計を測っていることになる
+"""
+
+PORT = 8095
+TIMEOUT = 10.0
+
+CONFIG = '''
+pid_file = "{pid_file}"
+access_log = false
+log_level = "WARNING"
+tls_cert = "{cert}"
+tls_key = "{key}"
+'''
+
+REQUEST = f'GET /about HTTP/1.1\r\nHost: localhost\r\nConnection: close\r\n\r\n'.encode('ascii')
+
+def	client_context(cert, version) -> ssl.SSLContext:
+	context = ssl.create_default_context(cafile=cert)
+	context.minimum_version = version
+	context.maximum_version = version
+	context.set_alpn_protocols(['http/1.1'])
+	return context
+
+# 1回の接続(戻り値: ハンドシェイクの秒数, 再開できたか, 次に使うセッション)
+def	connect(context, session):
+	with socket.create_connection((HOST, PORT), timeout=TIMEOUT) as raw:
+		# Nagleが有効だと、TLS 1.2の再開でFinishedとリクエストが別々の小さな書き込みになり、遅延ACKで約40ms止まる
+		raw.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+		begin = time.perf_counter()
+		with context.wrap_socket(raw, server_hostname='localhost', session=session) as sock:
+			elapsed = time.perf_counter() - begin
+			sock.sendall(REQUEST)
+			data = b''
+			while chunk := sock.recv(65536):
+				data += chunk
+			if not data.startswith(b'HTTP/1.1 200'):
+				raise RuntimeError(f'connect: unexpected response {data[:40]!r}')
+			# TLS 1.3のチケットはハンドシェイクの後に届くので、応答を読み終えてから取り出す
+			return elapsed, sock.session_reused, sock.session
+
+def	measure(context, resume, duration) -> dict:
+	session = None
+	if resume:
+		_, _, session = connect(context, None)		# 最初のチケットを受け取っておく
+	count = reused = 0
+	handshake = 0.0
+	begin = time.perf_counter()
+	while time.perf_counter() - begin < duration:
+		elapsed, was_reused, received = connect(context, session)
+		count += 1
+		reused += was_reused
+		handshake += elapsed
+		if resume:
+			session = received
+	total = time.perf_counter() - begin
+	return {'rate': count / total, 'handshake_ms': handshake / count * 1000, 'resumed': reused / count}
+
+def	server_stats(cert) -> dict:
+	context = ssl.create_default_context(cafile=cert)
+	request = REQUEST.replace(b'/about', b'/__stats')
+	with socket.create_connection((HOST, PORT), timeout=TIMEOUT) as raw:
+		with context.wrap_socket(raw, server_hostname='localhost') as sock:
+			sock.sendall(request)
+			data = b''
+			while chunk := sock.recv(65536):
+				data += chunk
+	return json.loads(data.partition(b'\r\n\r\n')[2])['tls']
+
+def	wait_ready(pid_file, pid) -> bool:
+	deadline = time.monotonic() + 10.0
+	while time.monotonic() < deadline:
+		try:
+			if int(Path(pid_file).read_text()) == pid:
+				return True
+		except (OSError, ValueError):
+			pass
+		time.sleep(0.05)
+	return False
+
+def	run_mode(mode, duration, workdir, cert, key) -> bool:
+	pid_file = workdir / f'{mode}.pid'
+	config_file = workdir / f'{mode}.toml'
+	log_file = workdir / f'{mode}.log'
+	config_file.write_text(CONFIG.format(pid_file=pid_file, cert=cert, key=key))
+	env = dict(os.environ, SERVER_CONFIG=str(config_file))
+	with open(log_file, 'wb') as log:
+		proc = subprocess.Popen([sys.executable, str(SERVER), mode, str(PORT)], env=env, stdout=log, stderr=log)
+	try:
+		if not wait_ready(pid_file, proc.pid):
+			print(f'--- {mode}: server did not start, see {log_file}')
+			return False
+		for name, version in (('TLSv1.3', ssl.TLSVersion.TLSv1_3), ('TLSv1.2', ssl.TLSVersion.TLSv1_2)):
+			context = client_context(cert, version)
+			full = measure(context, False, duration)
+			resumed = measure(context, True, duration)
+			for kind, result in (('full', full), ('resumed', resumed)):
+				print(
+					f'{mode:>8}{name:>9}{kind:>9}{result["rate"]:>9.1f}{result["handshake_ms"]:>8.2f}'
+					f'{result["resumed"] * 100:>8.0f}%'
+				)
+			print(f'{"":>26}resumed / full: {resumed["rate"] / full["rate"]:.2f}x conn/s')
+		print(f'  server: {server_stats(cert)}')
+	finally:
+		proc.terminate()
+		proc.wait()
+	return True
+
+def	main():
+	modes = sys.argv[1].split(',') if 1 < len(sys.argv) else ['thread', 'pool', 'async']
+	duration = float(sys.argv[2]) if 2 < len(sys.argv) else 3.0
+	workdir = Path(tempfile.mkdtemp(prefix='bench_tls_'))
+	cert, key = tls.generate_self_signed(workdir)
+	print(f'{"mode":>8}{"version":>9}{"kind":>9}{"conn/s":>9}{"hs ms":>8}{"resumed":>9}')
+	results = [run_mode(mode, duration, workdir, cert, key) for mode in modes]
+	return 0 if all(results) else 1
+
+if __name__ == '__main__':
+	sys.exit(main())
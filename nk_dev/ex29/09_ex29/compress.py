@@ -0,0 +1,85 @@
+import gzip
+
+import config
+
+try:
+	import brotli
+except ImportError:
+	brotli = None
+
+try:
+	import zstandard
+except ImportError:
+	zstandard = None
+
+"""
+	Accept-Encodingによる圧縮
+	compress.py:
+		- is_compressible関数
+		- negotiate関数
+		- compress関数
+		- encoded_etag関数
+
+	gzipは標準ライブラリ、brotli / zstdはモジュールが入っている時だけその場で圧縮する
+	(static/の.br / .zstの圧縮済みファイルはモジュールがなくてもそのまま送れる)
+"""
+
+# サーバー側の優先順(同じqなら前にあるものを選ぶ)
+PREFERENCE = ('br', 'zstd', 'gzip')
+SUFFIXES = {'br': '.br', 'zstd': '.zst', 'gzip': '.gz'}		# 圧縮済みファイルの拡張子
+CODINGS = tuple(coding for coding, module in (('br', brotli), ('zstd', zstandard), ('gzip', gzip)) if module)
+
+COMPRESSIBLE_TYPES = (
+	'application/json',
+	'application/javascript',
+	'application/xml',
+	'image/svg+xml'
+)
+
+# テキスト系だけを圧縮する(jpegなどは圧縮しても小さくならない)
+def	is_compressible(content_type: str) -> bool:
+	mime_type = content_type.split(';')[0].strip().lower()
+	return mime_type.startswith('text/') or mime_type in COMPRESSIBLE_TYPES
+
+# Accept-Encodingからcandidatesのうち最もqの高いものを選ぶ、なければNone
+# (q=0は拒否、*は明示されていないもの全て)
+def	negotiate(accept_encoding: str | None, candidates) -> str | None:
+	if not accept_encoding or not candidates:
+		return None
+	weights = {}
+	for item in accept_encoding.split(','):
+		coding, _, params = item.strip().partition(';')
+		coding = coding.strip().lower()
+		q = 1.0
+		params = params.strip()
+		if params.startswith('q='):
+			try:
+				q = float(params[2:])
+			except ValueError:
+				q = 0.0
+		if coding == 'x-gzip':
+			coding = 'gzip'
+		weights[coding] = q
+
+	best = None
+	best_q = 0.0
+	for coding in PREFERENCE:
+		if coding not in candidates:
+			continue
+		q = weights.get(coding, weights.get('*', 0.0))
+		if best_q < q:
+			best, best_q = coding, q
+	return best
+
+def	compress(body: bytes, coding: str) -> bytes:
+	if coding == 'gzip':
+		return gzip.compress(body, compresslevel=config.GZIP_LEVEL, mtime=0)
+	if coding == 'br':
+		return brotli.compress(body, quality=config.BROTLI_QUALITY)
+	if coding == 'zstd':
+		return zstandard.ZstdCompressor(level=config.ZSTD_LEVEL).compress(body)
+	raise ValueError(f'compress: unknown coding {coding}')
+
+# 圧縮したものは別の表現なので、ETagも変える
+def	encoded_etag(etag: str, coding: str) -> str:
+	return f'{etag[:-1]}-{coding}"'
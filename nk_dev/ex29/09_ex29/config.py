@@ -1,13 +1,195 @@
+import os
+import sys
+import json
+import queue
+import tomllib
+import atexit
 import logging
+import logging.handlers
+
+# 整形(format)はQueueListenerのスレッドで行い、呼び出し側はキューに入れるだけにする
+# (同じプロセス内で渡すので、標準のprepareのように先に文字列にしておく必要はない)
+class DeferredQueueHandler(logging.handlers.QueueHandler):
+	def	prepare(self, record):
+		return record
+
+# accessロガーには辞書を渡すので、JSONの1行にする
+class AccessFormatter(logging.Formatter):
+	def	format(self, record):
+		entry = {'time': self.formatTime(record, '%Y-%m-%dT%H:%M:%S')}
+		entry.update(record.msg)
+		return json.dumps(entry, ensure_ascii=False)
+
+listener = None
 
 def	setup_logging():
-	logging.basicConfig(
-		level=logging.DEBUG,
-		format='%(levelname)s - %(message)s'
-	)
+	global listener
+	if listener is not None:
+		return
+	log_queue = queue.SimpleQueue()
+
+	server_handler = logging.StreamHandler()
+	server_handler.setFormatter(logging.Formatter('%(levelname)s - %(message)s'))
+	server_handler.addFilter(lambda record: record.name != 'access')
+	if ACCESS_LOG:
+		access_handler = logging.FileHandler(ACCESS_LOG, encoding='utf-8')
+	else:
+		access_handler = logging.StreamHandler(sys.stdout)
+	access_handler.setFormatter(AccessFormatter())
+	access_handler.addFilter(logging.Filter('access'))
+
+	root = logging.getLogger()
+	root.setLevel(LOG_LEVEL)
+	root.addHandler(DeferredQueueHandler(log_queue))
+	access_logger = logging.getLogger('access')
+	access_logger.propagate = False
+	access_logger.addHandler(DeferredQueueHandler(log_queue))
+	access_logger.setLevel(logging.INFO if ACCESS_LOG is not None else logging.CRITICAL)
+
+	listener = logging.handlers.QueueListener(log_queue, server_handler, access_handler, respect_handler_level=True)
+	listener.start()
+	atexit.register(stop_logging)		# 終了時にキューに残っている分を書き出す
+
+# forkした子プロセスには書き込みのスレッドが引き継がれないので、キューごと作り直す
+def	restart_logging():
+	global listener
+	if listener is None:
+		return
+	log_queue = queue.SimpleQueue()
+	for logger in (logging.getLogger(), logging.getLogger('access')):
+		for handler in logger.handlers:
+			if isinstance(handler, DeferredQueueHandler):
+				handler.queue = log_queue
+	listener = logging.handlers.QueueListener(log_queue, *listener.handlers, respect_handler_level=True)
+	listener.start()
+
+# キューに残っている分を書き出してスレッドを止める(os._exitの前はatexitが動かないので直接呼ぶ)
+def	stop_logging():
+	if listener is not None and listener._thread is not None:
+		listener.stop()
+
+os.register_at_fork(after_in_child=restart_logging)
 
 LOCAL_HOST = '127.0.0.1'
 BUFFER_SIZE = 4096
 MAX_READ = 10 * 1024 * 1024
 TIMEOUT_INT = 30.0
 PORT = 8080
+BACKLOG = 1024			# listen()の接続待ちキュー長
+SERVER_MODE = 'thread'	# 'thread', 'event', 'pool', 'async', 'prefork'
+KEEPALIVE_TIMEOUT = TIMEOUT_INT / 6	# keep-alive中、次のリクエストを待つ秒数
+MAX_KEEPALIVE_REQUESTS = 100		# 1接続で処理するリクエストの上限
+MAX_UPLOAD = 1024 * 1024 * 1024		# multipart/form-dataのボディ上限(ディスクへ書き出す)
+SPOOL_THRESHOLD = 1024 * 1024		# アップロードファイルがこれを超えたら一時ファイルへ
+MAX_PART_HEADER = 16 * 1024			# multipartの各パートのヘッダー上限
+STATIC_CACHE_ENTRIES = 256				# 静的ファイルキャッシュの件数上限
+STATIC_CACHE_BYTES = 64 * 1024 * 1024	# 静的ファイルキャッシュの合計サイズ上限
+STATIC_CACHE_MAX_FILE = 256 * 1024		# これより大きいファイルはキャッシュせずsendfileで送る
+MAX_RANGES = 16						# 1リクエストで受け付けるRangeの数
+RESPONSE_CACHE_ENTRIES = 1024			# cacheableなハンドラーのレスポンスキャッシュの件数上限
+POOL_WORKERS = 32					# poolモードのワーカースレッド数
+POOL_QUEUE = 128					# poolモードの受付キューの長さ(あふれたら503)
+RETRY_AFTER = 1						# 503で返すRetry-After(秒)
+PREFORK_WORKERS = 0					# preforkモードのワーカープロセス数(0なら/proc/cpuinfoのsiblingsから決める)
+PREFORK_REUSEPORT = True			# Trueならワーカーごとに SO_REUSEPORT でbind、Falseなら親のソケットを受け継ぐ
+DRAIN_TIMEOUT = TIMEOUT_INT			# 終了・入れ替え時に処理中の接続を待つ秒数
+LOG_LEVEL = logging.INFO			# DEBUGにするとリクエストの詳細(print_request)も出す
+ACCESS_LOG = ''						# アクセスログの出力先(''なら標準出力、Noneなら出さない)
+COMPRESS_MIN_SIZE = 1024			# これより小さいボディは圧縮しない
+GZIP_LEVEL = 6						# gzipの圧縮レベル(1〜9)
+BROTLI_QUALITY = 5					# brotliの品質(0〜11、モジュールがある時だけ)
+ZSTD_LEVEL = 3						# zstdのレベル(モジュールがある時だけ)
+STREAM_CHUNK = 16 * 1024			# ストリーミングするボディを1チャンクにまとめる大きさ
+HEADER_CACHE_ENTRIES = 512			# 組み立て済みのヘッダー行(Content-Typeなど値の種類が少ないもの)のキャッシュ件数
+HEADER_TIMEOUT = 10.0				# リクエストの開始(1件目は接続)からヘッダーの終わりまでの上限秒数(超えたら408)
+BODY_GRACE = 5.0					# ボディの受信開始からこの秒数は転送速度を問わない
+MIN_BODY_RATE = 1024				# ボディの最低転送速度(バイト/秒)、これより遅ければ408
+MAX_HEADER_SIZE = 16 * 1024			# リクエスト行とヘッダーの合計の上限(超えたら431)
+MAX_HEADER_COUNT = 100				# ヘッダーの行数の上限(超えたら431)
+MAX_URL_LENGTH = 8 * 1024			# リクエスト行(URL)の長さの上限(超えたら414)
+MAX_CONNECTIONS_PER_IP = 64			# 1つのIPアドレスからの同時接続数の上限(超えたら503、preforkではワーカーごと)
+RESTART_TIMEOUT = 10.0				# SIGUSR2で起動した新しいプロセスの準備を待つ秒数(過ぎたら再起動をやめる)
+PID_FILE = ''						# 受付を始めたプロセスのpidを書き出すファイル(''なら書かない)
+TLS_CERT = ''						# TLSの証明書(PEM、''なら平文のHTTP、thread / pool / asyncモードのみ)
+TLS_KEY = ''						# TLSの秘密鍵(PEM、''なら証明書のファイルに含まれているもの)
+TLS_ALPN = 'http/1.1'				# ALPNで交渉するプロトコル(カンマ区切り、優先順)
+TLS_TICKETS = 2						# TLS 1.3でハンドシェイクの後に送るセッションチケットの枚数(0なら再開しない)
+
+# 上の値は設定ファイル(TOML)で上書きできる
+#	ファイル: 環境変数SERVER_CONFIG、なければこのファイルと同じディレクトリのconfig.toml(なければ上の値のまま)
+#	キーは上の名前(大文字・小文字は問わない)、LOG_LEVELは'DEBUG'などの名前でもよい、ACCESS_LOG = false でNone
+CONFIG_FILE = os.environ.get('SERVER_CONFIG') or os.path.join(os.path.dirname(os.path.abspath(__file__)), 'config.toml')
+
+# SIGHUPで読み直して動作中のプロセスに反映する値(使う時に毎回config.Xを読むもの)
+# それ以外(ポート・ワーカー数・キャッシュの大きさなど)は起動時だけ読むので、変えたら再起動(SIGUSR2)する
+RELOADABLE = frozenset({
+	'BUFFER_SIZE', 'MAX_READ', 'TIMEOUT_INT', 'KEEPALIVE_TIMEOUT', 'MAX_KEEPALIVE_REQUESTS',
+	'MAX_UPLOAD', 'SPOOL_THRESHOLD', 'MAX_PART_HEADER', 'MAX_RANGES', 'DRAIN_TIMEOUT', 'LOG_LEVEL',
+	'COMPRESS_MIN_SIZE', 'GZIP_LEVEL', 'BROTLI_QUALITY', 'ZSTD_LEVEL', 'STREAM_CHUNK',
+	'HEADER_TIMEOUT', 'BODY_GRACE', 'MIN_BODY_RATE', 'MAX_HEADER_SIZE', 'MAX_HEADER_COUNT',
+	'MAX_URL_LENGTH', 'MAX_CONNECTIONS_PER_IP', 'RESTART_TIMEOUT'
+})
+
+# 設定ファイルの1項目を検証し、今の値と同じ型にして返す(不正ならValueError)
+def	convert_value(label, value):
+	current = globals()[label]
+	if label == 'LOG_LEVEL' and isinstance(value, str):
+		value = logging.getLevelName(value.upper())		# 知らない名前は'Level X'という文字列になる
+	if label == 'ACCESS_LOG' and value is False:
+		return None
+	if isinstance(current, bool):
+		valid = isinstance(value, bool)
+	elif isinstance(current, int):
+		valid = isinstance(value, int) and not isinstance(value, bool) and 0 <= value
+	elif isinstance(current, float):
+		valid = isinstance(value, (int, float)) and not isinstance(value, bool) and 0 < value
+		value = float(value) if valid else value
+	else:
+		valid = isinstance(value, str)
+	if not valid:
+		raise ValueError(f'{label} = {value!r} ({type(current).__name__} expected)')
+	return value
+
+# 設定ファイルを読んで上の値を上書きする(戻り値は0、読めない・不正な値があれば-1で何も変えない)
+# reload: SIGHUPからの読み直し、RELOADABLEにない値の変更は無視して警告する
+def	load_config(reload=False) -> int:
+	try:
+		with open(CONFIG_FILE, 'rb') as file:
+			values = tomllib.load(file)
+	except FileNotFoundError:
+		if reload or 'SERVER_CONFIG' in os.environ:
+			logging.error(f'load_config: {CONFIG_FILE} not found')
+			return -1
+		return 0
+	except (OSError, tomllib.TOMLDecodeError) as e:
+		logging.error(f'load_config: Cannot read {CONFIG_FILE}: {e}')
+		return -1
+
+	updates = {}
+	try:
+		for label, value in values.items():
+			label = label.upper()
+			if label not in globals() or not label.isupper() or label in ('CONFIG_FILE', 'RELOADABLE') or callable(globals()[label]):
+				raise ValueError(f'unknown setting {label}')
+			value = convert_value(label, value)
+			if value == globals()[label]:
+				continue
+			if reload and label not in RELOADABLE:
+				logging.warning(f'load_config: {label} cannot be reloaded, restart (SIGUSR2) to apply it')
+				continue
+			updates[label] = value
+	except ValueError as e:
+		logging.error(f'load_config: {CONFIG_FILE}: {e}')
+		return -1
+
+	globals().update(updates)
+	if 'LOG_LEVEL' in updates and listener is not None:
+		logging.getLogger().setLevel(LOG_LEVEL)
+	if reload:
+		changed = ', '.join(f'{label}={value!r}' for label, value in updates.items()) or 'no changes'
+		logging.info(f'load_config: reloaded {CONFIG_FILE} ({changed})')
+	return 0
+
+# 起動時に読めなければ、意図しない設定で動き出さないよう止める(SIGUSR2の再起動なら古いプロセスが動き続ける)
+if load_config() == -1:
+	raise SystemExit(f'config: invalid config file {CONFIG_FILE}')
@@ -0,0 +1,88 @@
+import asyncio
+import inspect
+
+from http import Request
+from route import Response, router, static_search, static_exists, head_response, handle_post_method, compress_response
+from error import handle_404, handle_405
+
+"""
+	リクエストからレスポンスを決定するファイル
+	dispatch.py:
+		- dispatch関数(thread / event / poolモード)
+		- dispatch_async関数(asyncモード)
+
+	どのモードでも同じ router → static_search → 404 の流れを共有する
+	静的ファイルはGETとHEAD(同じヘッダーでボディなし)で返し、それ以外のメソッドには405を返す
+	ルートを先に引くので、動的なページではファイルシステムを見に行かない
+	async defのハンドラーは、dispatchではasyncio.runで、dispatch_asyncではawaitで実行する
+	最後にprepare_responseでAccept-Encodingに応じた圧縮などを行う
+"""
+
+STATIC_METHODS = ('GET', 'HEAD')
+
+# ルーターとPOSTの処理
+# 静的ファイル・404へ進む場合はNone、async defのハンドラーならコルーチンを返す
+def	find_response(request_obj: Request):
+	# ルーターからハンドラーを探す
+	found = router.find(request_obj.path)
+	request_obj.timer.mark('route')
+	if found:
+		handlers, kwargs, request_obj.route = found
+		handler = handlers.get(request_obj.method)
+		if handler:
+			kwargs['request_obj'] = request_obj	# Requestを使うハンドラーのために辞書に追加
+			return handler(**kwargs)
+		# POSTは従来どおり入力内容をミラーする
+		if request_obj.method != 'POST':
+			return handle_405(tuple(handlers))
+
+	# POSTならhandle_post関数でレスポンス
+	if request_obj.method == 'POST':
+		request_obj.route = 'POST'
+		return handle_post_method(request_obj)
+	return None
+
+# 静的ファイルの捜索、見つからなければ404
+def	find_static(request_obj: Request) -> Response:
+	if request_obj.method in STATIC_METHODS:
+		static_data = static_search(request_obj.path, request_obj)
+		if static_data:
+			request_obj.route = 'static'
+			if request_obj.method == 'HEAD':
+				return head_response(static_data)
+			return static_data
+	elif static_exists(request_obj.path):
+		request_obj.route = 'static'
+		return handle_405(STATIC_METHODS)
+
+	# ハンドラーも見つからなければ404処理
+	request_obj.route = '404'
+	return handle_404()
+
+# 圧縮、HTTP/1.0へのストリーミング(chunkedを使わない)
+def	prepare_response(response_obj: Response, request_obj: Request) -> Response:
+	response_obj = compress_response(response_obj, request_obj)
+	if response_obj.is_stream() and request_obj.version != 'HTTP/1.1':
+		response_obj.unchunk()
+	return response_obj
+
+def	dispatch(request_obj: Request) -> Response:
+	response_obj = find_response(request_obj)
+	if inspect.iscoroutine(response_obj):
+		response_obj = asyncio.run(response_obj)
+	if response_obj is None:
+		response_obj = find_static(request_obj)
+	response_obj = prepare_response(response_obj, request_obj)
+	request_obj.timer.mark('render')
+	return response_obj
+
+# 静的ファイルはstatや読み込みでイベントループを止めないよう、スレッドで探す
+async def	dispatch_async(request_obj: Request) -> Response:
+	response_obj = find_response(request_obj)
+	if inspect.iscoroutine(response_obj):
+		response_obj = await response_obj
+	if response_obj is None:
+		response_obj = await asyncio.to_thread(find_static, request_obj)
+	response_obj = prepare_response(response_obj, request_obj)
+	request_obj.timer.mark('render')
+	return response_obj
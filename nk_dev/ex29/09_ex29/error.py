@@ -1,6 +1,12 @@
-from route import Response, create_html
+from route import Response, create_html, prerendered
 
+"""
+	エラーレスポンスは@prerenderedで引数ごとに一度だけ作り、
+	以降はエンコード済みのバイト列をそのまま返す
+"""
 
+
+@prerendered
 def	handle_400():
 	title = '400 Bad Request'
 	h1 = '400 Bad Request'
@@ -19,6 +25,7 @@ def	handle_400():
 		body=body
 	)
 
+@prerendered
 def	handle_404():
 	title = '404 Not Found'
 	h1 = '404 Not Found'
@@ -37,6 +44,27 @@ def	handle_404():
 		body=body
 	)
 
+@prerendered
+def	handle_405(allowed):
+	title = '405 Method Not Allowed'
+	h1 = '405 Method Not Allowed'
+	content = '\t<p>405 Method Not Allowed</p>\n'
+
+	body = create_html(title, h1, content)
+	length = len(body.encode('utf-8', errors='replace'))
+
+	return Response(
+		status=405,
+		reason='Method Not Allowed',
+		headers={
+			'Content-Type': 'text/html; charset=utf-8',
+			'Content-Length': length,
+			'Allow': ', '.join(allowed)
+		},
+		body=body
+	)
+
+@prerendered
 def handle_408():
 	title = '408 Request Timeout'
 	h1 = '408 Request Timeout'
@@ -55,6 +83,7 @@ def handle_408():
 		body=body
 	)
 
+@prerendered
 def	handle_500():
 	title = '500 Internal Server Error'
 	h1 = '500 Internal Server Error'
@@ -72,3 +101,91 @@ def	handle_500():
 		},
 		body=body
 	)
+
+@prerendered
+def	handle_503(retry_after):
+	title = '503 Service Unavailable'
+	h1 = '503 Service Unavailable'
+	content = '\t<p>503 Service Unavailable</p>\n'
+
+	body = create_html(title, h1, content)
+	length = len(body.encode('utf-8', errors='replace'))
+
+	return Response(
+		status=503,
+		reason='Service Unavailable',
+		headers={
+			'Content-Type': 'text/html; charset=utf-8',
+			'Content-Length': length,
+			'Retry-After': retry_after
+		},
+		body=body
+	)
+
+@prerendered
+def	handle_413():
+	title = '413 Content Too Large'
+	h1 = '413 Content Too Large'
+	content = '\t<p>413 Content Too Large</p>\n'
+
+	body = create_html(title, h1, content)
+	length = len(body.encode('utf-8', errors='replace'))
+
+	return Response(
+		status=413,
+		reason='Content Too Large',
+		headers={
+			'Content-Type': 'text/html; charset=utf-8',
+			'Content-Length': length
+		},
+		body=body
+	)
+
+@prerendered
+def	handle_414():
+	title = '414 URI Too Long'
+	h1 = '414 URI Too Long'
+	content = '\t<p>414 URI Too Long</p>\n'
+
+	body = create_html(title, h1, content)
+	length = len(body.encode('utf-8', errors='replace'))
+
+	return Response(
+		status=414,
+		reason='URI Too Long',
+		headers={
+			'Content-Type': 'text/html; charset=utf-8',
+			'Content-Length': length
+		},
+		body=body
+	)
+
+@prerendered
+def	handle_431():
+	title = '431 Request Header Fields Too Large'
+	h1 = '431 Request Header Fields Too Large'
+	content = '\t<p>431 Request Header Fields Too Large</p>\n'
+
+	body = create_html(title, h1, content)
+	length = len(body.encode('utf-8', errors='replace'))
+
+	return Response(
+		status=431,
+		reason='Request Header Fields Too Large',
+		headers={
+			'Content-Type': 'text/html; charset=utf-8',
+			'Content-Length': length
+		},
+		body=body
+	)
+
+# 読めなかったリクエストへの応答
+# status: LimitExceededのステータス(request_obj.error)、それ以外(None)は400
+def	handle_rejected(status=None):
+	if status == 413:
+		return handle_413()
+	if status == 414:
+		return handle_414()
+	if status == 431:
+		return handle_431()
+	return handle_400()
@@ -0,0 +1,473 @@
+import os
+import time
+import signal
+import socket
+import logging
+import selectors
+
+import config
+from http import Request, MultipartParser, has_body, parse_header, parse_body, print_request, wants_keep_alive, decode_chunked
+from route import log_routes, set_connection_header, response_cache, FileResponse, IOV_MAX, advance_buffers
+from error import handle_408, handle_431, handle_500, handle_503, handle_rejected
+from dispatch import dispatch
+from static_cache import static_cache
+from metrics import metrics, finish_request
+from limits import LimitExceeded, RequestBudget, connection_limiter
+from worker_pool import shed
+from restart import Handoff, inherited_listener, notify_ready
+
+"""
+	selectors(Linuxではepoll)によるノンブロッキングサーバー
+	event_server.py:
+		- Connectionクラス(接続ごとの状態機械)
+		- create_listener関数
+		- drain関数(シグナルハンドラーから呼ぶ)
+		- run_event_server関数
+
+	状態遷移:
+		READ_HEADER -> READ_BODY -> WRITE -> CLOSED
+		(GETなどボディがなければ READ_HEADER -> WRITE)
+		(keep-aliveなら WRITE -> READ_HEADER に戻り、バッファ済みの次のリクエストを処理)
+
+	1スレッドで全接続を多重化するので、接続数が増えてもスレッドスタックは増えない
+	リクエストの解釈は http.py の parse_header / parse_body、
+	レスポンスの決定は dispatch.py の dispatch をスレッドモードと共有する
+
+	1リクエストの期限はlimits.RequestBudgetで管理し、sweep_idleが1秒ごとに確認して408を返す
+	同じIPアドレスからの接続がMAX_CONNECTIONS_PER_IPを超えたらacceptしてすぐ503で閉じる
+
+	drain()が呼ばれると新しい接続の受付をやめ、処理中の接続を終えてから(最長DRAIN_TIMEOUT)
+	run_event_serverから戻る(preforkのワーカーの終了・入れ替え、SIGUSR2での再起動で使う)
+	単独で動かす時はSIGHUPで設定を読み直し、SIGUSR2で新しいプロセスへ受付を引き継いでからdrainする
+"""
+
+READ_HEADER = 'READ_HEADER'
+READ_BODY = 'READ_BODY'
+WRITE = 'WRITE'
+CLOSED = 'CLOSED'
+
+draining = False
+counters = {'connections': 0, 'requests': 0}
+
+class Connection:
+	def	__init__(self, client_socket, client_address):
+		self.client_socket = client_socket
+		self.address = client_address
+		self.state = READ_HEADER
+		self.buffer = bytearray()
+		self.scan = 0		# ヘッダー終端の探索を再開する位置
+		self.request_obj = Request()
+		self.body_length = 0
+		self.multipart = None
+		self.views = []		# 送信待ちのバッファ(sendmsgでまとめて送る)
+		self.frames = None		# ストリーミングのボディの残り(Response.frames)
+		self.file = None		# FileResponseの送信中に開いているファイル
+		self.segments = []
+		self.served = 0
+		self.keep_alive = False
+		self.last_active = time.monotonic()
+		self.budget = RequestBudget()		# 1件目は接続した時から数える
+		self.accepted = time.perf_counter()	# 最初のデータが届くまではaccept段階として計測
+		self.response_obj = None
+
+	# 受信したバイト列を状態に応じて処理する
+	# レスポンスが決まったらWRITE状態へ移行
+	def	feed(self, data: bytes):
+		if self.state == READ_HEADER and not self.buffer and data:
+			# リクエストの最初のバイトから計測する(keep-aliveの待ち時間は含めない)
+			if self.accepted is not None:
+				metrics.record_accept(time.perf_counter() - self.accepted)
+				self.accepted = None
+			else:
+				self.budget.restart()
+			self.request_obj.timer.restart()
+		self.buffer += data
+		self.last_active = time.monotonic()
+		if self.state == READ_BODY:
+			self.budget.add(len(data))
+
+		if self.state == READ_HEADER:
+			# 前回探した範囲は飛ばす(末尾3バイトはチャンクをまたぐ終端のために含める)
+			header_end = self.buffer.find(b'\r\n\r\n', max(0, self.scan - 3))
+			if header_end == -1:
+				self.scan = len(self.buffer)
+				if config.MAX_HEADER_SIZE < len(self.buffer):
+					logging.error('feed/Connection: Request header is too long')
+					self.set_response(handle_431())
+				return
+
+			headers = bytes(self.buffer[:header_end])
+			del self.buffer[:header_end + 4]		# ボディ部分だけを残す
+			self.scan = 0
+			try:
+				result = parse_header(headers, self.request_obj)
+			except LimitExceeded as e:
+				logging.error(f'parse_header/Connection: {e}')
+				self.set_response(handle_rejected(e.status))
+				return
+			self.request_obj.timer.mark('header')
+			if result == -1:
+				logging.error('parse_header/Connection: returned error')
+				self.set_response(handle_rejected())
+				return
+
+			if self.request_obj.method == 'GET' or not has_body(self.request_obj):
+				self.respond()
+				return
+
+			if not self.request_obj.chunked:
+				self.body_length = int(self.request_obj.length)
+				# multipartは届いた分からパーサーへ渡してバッファを空ける
+				if self.request_obj.type == 'multipart/form-data;':
+					self.multipart = MultipartParser(self.request_obj.boundary)
+			self.state = READ_BODY
+			self.budget.start_body()
+
+		if self.state == READ_BODY and self.multipart:
+			length = min(len(self.buffer), self.body_length)
+			try:
+				with memoryview(self.buffer) as view:
+					self.multipart.feed(view[:length])
+			except ValueError:
+				logging.exception('feed/Connection: Invalid multipart body')
+				self.multipart.close()
+				self.set_response(handle_rejected())
+				return
+			del self.buffer[:length]
+			self.body_length -= length
+			if self.body_length:
+				return
+			if not self.multipart.close():
+				logging.error('feed/Connection: multipart body is not terminated')
+				self.set_response(handle_rejected())
+				return
+			self.request_obj.body = self.multipart.parts
+			self.respond()
+			return
+
+		if self.state == READ_BODY and self.request_obj.chunked:
+			try:
+				decoded = decode_chunked(self.buffer)
+			except LimitExceeded as e:
+				logging.error(f'decode_chunked/Connection: {e}')
+				self.set_response(handle_rejected(e.status))
+				return
+			except ValueError:
+				logging.error('decode_chunked/Connection: Invalid chunked body')
+				self.set_response(handle_rejected())
+				return
+			if decoded is None:
+				return
+			body_part, consumed = decoded
+			del self.buffer[:consumed]
+			self.request_obj.length = str(len(body_part))
+			self.parse_and_respond(body_part)
+			return
+
+		if self.state == READ_BODY and self.body_length <= len(self.buffer):
+			body_part = bytes(self.buffer[:self.body_length])
+			del self.buffer[:self.body_length]	# 次のリクエストの分だけを残す
+			self.parse_and_respond(body_part)
+
+	def	parse_and_respond(self, body_part):
+		try:
+			if parse_body(body_part, self.request_obj) == -1:
+				raise ValueError('parse_body returned error')
+		except ValueError:
+			logging.exception('parse_body/Connection: Invalid request body')
+			self.set_response(handle_rejected())
+			return
+		self.respond()
+
+	# リクエストが揃ったらdispatchでレスポンスを決定
+	def	respond(self):
+		if self.state == READ_BODY:
+			self.request_obj.timer.mark('body')
+		self.served += 1
+		try:
+			print_request(self.request_obj)
+			counters['requests'] += 1
+			self.keep_alive = wants_keep_alive(self.request_obj) and \
+				self.served < config.MAX_KEEPALIVE_REQUESTS and not draining
+			response_obj = dispatch(self.request_obj)
+			self.keep_alive = set_connection_header(response_obj, self.keep_alive)
+			self.set_response(response_obj)
+		except Exception:
+			logging.exception('Exception respond/Connection:')
+			self.keep_alive = False
+			self.set_response(handle_500())
+
+	# keep-alive後、次のリクエストのために状態を初期化
+	# パイプラインで届いている分があればそのまま処理する
+	def	reset(self):
+		self.request_obj.close()		# アップロードの一時ファイルを削除
+		self.close_file()
+		self.state = READ_HEADER
+		self.request_obj = Request()
+		self.scan = 0
+		self.body_length = 0
+		self.multipart = None
+		self.views = []
+		self.frames = None
+		self.keep_alive = False
+		self.response_obj = None
+		self.budget.restart()		# パイプラインで届いている次のリクエストの期限
+		if self.buffer:
+			self.feed(b'')
+
+	def	set_response(self, response_obj):
+		self.close_file()
+		self.response_obj = response_obj
+		self.frames = None
+		if isinstance(response_obj, FileResponse):
+			# ヘッダーを送った後、ボディはos.sendfileで送る
+			self.views = [memoryview(response_obj.head_bytes())]
+			self.file = open(response_obj.file_path, 'rb')
+			self.segments = list(response_obj.segments)
+		elif response_obj.is_stream():
+			# ソケットに書けた分だけ次のチャンクを作る(ボディ全体をメモリに持たない)
+			# ヘッダーはここで作り、不正ならrespondで500にする
+			self.frames = response_obj.frames()
+			self.views = [memoryview(buffer) for buffer in next(self.frames)]
+		else:
+			# ヘッダーとボディを連結せずsendmsgで送る
+			self.views = [memoryview(buffer) for buffer in response_obj.buffers() if buffer]
+		self.state = WRITE
+
+	def	close_file(self):
+		if self.file:
+			self.file.close()
+		self.file = None
+		self.segments = []
+
+	# 送れるだけ送り、全て送信したらTrueを返す
+	# ソケットが一杯になるとBlockingIOErrorで抜け、次のEVENT_WRITEで続きから送る
+	def	write(self) -> bool:
+		self.last_active = time.monotonic()
+		while True:
+			if self.views:
+				advance_buffers(self.views, self.client_socket.sendmsg(self.views[:IOV_MAX]))
+				continue
+			if self.frames is not None:
+				frame = next(self.frames, None)
+				if frame is None:
+					self.frames = None
+				else:
+					self.views = [memoryview(buffer) for buffer in frame if buffer]
+				continue
+			if not self.segments:
+				self.close_file()
+				return True
+
+			segment = self.segments[0]
+			if not isinstance(segment, tuple):
+				self.segments.pop(0)
+				self.views = [memoryview(segment)]
+				continue
+			# BlockingIOErrorの時はsegmentsを変えずに抜ける
+			offset, count = segment
+			sent = os.sendfile(self.client_socket.fileno(), self.file.fileno(), offset, count)
+			if sent == 0:
+				raise ConnectionError('write/Connection: file was truncated')
+			if sent < count:
+				self.segments[0] = (offset + sent, count - sent)
+			else:
+				self.segments.pop(0)
+
+
+def	close_connection(selector, conn):
+	if conn.state == CLOSED:
+		return
+	conn.state = CLOSED
+	connection_limiter.release(conn.address[0])
+	conn.request_obj.close()
+	conn.close_file()
+	try:
+		selector.unregister(conn.client_socket)
+	except (KeyError, ValueError):
+		pass
+	try:
+		conn.client_socket.close()
+	except OSError:
+		pass
+
+def	accept_clients(selector, server_socket):
+	# 1回の通知で溜まっている接続を全てaccept
+	while True:
+		try:
+			client_socket, client_address = server_socket.accept()
+		except BlockingIOError:
+			return
+		if not connection_limiter.acquire(client_address[0]):
+			logging.warning(f'accept_clients: too many connections from {client_address[0]}, 503')
+			shed(client_socket, handle_503(config.RETRY_AFTER).to_bytes())
+			continue
+		try:
+			client_socket.setblocking(False)
+			# keep-aliveやパイプラインで、ヘッダーとボディの小さな書き込みがNagleで遅延ACK待ちにならないようにする
+			client_socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+		except OSError as e:
+			logging.debug(f'accept_clients: {e}')		# acceptした直後に切られた場合
+			client_socket.close()
+			connection_limiter.release(client_address[0])
+			continue
+		logging.debug(f'accept_clients: Connection detected {client_address[0]}:{client_address[1]}')
+		counters['connections'] += 1
+		conn = Connection(client_socket, client_address)
+		selector.register(client_socket, selectors.EVENT_READ, conn)
+
+def	service_connection(selector, conn, mask):
+	try:
+		if mask & selectors.EVENT_READ and conn.state in (READ_HEADER, READ_BODY):
+			data = conn.client_socket.recv(config.BUFFER_SIZE)
+			if not data:
+				close_connection(selector, conn)
+				return
+			conn.feed(data)
+			if conn.state == WRITE:
+				selector.modify(conn.client_socket, selectors.EVENT_WRITE, conn)
+
+		if mask & selectors.EVENT_WRITE and conn.state == WRITE:
+			if conn.write():
+				finish_request(conn.request_obj, conn.response_obj, conn.address)
+				if not conn.keep_alive:
+					close_connection(selector, conn)
+					return
+				conn.reset()
+				if conn.state != WRITE:
+					selector.modify(conn.client_socket, selectors.EVENT_READ, conn)
+	except (BlockingIOError, InterruptedError):
+		return
+	except ConnectionError:
+		logging.exception('service_connection: Client connection error')
+		close_connection(selector, conn)
+	except Exception:
+		logging.exception('Exception service_connection:')
+		close_connection(selector, conn)
+
+# TIMEOUT_INTより長く動きのない接続、リクエストの期限(RequestBudget)を過ぎた接続に408を返す
+# keep-aliveで次のリクエストを待っているだけの接続はKEEPALIVE_TIMEOUTで静かに閉じる
+def	sweep_idle(selector):
+	now = time.monotonic()
+	for key in list(selector.get_map().values()):
+		conn = key.data
+		if conn is None or conn.state == WRITE:
+			continue
+		idle = now - conn.last_active
+		if conn.served and conn.state == READ_HEADER and not conn.buffer:
+			if config.KEEPALIVE_TIMEOUT < idle:
+				logging.debug('sweep_idle: keep-alive idle timeout')
+				close_connection(selector, conn)
+			continue
+		if config.TIMEOUT_INT < idle or conn.budget.deadline() < now:
+			logging.warning('sweep_idle: Client timeout')
+			conn.set_response(handle_408())
+			selector.modify(conn.client_socket, selectors.EVENT_WRITE, conn)
+
+# 処理中の接続を終えたら止まるよう指示する(シグナルハンドラーから呼べるようフラグを立てるだけ)
+def	drain():
+	global draining
+	draining = True
+
+# 受付をやめた後、keep-aliveで次のリクエストを待っているだけの接続は閉じる
+# 残っている接続がなくなればTrue
+def	sweep_drained(selector) -> bool:
+	remaining = 0
+	for key in list(selector.get_map().values()):
+		conn = key.data
+		if conn is None:
+			continue
+		if conn.served and conn.state == READ_HEADER and not conn.buffer:
+			close_connection(selector, conn)
+			continue
+		remaining += 1
+	return remaining == 0
+
+# reuse_port: 同じポートを複数のプロセスでbindし、カーネルに接続を振り分けさせる
+def	create_listener(host, port, backlog, reuse_port=False, listen=True) -> socket.socket:
+	server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+	server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+	if reuse_port:
+		server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+	server_socket.bind((host, port))
+	if listen:
+		server_socket.listen(backlog)
+	return server_socket
+
+def	stats(selector=None) -> dict:
+	active = 0
+	if selector is not None:
+		active = sum(1 for key in selector.get_map().values() if key.data is not None)
+	return {
+		'connections': counters['connections'],
+		'requests': counters['requests'],
+		'active': active,
+		'static_cache': static_cache.stats(),
+		'response_cache': response_cache.stats()
+	}
+
+# server_socket: 作成済みのリスニングソケット(preforkで親から受け継いだもの)
+# report: 1秒ごとにstatsを渡して呼ぶ関数(preforkで親へ送るため)
+def	run_event_server(host=config.LOCAL_HOST, port=config.PORT, backlog=config.BACKLOG,
+		server_socket=None, report=None):
+	handoff = None
+	if server_socket is None:
+		# preforkのワーカーでなければ、シグナルは自分で受ける
+		server_socket = inherited_listener() or create_listener(host, port, backlog)
+		handoff = Handoff()
+		signal.signal(signal.SIGHUP, lambda signum, frame: config.load_config(reload=True))
+		signal.signal(signal.SIGUSR2, handoff.request)
+	server_socket.setblocking(False)
+
+	selector = selectors.DefaultSelector()
+	selector.register(server_socket, selectors.EVENT_READ, None)	# data=Noneでリスニングソケットを区別
+
+	logging.info('')
+	logging.info(f'Event Server Listening {host}:{port} ({type(selector).__name__})')
+	log_routes()
+
+	last_sweep = time.monotonic()
+	deadline = None		# drain開始後、接続を強制的に閉じる時刻
+	if handoff is not None:
+		notify_ready()
+	if report:
+		report(stats(selector))		# 受付を始めたことを親に知らせる
+	try:
+		while True:
+			for key, mask in selector.select(timeout=1.0):
+				if key.data is None:
+					accept_clients(selector, server_socket)
+				else:
+					service_connection(selector, key.data, mask)
+
+			if handoff is not None and handoff.poll(server_socket):
+				drain()		# 新しいプロセスが受付を始めた
+			if draining:
+				if deadline is None:
+					# 接続待ちキューに溜まっている分は受け付けてから閉じる
+					logging.info('run_event_server: draining')
+					accept_clients(selector, server_socket)
+					selector.unregister(server_socket)
+					server_socket.close()
+					deadline = time.monotonic() + config.DRAIN_TIMEOUT
+				if sweep_drained(selector) or deadline < time.monotonic():
+					break
+
+			if 1.0 <= time.monotonic() - last_sweep:
+				sweep_idle(selector)
+				last_sweep = time.monotonic()
+				if report:
+					report(stats(selector))
+	except KeyboardInterrupt:
+		logging.info('Server closing')
+	finally:
+		for key in list(selector.get_map().values()):
+			if key.data is not None:
+				close_connection(selector, key.data)
+		selector.close()
+		server_socket.close()
+		if report:
+			report(stats())
+		logging.info(f'static cache: {static_cache.stats()}')
+		logging.info(f'response cache: {response_cache.stats()}')
+		logging.info('Server closed')
@@ -1,12 +1,29 @@
 import re
 import socket
 import logging
+import tempfile
 from urllib.parse import urlparse, parse_qs
 
 import config
+from metrics import StageTimer
+from limits import LimitExceeded, RequestBudget
 
 config.setup_logging()
 
+class Headers(dict):
+	# ヘッダー名の大文字・小文字を区別しない辞書(キーは小文字で保存)
+	def	__setitem__(self, key, value):
+		super().__setitem__(key.lower(), value)
+
+	def	__getitem__(self, key):
+		return super().__getitem__(key.lower())
+
+	def	__contains__(self, key):
+		return super().__contains__(key.lower())
+
+	def	get(self, key, default=None):
+		return super().get(key.lower(), default)
+
 class Request:
 	def	__init__(self):
 		self.method = None
@@ -15,8 +32,20 @@ class Request:
 		self.type = None
 		self.boundary = None
 		self.length = None
+		self.connection = None
+		self.chunked = False
+		self.headers = Headers()
 		self.query = {}
 		self.body = {}
+		self.route = None		# 計測用のラベル(ルートのパターン、static、404など)
+		self.error = None		# 読めなかった時に返すステータス(LimitExceededの413 / 414 / 431、Noneなら400)
+		self.timer = StageTimer()
+
+	# アップロードされたファイル(一時ファイル)を片付ける
+	def	close(self):
+		for detail in self.body.values():
+			if isinstance(detail, Part):
+				detail.close()
 
 def	parse_http(http_line: str, request_obj: Request) -> bool:
 	parts = http_line.split()
@@ -32,84 +61,555 @@ def	parse_http(http_line: str, request_obj: Request) -> bool:
 
 	return True
 
-def	get_form_data(body_part: bytes, request_obj: Request) -> int:
-	boundary_bytes = request_obj.boundary.encode('utf-8')	# body_partはバイト列なのでboundaryをエンコード
-	parts = body_part.split(boundary_bytes)					# エンコードしたboundaryでsplit
+# ヘッダー値の ; 区切りのパラメーター(name="x"; filename="y")を辞書にする
+# 値はクォートされていてもいなくてもよく、クォート内の ; や \" も扱う
+PARAM_PATTERN = re.compile(r';\s*([^\s=;]+)\s*=\s*("(?:[^"\\]|\\.)*"|[^;]*)')
 
-	for boundary_part in parts[1:]:							# 最初は"--"で始まるので飛ばす
-		line = boundary_part.split(b'\r\n\r\n')
-		line[0] = line[0].decode('utf-8', errors='replace').strip('\r\n')	# 正規表現を使うためにname=列だけデコード
+def	parse_params(value: str) -> dict:
+	params = {}
+	for label, detail in PARAM_PATTERN.findall(value):
+		detail = detail.strip()
+		if detail.startswith('"') and detail.endswith('"'):
+			detail = re.sub(r'\\(.)', r'\1', detail[1:-1])
+		params[label.lower()] = detail
+	return params
 
-		if line[0].strip('\r\n') == '--':
-			break
+class Part:
+	"""
+		multipart/form-dataの1パート
+		- ファイル(filenameあり)はSpooledTemporaryFileに書き込み、
+		  config.SPOOL_THRESHOLDを超えたらディスクの一時ファイルへ移る
+		- 通常のフィールドはメモリ上のbytearrayに保存する(上限はMAX_READ)
+	"""
+	def	__init__(self, headers: Headers):
+		self.headers = headers
+		disposition = headers.get('Content-Disposition', '')
+		params = parse_params(disposition)
+		self.name = params.get('name')
+		self.filename = params.get('filename')
+		self.content_type = headers.get('Content-Type', 'text/plain')
+		self.size = 0
+		if self.filename is not None:
+			self.file = tempfile.SpooledTemporaryFile(max_size=config.SPOOL_THRESHOLD)
+			self.data = None
+		else:
+			self.file = None
+			self.data = bytearray()
 
-		matched = re.search(r'name="(\w+)"', line[0])		# nameを捕捉
-		if matched:
-			request_obj.body[matched.group(1)] = line[1]	# Requestオブジェクトに保存
+	def	write(self, data):
+		self.size += len(data)
+		if self.file:
+			self.file.write(data)
+			return
+		if config.MAX_READ < self.size:
+			raise ValueError(f'write/Part: field "{self.name}" is too long')
+		self.data += data
 
+	# 書き込み完了、ファイルなら先頭へ戻して読めるようにする
+	def	finish(self):
+		if self.file:
+			self.file.seek(0)
 
-def	get_request(client_socket, request_obj) -> int:
-	## ヘッダー終了までバッファ
-	buffer = b''
-	while not b'\r\n\r\n' in buffer:
-		buffer += client_socket.recv(config.BUFFER_SIZE)
-		if buffer == b'':	# バッファが空ならループ終了
-			break
-		if config.MAX_READ < len(buffer):	# 見つからなければ終了
-			logging.error('get_request: Request header is too long')
-			return
-	logging.debug('get_request: found header end')
+	# ディスクに移ったかどうか
+	def	spooled(self) -> bool:
+		return bool(self.file and self.file._rolled)
+
+	# 中身をbytesで返す(大きなファイルはself.fileから少しずつ読むこと)
+	def	value(self) -> bytes:
+		if self.file:
+			self.file.seek(0)
+			data = self.file.read()
+			self.file.seek(0)
+			return data
+		return bytes(self.data)
+
+	def	close(self):
+		if self.file:
+			self.file.close()
+
+# MultipartParserの状態
+PREAMBLE = 'PREAMBLE'
+BOUNDARY = 'BOUNDARY'
+PART_HEADER = 'PART_HEADER'
+PART_BODY = 'PART_BODY'
+DONE = 'DONE'
+
+class MultipartParser:
+	"""
+		multipart/form-dataのプッシュ型パーサー
+		ソケットから届いた順にfeed()でチャンクを渡し、最後にclose()する
+
+		- 区切り(\r\n--boundary)がチャンクをまたいでも見つけられるよう、
+		  区切りの長さ-1バイトだけを次のチャンクまで保留する
+		- それ以外のボディはすぐPartへ書き出すので、保持するのは常にチャンク1つ分程度
+	"""
+	def	__init__(self, boundary: str):
+		self.delimiter = b'\r\n--' + boundary.encode('utf-8')
+		self.buffer = bytearray(b'\r\n')	# 最初の区切りの前には\r\nがないので補う
+		self.state = PREAMBLE
+		self.part = None
+		self.parts = {}
+
+	def	feed(self, data):
+		self.buffer += data
+		keep = len(self.delimiter) - 1
 
-	# ヘッダーとボディを分割
-	header_end = buffer.find(b'\r\n\r\n')	# ヘッダー終了文字のインデックスを捜索
-	headers = buffer[:header_end]			# ヘッダー部分を保存
-	body_part = buffer[header_end + 4:]			# ボディ部分を保存
-	logging.debug('get_request: got raw header data')
+		while True:
+			if self.state == PREAMBLE:
+				index = self.buffer.find(self.delimiter)
+				if index == -1:
+					del self.buffer[:max(0, len(self.buffer) - keep)]
+					return
+				del self.buffer[:index + len(self.delimiter)]
+				self.state = BOUNDARY
 
-	# ヘッダーをデコード
-	headers = headers.decode('utf-8', errors='replace')
-	logging.debug('get_request: decoded raw header data')
+			elif self.state == BOUNDARY:
+				# 区切りの直後は "--"(終端) か "\r\n"(次のパート)
+				if len(self.buffer) < 2:
+					return
+				if self.buffer.startswith(b'--'):
+					self.state = DONE
+					self.buffer.clear()
+					return
+				line_end = self.buffer.find(b'\r\n')
+				if line_end == -1:
+					if 1024 < len(self.buffer):
+						raise ValueError('feed/MultipartParser: Invalid boundary line')
+					return
+				if self.buffer[:line_end].strip(b' \t'):	# 区切り行の後ろは空白だけ許可
+					raise ValueError('feed/MultipartParser: Invalid boundary line')
+				del self.buffer[:line_end + 2]
+				self.state = PART_HEADER
+
+			elif self.state == PART_HEADER:
+				if self.buffer.startswith(b'\r\n'):	# ヘッダーのないパート
+					header_end, header_length = 0, 2
+				else:
+					header_end, header_length = self.buffer.find(b'\r\n\r\n'), 4
+				if header_end == -1:
+					if config.MAX_PART_HEADER < len(self.buffer):
+						raise ValueError('feed/MultipartParser: Part header is too long')
+					return
+				self.part = Part(parse_fields(bytes(self.buffer[:header_end])))
+				del self.buffer[:header_end + header_length]
+				self.state = PART_BODY
+
+			elif self.state == PART_BODY:
+				index = self.buffer.find(self.delimiter)
+				if index == -1:
+					# 区切りの一部かもしれない末尾だけ残して書き出す
+					safe = len(self.buffer) - keep
+					if 0 < safe:
+						with memoryview(self.buffer) as view:
+							self.part.write(view[:safe])
+						del self.buffer[:safe]
+					return
+				with memoryview(self.buffer) as view:
+					self.part.write(view[:index])
+				del self.buffer[:index + len(self.delimiter)]
+				self.finish_part()
+				self.state = BOUNDARY
+
+			else:	# DONE: 終端以降(エピローグ)は捨てる
+				self.buffer.clear()
+				return
+
+	def	finish_part(self):
+		self.part.finish()
+		if self.part.name is not None:
+			if self.part.name in self.parts:
+				self.parts[self.part.name].close()	# 同じnameは後のパートで上書き
+			self.parts[self.part.name] = self.part
+		else:
+			self.part.close()
+		self.part = None
+
+	# 終端の区切りまで届いたか確認する
+	def	close(self) -> bool:
+		if self.state != DONE:
+			if self.part:
+				self.part.close()
+			for part in self.parts.values():
+				part.close()
+			return False
+		return True
+
+def	get_form_data(body_part: bytes, request_obj: Request) -> int:
+	# ボディがまとめて手元にある場合(chunked)も同じパーサーに一度で渡す
+	parser = MultipartParser(request_obj.boundary)
+	parser.feed(body_part)
+	if not parser.close():
+		logging.error('get_form_data: multipart body is not terminated')
+		return -1
+	request_obj.body = parser.parts
+	return 0
+
+# "Label: value"の行を一度だけHeadersにする(同じヘッダーが複数あれば', 'で連結)
+# キーは先に小文字にしておき、Headersへはまとめて登録する
+def	parse_fields(headers: bytes) -> Headers:
+	fields = {}
+	for header in headers.decode('utf-8', errors='replace').split('\r\n'):
+		label, sep, detail = header.partition(':')
+		if not sep:
+			continue
+		label = label.strip().lower()
+		detail = detail.strip()
+		if label in fields:
+			detail = f'{fields[label]}, {detail}'
+		fields[label] = detail
+	result = Headers()
+	result.update(fields)
+	return result
+
+def	has_body_headers(request_obj: Request) -> bool:
+	return 'Content-Length' in request_obj.headers or 'Transfer-Encoding' in request_obj.headers
+
+# ボディを読む必要があるか(parse_headerの後で使う)
+def	has_body(request_obj: Request) -> bool:
+	return request_obj.length is not None or request_obj.chunked
+
+# 上限を超えたらLimitExceeded
+def	parse_header(headers: bytes, request_obj: Request) -> int:
+	if config.MAX_HEADER_SIZE < len(headers):
+		raise LimitExceeded(431, 'parse_header: Request header is too long')
 
 	# httpリクエストを分解
-	header_line = headers.split('\r\n')
-	if not parse_http(header_line[0], request_obj):		# parse_httpでリクエスト最上部をパース
-		logging.error('get_request: Cannot parse http request')
+	request_line, _, fields = headers.partition(b'\r\n')
+	if config.MAX_URL_LENGTH < len(request_line):
+		raise LimitExceeded(414, 'parse_header: Request line is too long')
+	if fields and config.MAX_HEADER_COUNT <= fields.count(b'\r\n'):
+		raise LimitExceeded(431, 'parse_header: Too many header fields')
+	request_line = request_line.decode('utf-8', errors='replace')
+	if not parse_http(request_line, request_obj):		# parse_httpでリクエスト最上部をパース
+		logging.error('parse_header: Cannot parse http request')
 		return -1
-	logging.debug('get_request: got http request in header')
+	logging.debug('parse_header: got http request in header')
+
+	# ヘッダーは一度だけ辞書にする
+	request_obj.headers = parse_fields(fields)
+
+	# Connectionヘッダーはメソッドに関係なく保存(keep-aliveの判定に使う)
+	connection = request_obj.headers.get('Connection')
+	if connection:
+		request_obj.connection = connection.lower()
 
 	# GETメソッドならここで終了
 	if request_obj.method == 'GET':
 		return 0
-	logging.debug('get_request: request is GET method')
-
-	# Content-Type, Lengthを保存
-	for header in header_line[1:]:
-		if 'Content-Type' in header:
-			request_obj.type = header.split()[1].strip()
-			if request_obj.type == 'multipart/form-data;':	# multipart/form-dataならboundary文字列を取得
-				boundary_start = header.find('boundary=')
-				request_obj.boundary = header[boundary_start + len('boundary='):]
-		if 'Content-Length' in header:
-			request_obj.length = header.split(':')[1].strip()	# int変換するとprint_requestでエラーになる
+	logging.debug('parse_header: request is not GET method')
+
+	# POST以外でボディの長さの指定がなければボディなし(DELETEなど)
+	if request_obj.method != 'POST' and not has_body_headers(request_obj):
+		return 0
+
+	# Content-Type, Length, Transfer-Encodingを保存
+	content_type = request_obj.headers.get('Content-Type')
+	if content_type:
+		request_obj.type = content_type.split()[0]
+		if request_obj.type == 'multipart/form-data;':	# multipart/form-dataならboundary文字列を取得
+			request_obj.boundary = parse_params(content_type).get('boundary')
+			if not request_obj.boundary:
+				logging.error('parse_header: Cannot find boundary')
+				return -1
+	request_obj.length = request_obj.headers.get('Content-Length')	# int変換するとprint_requestでエラーになる
+	if 'chunked' in request_obj.headers.get('Transfer-Encoding', '').lower():
+		request_obj.chunked = True
+		request_obj.length = None		# chunkedが優先(RFC 9112 6.3)
 
 	# ボディ長・タイプが取得できなければエラー
-	if request_obj.length is None or request_obj.type is None:
-		logging.error('get_request: Cannot find Content-Length')
+	if (request_obj.length is None and not request_obj.chunked) or request_obj.type is None:
+		logging.error('parse_header: Cannot find Content-Length')
 		return -1
-	logging.debug('get_request: got Content-Type and Content-Length')
+	# multipartはディスクへ書き出すので、ボディ全体をメモリに置く他の形式より大きくてよい
+	limit = config.MAX_UPLOAD if request_obj.type == 'multipart/form-data;' else config.MAX_READ
+	if request_obj.length is not None:
+		if not request_obj.length.isdigit():
+			logging.error('parse_header: Invalid Content-Length')
+			return -1
+		if limit < int(request_obj.length):
+			raise LimitExceeded(413, 'parse_header: Content-Length is too large')
+	logging.debug('parse_header: got Content-Type and Content-Length')
 
-	# 残りのボディ読み込み
-	buffer = client_socket.recv(int(request_obj.length) - len(body_part))
-	body_part += buffer
-	logging.debug('get_request: latest body_part is loaded')
+	return 0
 
+def	parse_body(body_part: bytes, request_obj: Request) -> int:
 	# 単なるPOSTメソッドならボディをデコード・パースして保存
 	if request_obj.method == 'POST' and request_obj.type == 'application/x-www-form-urlencoded':
-		logging.debug('get_request: method=POST, Type=application/x-www-form-urlencoded')
+		logging.debug('parse_body: method=POST, Type=application/x-www-form-urlencoded')
 		body_part = body_part.decode('utf-8', errors='replace')
 		request_obj.body = parse_qs(body_part)
 		return 0
 
+	# multipart/form-dataならget_form_data関数を呼び出し
+	if request_obj.method == 'POST' and request_obj.type == 'multipart/form-data;':
+		logging.debug('parse_body: method=POST, Type=multipart/form-data;')
+		return get_form_data(body_part, request_obj)
+
+	return 0
+
+# 接続を維持するかどうか
+# HTTP/1.1はデフォルトでkeep-alive、HTTP/1.0は明示された時だけ
+def	wants_keep_alive(request_obj: Request) -> bool:
+	if request_obj.connection == 'close':
+		return False
+	if request_obj.version == 'HTTP/1.1':
+		return True
+	return request_obj.connection == 'keep-alive'
+
+# バッファ上のchunked形式のボディを復元する
+# 全て揃っていれば(ボディ, 消費したバイト数)、まだ途中ならNoneを返す
+# (event_server用、RequestReaderはソケットから直接読みながら復元する)
+def	decode_chunked(data) -> tuple[bytes, int] | None:
+	body = bytearray()
+	offset = 0
+	while True:
+		line_end = data.find(b'\r\n', offset)
+		if line_end == -1:
+			return None
+		size = int(bytes(data[offset:line_end]).split(b';')[0].strip(), 16)	# 不正な値はValueError
+		offset = line_end + 2
+		if size == 0:
+			break
+		if len(data) < offset + size + 2:
+			return None
+		body += data[offset:offset + size]
+		offset += size + 2
+		if config.MAX_READ < len(body):
+			raise LimitExceeded(413, 'decode_chunked: body is too long')
+
+	# トレーラーを空行まで読み飛ばす
+	while True:
+		line_end = data.find(b'\r\n', offset)
+		if line_end == -1:
+			return None
+		empty = line_end == offset
+		offset = line_end + 2
+		if empty:
+			return bytes(body), offset
+
+class RequestReader:
+	"""
+		1接続につき1つ作り、keep-alive中のリクエストをまたいで使い回す
+
+		- 受信はrecv_intoで再利用するbytearrayへ直接書き込む
+		- ヘッダー終端の探索はscanから再開するので同じバイトを二度探さない
+		- ボディはContent-Length分を確保したbytearrayへ直接受信する
+		- 次のリクエストの分(パイプライン)はバッファのstart〜endに残る
+		- 受信のたびにbudgetの残り時間をソケットのタイムアウトにする
+		  (期限切れ・転送が遅すぎる場合はsocket.timeout)
+	"""
+	def	__init__(self, client_socket, size=None):
+		self.client_socket = client_socket
+		self.budget = RequestBudget()		# 1件目は接続した時から数える
+		self.buffer = bytearray(size or config.BUFFER_SIZE)
+		self.view = memoryview(self.buffer)
+		self.start = 0		# 未処理データの先頭
+		self.end = 0		# 受信済みデータの末尾
+		self.scan = 0		# ヘッダー終端の探索を再開する位置
+
+	# まだ処理していない受信済みバイト数
+	def	pending(self) -> int:
+		return self.end - self.start
+
+	# 期限までの秒数をソケットのタイムアウトにする
+	def	wait(self):
+		remaining = self.budget.remaining()
+		if remaining <= 0:
+			raise socket.timeout('wait/RequestReader: request budget is exhausted')
+		self.client_socket.settimeout(remaining)
+
+	# ソケットから1回だけ受信し、受信バイト数を返す(0なら切断)
+	def	fill(self) -> int:
+		if self.end == len(self.buffer):
+			if self.start:
+				# 処理済みの分を捨てて先頭に詰める
+				length = self.end - self.start
+				self.buffer[:length] = bytes(self.view[self.start:self.end])
+				self.scan -= self.start
+				self.start = 0
+				self.end = length
+			else:
+				# 詰められなければバッファを倍にする
+				self.view.release()
+				self.buffer.extend(bytes(len(self.buffer)))
+				self.view = memoryview(self.buffer)
+
+		with self.view[self.end:] as free:
+			received = self.client_socket.recv_into(free)
+		self.end += received
+		return received
+
+	# ヘッダー部分(終端の\r\n\r\nは含まない)を返す
+	def	read_header(self) -> bytes | None:
+		self.scan = max(self.scan, self.start)
+		while True:
+			# 前回の末尾3バイトから探せば、チャンクをまたいだ\r\n\r\nも見つかる
+			header_end = self.buffer.find(b'\r\n\r\n', max(self.start, self.scan - 3), self.end)
+			if header_end != -1:
+				headers = bytes(self.view[self.start:header_end])
+				self.start = header_end + 4
+				self.scan = self.start
+				return headers
+			self.scan = self.end
+
+			if config.MAX_HEADER_SIZE < self.pending():
+				raise LimitExceeded(431, 'read_header/RequestReader: Request header is too long')
+			self.wait()
+			if self.fill() == 0:	# ヘッダーの途中で切断
+				return None
+
+	# \r\nまでの1行(\r\nは含まない)を返す
+	def	read_line(self) -> bytes | None:
+		while True:
+			line_end = self.buffer.find(b'\r\n', self.start, self.end)
+			if line_end != -1:
+				line = bytes(self.view[self.start:line_end])
+				self.start = line_end + 2
+				return line
+			if config.BUFFER_SIZE < self.pending():
+				logging.error('read_line/RequestReader: line is too long')
+				return None
+			self.wait()
+			received = self.fill()
+			if received == 0:
+				return None
+			self.budget.add(received)
+
+	# ちょうどlengthバイト読む
+	def	read_exact(self, length: int) -> bytearray | None:
+		body = bytearray(length)
+		got = min(length, self.pending())
+		body[:got] = self.view[self.start:self.start + got]		# バッファに残っていた分
+		self.start += got
+
+		with memoryview(body) as view:
+			while got < length:
+				self.wait()
+				received = self.client_socket.recv_into(view[got:])
+				if received == 0:	# ボディの途中で切断
+					logging.error('read_exact/RequestReader: connection closed in body')
+					return None
+				got += received
+				self.budget.add(received)
+		return body
+
+	# lengthバイトを少しずつ返す(multipartのストリーミング用)
+	# 返すmemoryviewは次の受信で上書きされるので、受け取った側ですぐ処理すること
+	def	read_stream(self, length: int):
+		got = min(length, self.pending())
+		if got:
+			yield self.view[self.start:self.start + got]	# バッファに残っていた分
+			self.start += got
+
+		if length <= got:
+			return
+
+		# 残りはバッファ全体を使い回して受信(ここまででバッファは空になっている)
+		self.start = self.end = self.scan = 0
+		while got < length:
+			with self.view[:min(len(self.buffer), length - got)] as free:
+				self.wait()
+				received = self.client_socket.recv_into(free)
+				if received == 0:
+					raise ConnectionError('read_stream/RequestReader: connection closed in body')
+				got += received
+				self.budget.add(received)
+				yield free[:received]
+
+	# Transfer-Encoding: chunked のボディを復元する
+	def	read_chunked(self) -> bytearray | None:
+		body = bytearray()
+		while True:
+			line = self.read_line()
+			if line is None:
+				return None
+			size = int(line.split(b';')[0].strip(), 16)	# 不正な値はValueError
+			if size == 0:
+				break
+			if config.MAX_READ < len(body) + size:
+				raise LimitExceeded(413, 'read_chunked/RequestReader: body is too long')
+			chunk = self.read_exact(size + 2)		# データ + \r\n
+			if chunk is None:
+				return None
+			body += memoryview(chunk)[:size]
+
+		# トレーラーを空行まで読み飛ばす
+		while True:
+			line = self.read_line()
+			if line is None:
+				return None
+			if not line:
+				return body
+
+# reader: 接続ごとのRequestReader(keep-alive中は同じものを渡す)
+#         省略した場合はこの1リクエスト用に作る
+# 上限を超えた場合も-1を返し、返すステータスをrequest_obj.errorに入れる
+# 期限切れ(reader.budget)はsocket.timeout
+def	get_request(client_socket, request_obj, reader=None) -> int:
+	if reader is None:
+		reader = RequestReader(client_socket)
+	try:
+		return read_request(reader, request_obj)
+	except LimitExceeded as e:
+		logging.error(f'get_request: {e}')
+		request_obj.error = e.status
+		return -1
+
+def	read_request(reader, request_obj) -> int:
+	## ヘッダー終了までバッファ
+	headers = reader.read_header()
+	if headers is None:
+		logging.error('read_request: Cannot find header end')
+		return -1
+	logging.debug('read_request: got raw header data')
+
+	# ヘッダーをパース(event_serverと共通)
+	result = parse_header(headers, request_obj)
+	request_obj.timer.mark('header')
+	if result == -1:
+		return -1
+
+	# GETメソッド・ボディのないリクエストならここで終了
+	if request_obj.method == 'GET' or not has_body(request_obj):
+		return 0
+	reader.budget.start_body()
+
+	# multipart/form-dataは届いた分からパーサーへ渡し、ボディ全体をメモリに持たない
+	if request_obj.type == 'multipart/form-data;' and not request_obj.chunked:
+		parser = MultipartParser(request_obj.boundary)
+		try:
+			for chunk in reader.read_stream(int(request_obj.length)):
+				parser.feed(chunk)
+		except ValueError:
+			logging.exception('read_request: Invalid multipart body')
+			parser.close()
+			return -1
+		except BaseException:
+			parser.close()		# タイムアウト・切断でも一時ファイルを残さない
+			raise
+		if not parser.close():
+			logging.error('read_request: multipart body is not terminated')
+			return -1
+		request_obj.body = parser.parts
+		request_obj.timer.mark('body')
+		logging.debug('read_request: multipart body is streamed')
+		return 0
+
+	# ボディ読み込み(Content-Length分ちょうど、またはchunked)
+	try:
+		if request_obj.chunked:
+			body_part = reader.read_chunked()
+		else:
+			body_part = reader.read_exact(int(request_obj.length))
+	except ValueError:
+		logging.error('read_request: Invalid chunk size')
+		return -1
+	if body_part is None:
+		return -1
+	if request_obj.chunked:
+		request_obj.length = str(len(body_part))
+	logging.debug('read_request: latest body_part is loaded')
+
 	"""
 	form-dataの処理への移行
 		1.	Content-TypeとLengthを保存
@@ -119,29 +619,35 @@ def	get_request(client_socket, request_obj) -> int:
 		- body_partとrequest_objを渡す
 
 	"""
-	# multipart/form-dataならget_form_data関数を呼び出し
-	if request_obj.method == 'POST' and request_obj.type == 'multipart/form-data;':
-		logging.debug('get_request: method=POST, Type=multipart/form-data;')
-		get_form_data(body_part, request_obj)
+	try:
+		return parse_body(body_part, request_obj)
+	except ValueError:
+		logging.exception('read_request: Invalid request body')
+		return -1
+	finally:
+		request_obj.timer.mark('body')
 
 
+# リクエストの詳細はDEBUGの時だけ出す(1リクエストで10行以上を整形するので、普段は行わない)
 def	print_request(request_obj):
-	logging.info('===== Request Details =====')
-	logging.info(f'{"method":<10}:{request_obj.method:>25}')
-	logging.info(f'{"Path":<10}:{request_obj.path:>25}')
-	logging.info(f'{"Version":<10}:{request_obj.version:>25}')
-	logging.info(f'{"Type":<10}:{request_obj.type:>25}')
+	if not logging.getLogger().isEnabledFor(logging.DEBUG):
+		return
+	logging.debug('===== Request Details =====')
+	logging.debug(f'{"method":<10}:{request_obj.method:>25}')
+	logging.debug(f'{"Path":<10}:{request_obj.path:>25}')
+	logging.debug(f'{"Version":<10}:{request_obj.version:>25}')
+	logging.debug(f'{"Type":<10}:{str(request_obj.type):>25}')
 	if request_obj.type == 'multipart/form-data;':
-		logging.info(f'{"Boundary":<10}:')
-		logging.info(f'\t{request_obj.boundary}')
-	logging.info('Query:')
+		logging.debug(f'{"Boundary":<10}:')
+		logging.debug(f'\t{request_obj.boundary}')
+	logging.debug('Query:')
 	for label, detail in request_obj.query.items():
 		detail = ','.join(detail)
-		logging.info(f'\t{label}:{detail}')
-	logging.info('Request Body:')
+		logging.debug(f'\t{label}:{detail}')
+	logging.debug('Request Body:')
 	for label, detail in request_obj.body.items():
-		if isinstance(detail, bytes):
-			logging.info(f'\t{label}: len={len(detail)}')
+		if isinstance(detail, Part):
+			logging.debug(f'\t{label}: len={detail.size} filename={detail.filename} spooled={detail.spooled()}')
 			continue
 		detail = ','.join(detail)
-		logging.info(f'\t{label}:{detail}')
+		logging.debug(f'\t{label}:{detail}')
@@ -0,0 +1,94 @@
+import time
+import threading
+
+import config
+from metrics import metrics
+
+"""
+	1接続・1リクエストに使わせる資源の上限
+	limits.py:
+		- LimitExceededクラス(上限を超えたリクエスト、返すステータスを持つ)
+		- RequestBudgetクラス(ヘッダーの期限とボディの最低転送速度)
+		- ConnectionLimiterクラス(IPアドレスごとの同時接続数)
+
+	TIMEOUT_INTはrecv 1回ごとのタイムアウトなので、1バイトずつ送り続ける(slowloris)と
+	いつまでも接続を握られる。RequestBudgetはリクエスト全体に期限を付けて打ち切る
+		- ヘッダー: 開始からHEADER_TIMEOUT秒以内に終わらなければ408
+		- ボディ: 開始からBODY_GRACE秒 + 受信済みバイト数 / MIN_BODY_RATE 秒を過ぎたら408
+		  (MIN_BODY_RATEより速く送っている間は期限が延び続ける)
+		- どちらも、1回の受信を待つのはTIMEOUT_INT秒まで
+"""
+
+class LimitExceeded(Exception):
+	# status: 413(ボディ)、414(URL)、431(ヘッダー)
+	def	__init__(self, status: int, message: str):
+		super().__init__(message)
+		self.status = status
+
+class RequestBudget:
+	__slots__ = ('begin', 'body_begin', 'received')
+
+	def	__init__(self):
+		self.restart()
+
+	# リクエストの最初のバイトが届いた時(1件目は接続した時)に呼ぶ
+	def	restart(self):
+		self.begin = time.monotonic()
+		self.body_begin = None
+		self.received = 0
+
+	def	start_body(self):
+		self.body_begin = time.monotonic()
+		self.received = 0
+
+	def	add(self, received: int):
+		self.received += received
+
+	# 期限の時刻(time.monotonic、asyncioのloop.time()と同じ時計)
+	def	deadline(self) -> float:
+		if self.body_begin is None:
+			return self.begin + config.HEADER_TIMEOUT
+		return self.body_begin + config.BODY_GRACE + self.received / config.MIN_BODY_RATE
+
+	# 次の受信を待てる秒数(0以下なら期限切れ)
+	def	remaining(self) -> float:
+		return min(self.deadline() - time.monotonic(), config.TIMEOUT_INT)
+
+class ConnectionLimiter:
+	# IPアドレスごとの接続数を数える(スレッドモードでは複数スレッドから呼ばれるのでlockで守る)
+	# limit: Noneならconfig.MAX_CONNECTIONS_PER_IPを毎回読む(SIGHUPでの読み直しを反映する)
+	def	__init__(self, limit: int = None):
+		self.limit = limit
+		self.counts = {}
+		self.lock = threading.Lock()
+		self.rejected = 0
+
+	# 上限に達していればFalse(Trueを返した接続は必ずreleaseする)
+	def	acquire(self, address: str) -> bool:
+		with self.lock:
+			count = self.counts.get(address, 0)
+			limit = config.MAX_CONNECTIONS_PER_IP if self.limit is None else self.limit
+			if limit <= count:
+				self.rejected += 1
+				return False
+			self.counts[address] = count + 1
+			return True
+
+	def	release(self, address: str):
+		with self.lock:
+			count = self.counts.get(address, 0) - 1
+			if 0 < count:
+				self.counts[address] = count
+			else:
+				self.counts.pop(address, None)
+
+	def	stats(self) -> dict:
+		with self.lock:
+			return {
+				'addresses': len(self.counts),
+				'max_per_address': max(self.counts.values(), default=0),
+				'rejected': self.rejected
+			}
+
+connection_limiter = ConnectionLimiter()
+metrics.register('connection_limiter', connection_limiter.stats)
@@ -0,0 +1,163 @@
+import os
+import time
+import logging
+import threading
+
+"""
+	リクエストごとの計測とアクセスログ
+	metrics.py:
+		- Histogramクラス(HDR形式の対数・線形バケット)
+		- StageTimerクラス(1リクエストの段階ごとの時間)
+		- Metricsクラス
+		- finish_request関数(計測の記録とアクセスログ)
+
+	段階:
+		accept	- acceptしてから接続の処理を始めるまで(1接続の最初のリクエストだけ)
+		header	- リクエストの読み始めからヘッダーのパースまで
+		body	- ボディの受信・パース
+		route	- ルーターでハンドラーを探す
+		render	- ハンドラー・静的ファイルの検索でレスポンスを作る
+		send	- レスポンスの送信
+
+	アクセスログは'access'ロガーへ辞書のまま渡し、JSON化と書き込みは
+	config.setup_loggingのQueueListenerのスレッドで行う(リクエストの処理はI/Oを待たない)
+"""
+
+STAGES = ('accept', 'header', 'body', 'route', 'render', 'send')
+SUB_BITS = 5			# 2の累乗ごとに2**SUB_BITS個のバケット(相対誤差 約3%)
+SUB_COUNT = 1 << SUB_BITS
+MAX_SHIFT = 32			# これを超える値(約2**38マイクロ秒)は最後のバケットに入れる
+
+access_logger = logging.getLogger('access')
+
+class Histogram:
+	"""
+		マイクロ秒単位の値をHDR Histogramと同じ形のバケットに数える
+		- 2*SUB_COUNT未満はそのまま、それ以上は2の累乗の区間ごとにSUB_COUNT等分
+		- 記録はインデックスの計算と加算だけで、値そのものは保存しない
+	"""
+	__slots__ = ('counts', 'count', 'total', 'max')
+
+	def	__init__(self):
+		self.counts = [0] * ((MAX_SHIFT + 2) * SUB_COUNT)
+		self.count = 0
+		self.total = 0
+		self.max = 0
+
+	@staticmethod
+	def	index(value: int) -> int:
+		shift = max(0, value.bit_length() - SUB_BITS - 1)
+		return shift * SUB_COUNT + (value >> shift)
+
+	# バケットに入る値の上限
+	@staticmethod
+	def	value_at(index: int) -> int:
+		shift = max(0, index // SUB_COUNT - 1)
+		return ((index - shift * SUB_COUNT) << shift) + (1 << shift) - 1
+
+	def	record(self, seconds: float):
+		value = int(seconds * 1e6)
+		self.counts[min(self.index(value), len(self.counts) - 1)] += 1
+		self.count += 1
+		self.total += value
+		self.max = max(self.max, value)
+
+	# p(0〜100)パーセンタイルの値(マイクロ秒)
+	def	percentile(self, p) -> int:
+		if not self.count:
+			return 0
+		target = max(1, int(self.count * p / 100 + 0.5))
+		seen = 0
+		for index, count in enumerate(self.counts):
+			seen += count
+			if target <= seen:
+				return min(self.value_at(index), self.max)
+		return self.max
+
+	def	snapshot(self) -> dict:
+		return {
+			'count': self.count,
+			'mean_ms': round(self.total / self.count / 1000, 3) if self.count else 0.0,
+			'p50_ms': self.percentile(50) / 1000,
+			'p95_ms': self.percentile(95) / 1000,
+			'p99_ms': self.percentile(99) / 1000,
+			'max_ms': self.max / 1000
+		}
+
+class StageTimer:
+	# 前回のmarkからの経過時間を段階ごとに足していく
+	__slots__ = ('begin', 'last', 'stages')
+
+	def	__init__(self):
+		self.begin = self.last = time.perf_counter()
+		self.stages = {}
+
+	# 待ち時間を含めないよう、リクエストの最初のバイトが届いた時に測り直す
+	def	restart(self):
+		self.begin = self.last = time.perf_counter()
+		self.stages.clear()
+
+	def	mark(self, stage: str):
+		now = time.perf_counter()
+		self.stages[stage] = self.stages.get(stage, 0.0) + now - self.last
+		self.last = now
+
+	def	elapsed(self) -> float:
+		return self.last - self.begin
+
+class Metrics:
+	def	__init__(self):
+		self.lock = threading.Lock()
+		self.stages = {stage: Histogram() for stage in STAGES}
+		self.routes = {}		# ルート(パターン) -> Histogram
+		self.statuses = {}
+		self.sources = {}		# /__statsに載せる他の統計(名前 -> 辞書を返す関数)
+
+	def	record(self, route: str, status: int, stages: dict, elapsed: float):
+		with self.lock:
+			for stage, seconds in stages.items():
+				self.stages[stage].record(seconds)
+			histogram = self.routes.get(route)
+			if histogram is None:
+				histogram = self.routes[route] = Histogram()
+			histogram.record(elapsed)
+			self.statuses[status] = self.statuses.get(status, 0) + 1
+
+	# 接続の最初のリクエストの前に、accept待ちの時間だけを記録する
+	def	record_accept(self, seconds: float):
+		with self.lock:
+			self.stages['accept'].record(seconds)
+
+	def	register(self, name: str, source):
+		self.sources[name] = source
+
+	def	stats(self) -> dict:
+		with self.lock:
+			result = {
+				'pid': os.getpid(),
+				'routes': {route: histogram.snapshot() for route, histogram in sorted(self.routes.items())},
+				'stages': {stage: histogram.snapshot() for stage, histogram in self.stages.items()},
+				'statuses': {str(status): count for status, count in sorted(self.statuses.items())}
+			}
+		for name, source in self.sources.items():
+			result[name] = source()
+		return result
+
+metrics = Metrics()
+
+# レスポンスを送り終えたら呼ぶ(エラー応答でリクエストが途中までしか埋まっていなくてもよい)
+def	finish_request(request_obj, response_obj, client_address):
+	timer = request_obj.timer
+	timer.mark('send')
+	route = request_obj.route or '-'
+	metrics.record(route, response_obj.status, timer.stages, timer.elapsed())
+	if access_logger.isEnabledFor(logging.INFO):
+		access_logger.info({
+			'client': client_address[0] if client_address else '-',
+			'method': request_obj.method or '-',
+			'path': request_obj.path or '-',
+			'route': route,
+			'status': response_obj.status,
+			'bytes': response_obj.headers.get('Content-Length', 0),
+			'ms': round(timer.elapsed() * 1000, 3)
+		})
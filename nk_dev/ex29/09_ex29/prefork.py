@@ -0,0 +1,286 @@
+import os
+import json
+import time
+import signal
+import logging
+import selectors
+
+import config
+from route import log_routes
+from event_server import create_listener, drain, run_event_server
+from restart import Handoff, inherited_listener, notify_ready
+
+"""
+	prefork: 複数のワーカープロセスでevent_serverを動かす
+	prefork.py:
+		- cpu_count関数(/proc/cpuinfoのsiblingsからコア数を得る)
+		- Workerクラス(親から見たワーカー1つ分)
+		- Supervisorクラス(ワーカーの起動・再起動・終了)
+		- run_prefork_server関数
+
+	GILがあるので1プロセスでは1コアしか使えない
+	ワーカーをコア数だけforkし、それぞれがevent_serverのループを回す
+		- PREFORK_REUSEPORT=True : ワーカーごとにSO_REUSEPORTでbindし、カーネルが接続を振り分ける
+		                           (親はポートを確保するためbindだけしておく)
+		- PREFORK_REUSEPORT=False: 親がlistenしたソケットを全ワーカーが受け継いでacceptする
+
+	シグナル(親へ送る):
+		SIGTERM / SIGINT	- 全ワーカーをdrainしてから終了
+		SIGHUP				- 設定ファイルを読み直し、新しいワーカーを起動してから、古いワーカーをdrainして入れ替える
+		SIGUSR1				- 全ワーカーの集計をログに出す
+		SIGUSR2				- 新しい親プロセスを起動してソケットを引き継ぎ、全ワーカーをdrainしてから終了する
+							  (新しいワーカーが全て最初のstatsを送った=受付を始めた時点で引き継ぐ)
+	ワーカーが異常終了したら起動し直す(すぐ落ちる場合は1秒待ってから)
+
+	ワーカーは1秒ごとにevent_server.statsをJSONの1行にしてパイプで親へ送る
+	親は終了したワーカーの分も含めて合計する
+"""
+
+RESTART_DELAY = 1.0		# 起動からこれより早く落ちたワーカーは、この秒数待ってから起動し直す
+
+# /proc/cpuinfoのphysical idごとのsiblings(論理コア数)を合計する
+def	cpu_count() -> int:
+	siblings = {}
+	physical_id = '0'
+	try:
+		with open('/proc/cpuinfo') as file:
+			for line in file:
+				label, _, value = line.partition(':')
+				label = label.strip()
+				if label == 'physical id':
+					physical_id = value.strip()
+				elif label == 'siblings':
+					siblings[physical_id] = int(value)
+	except (OSError, ValueError):
+		logging.exception('cpu_count: Cannot read /proc/cpuinfo')
+	if siblings:
+		return sum(siblings.values())
+	return os.cpu_count() or 1
+
+# 数値は足し合わせ、辞書は中身ごとに合計する
+def	merge_stats(total: dict, stats: dict):
+	for label, value in stats.items():
+		if isinstance(value, dict):
+			merge_stats(total.setdefault(label, {}), value)
+		elif isinstance(value, (int, float)):
+			total[label] = total.get(label, 0) + value
+
+class Worker:
+	def	__init__(self, pid, pipe, index):
+		self.pid = pid
+		self.pipe = pipe		# ワーカーからstatsを受け取る読み込み側
+		self.index = index
+		self.started = time.monotonic()
+		self.retiring = False	# SIGHUPで入れ替え中(終了しても起動し直さない)
+		self.stats = {}
+		self.partial = b''		# 改行まで届いていない分
+
+	# パイプに届いた行を読み、最新のstatsを残す
+	# 書き込み側が閉じられていたらFalse
+	def	read_stats(self) -> bool:
+		try:
+			data = os.read(self.pipe, 65536)
+		except BlockingIOError:
+			return True
+		if not data:
+			return False
+		lines = (self.partial + data).split(b'\n')
+		self.partial = lines.pop()
+		for line in lines:
+			try:
+				self.stats = json.loads(line)
+			except ValueError:
+				logging.error('read_stats/Worker: broken stats line')
+		return True
+
+class Supervisor:
+	def	__init__(self, host, port, backlog, workers):
+		self.host = host
+		self.port = port
+		self.backlog = backlog
+		self.count = workers
+		self.workers = {}		# pid -> Worker
+		self.retired = {}		# 終了したワーカーのstatsの合計
+		self.restarts = 0
+		self.selector = selectors.DefaultSelector()
+		self.stopping = False
+		self.reloading = False
+		self.dumping = False
+
+		# 親のソケット: REUSEPORTならポートの確保だけ、そうでなければワーカーが受け継ぐ
+		self.reuse_port = config.PREFORK_REUSEPORT
+		self.listener = inherited_listener() or create_listener(host, port, backlog, reuse_port=self.reuse_port, listen=not self.reuse_port)
+		self.handoff = Handoff()
+		self.starting = True		# 全ワーカーが受付を始めたらnotify_readyする
+
+		# シグナルはフラグを立てるだけにし、wakeup_fdでselectから抜けさせる
+		self.wakeup_r, self.wakeup_w = os.pipe()
+		os.set_blocking(self.wakeup_r, False)
+		os.set_blocking(self.wakeup_w, False)
+		self.selector.register(self.wakeup_r, selectors.EVENT_READ, None)
+
+	def	handle_signal(self, signum, frame):
+		if signum in (signal.SIGTERM, signal.SIGINT):
+			self.stopping = True
+		elif signum == signal.SIGHUP:
+			self.reloading = True
+		elif signum == signal.SIGUSR1:
+			self.dumping = True
+		elif signum == signal.SIGUSR2:
+			self.handoff.request()
+
+	def	spawn(self, index) -> Worker:
+		read_fd, write_fd = os.pipe()
+		pid = os.fork()
+		if pid == 0:
+			os.close(read_fd)
+			self.run_worker(write_fd)		# 戻らない
+		os.close(write_fd)
+		os.set_blocking(read_fd, False)
+		worker = Worker(pid, read_fd, index)
+		self.workers[pid] = worker
+		self.selector.register(read_fd, selectors.EVENT_READ, worker)
+		logging.info(f'spawn/Supervisor: worker {index} pid={pid}')
+		return worker
+
+	# forkした子プロセス側
+	def	run_worker(self, write_fd):
+		status = 1
+		try:
+			# 親のシグナル処理・他のワーカーのパイプは受け継がない
+			signal.set_wakeup_fd(-1)
+			self.selector.close()
+			for fd in [self.wakeup_r, self.wakeup_w] + [worker.pipe for worker in self.workers.values()]:
+				os.close(fd)
+			signal.signal(signal.SIGTERM, lambda signum, frame: drain())
+			signal.signal(signal.SIGHUP, lambda signum, frame: drain())
+			signal.signal(signal.SIGINT, signal.SIG_IGN)		# Ctrl-Cは親がSIGTERMにして送る
+			signal.signal(signal.SIGUSR1, signal.SIG_DFL)
+			signal.signal(signal.SIGUSR2, signal.SIG_IGN)
+
+			if self.reuse_port:
+				self.listener.close()
+				server_socket = create_listener(self.host, self.port, self.backlog, reuse_port=True)
+			else:
+				server_socket = self.listener
+			os.set_blocking(write_fd, False)
+
+			def	report(stats):
+				try:
+					os.write(write_fd, json.dumps(stats).encode('ascii') + b'\n')
+				except BlockingIOError:
+					pass		# 親が読めていなければ今回の分は捨てる
+
+			run_event_server(self.host, self.port, self.backlog, server_socket=server_socket, report=report)
+			status = 0
+		except Exception:
+			logging.exception('Exception run_worker/Supervisor:')
+		finally:
+			config.stop_logging()
+			os._exit(status)
+
+	# 終了したワーカーを回収し、必要なら起動し直す
+	def	reap(self):
+		while self.workers:
+			try:
+				pid, status = os.waitpid(-1, os.WNOHANG)
+			except ChildProcessError:
+				return
+			if pid == 0:
+				return
+			worker = self.workers.pop(pid, None)
+			if worker is None:
+				continue
+			while worker.read_stats():		# 最後に送られたstatsまで読む
+				pass
+			if worker.pipe in self.selector.get_map():
+				self.selector.unregister(worker.pipe)
+			os.close(worker.pipe)
+			worker.stats.pop('active', None)
+			merge_stats(self.retired, worker.stats)
+
+			if self.stopping or worker.retiring:
+				logging.info(f'reap/Supervisor: worker {worker.index} pid={pid} exited')
+				continue
+			logging.error(f'reap/Supervisor: worker {worker.index} pid={pid} died (status={status}), restarting')
+			self.restarts += 1
+			if time.monotonic() - worker.started < RESTART_DELAY:
+				time.sleep(RESTART_DELAY)
+			self.spawn(worker.index)
+
+	# 設定ファイルを読み直し、新しいワーカーを先に起動して古いワーカーをdrainさせる
+	# (新しいワーカーは読み直した設定をforkで受け継ぐ)
+	def	reload(self):
+		config.load_config(reload=True)
+		logging.info('reload/Supervisor: replacing workers')
+		for worker in list(self.workers.values()):
+			if worker.retiring:
+				continue
+			worker.retiring = True
+			self.spawn(worker.index)
+			os.kill(worker.pid, signal.SIGTERM)
+
+	def	stats(self) -> dict:
+		total = {}
+		merge_stats(total, self.retired)
+		for worker in self.workers.values():
+			merge_stats(total, worker.stats)
+		total['workers'] = len(self.workers)
+		total['restarts'] = self.restarts
+		return total
+
+	def	run(self):
+		signal.set_wakeup_fd(self.wakeup_w)
+		for signum in (signal.SIGTERM, signal.SIGINT, signal.SIGHUP, signal.SIGUSR1, signal.SIGUSR2):
+			signal.signal(signum, self.handle_signal)
+
+		for index in range(self.count):
+			self.spawn(index)
+
+		deadline = None		# 停止を指示した後、SIGKILLに切り替える時刻
+		try:
+			while self.workers:
+				for key, mask in self.selector.select(timeout=1.0):
+					if key.data is None:
+						try:
+							os.read(self.wakeup_r, 512)
+						except BlockingIOError:
+							pass
+					elif not key.data.read_stats():
+						self.selector.unregister(key.fd)
+				self.reap()
+
+				if self.stopping and deadline is None:
+					logging.info('run/Supervisor: stopping workers')
+					for pid in self.workers:
+						os.kill(pid, signal.SIGTERM)
+					deadline = time.monotonic() + config.DRAIN_TIMEOUT + 5.0
+				if deadline is not None and deadline < time.monotonic():
+					logging.error('run/Supervisor: workers did not stop, killing')
+					for pid in self.workers:
+						os.kill(pid, signal.SIGKILL)
+					deadline = float('inf')
+				if self.reloading and not self.stopping:
+					self.reloading = False
+					self.reload()
+				if self.dumping:
+					self.dumping = False
+					logging.info(f'prefork stats: {self.stats()}')
+				if self.starting and all(worker.stats for worker in self.workers.values()):
+					self.starting = False
+					notify_ready()
+				if self.handoff.poll(self.listener) and not self.stopping:
+					self.stopping = True		# 新しい親プロセスのワーカーが受付を始めた
+		finally:
+			self.listener.close()
+			self.selector.close()
+			logging.info(f'prefork stats: {self.stats()}')
+			logging.info('Server closed')
+
+def	run_prefork_server(host=config.LOCAL_HOST, port=config.PORT, backlog=config.BACKLOG, workers=None):
+	workers = workers or config.PREFORK_WORKERS or cpu_count()
+	supervisor = Supervisor(host, port, backlog, workers)
+	logging.info('')
+	logging.info(f'Prefork Server Listening {host}:{port} workers={workers} reuse_port={supervisor.reuse_port}')
+	log_routes()
+	supervisor.run()
@@ -0,0 +1,119 @@
+import os
+import sys
+import select
+import socket
+import logging
+import threading
+import subprocess
+
+import config
+
+"""
+	リスニングソケットを引き継ぐ再起動(ゼロダウンタイム)
+	restart.py:
+		- inherited_listener関数
+		- notify_ready関数
+		- spawn_successor関数
+		- Handoffクラス
+
+	SIGUSR2を受けたプロセスは、同じ引数で新しいプロセスを起動してリスニングソケットのfdを受け継がせる
+		環境変数 LISTEN_FD	- 受け継いだリスニングソケットのfd番号
+		環境変数 READY_FD	- 準備ができたら1バイト書くパイプのfd番号
+	新しいプロセスが受付を始めたら(notify_ready)、古いプロセスは受付をやめ、処理中のリクエストを終えてから終了する
+	ソケット自体はどちらかのプロセスが開いている間は閉じないので、切り替えの間に届いた接続も
+	接続待ちキューに残って新しいプロセスが受け付ける(接続を拒否しない)
+
+	新しいプロセスがRESTART_TIMEOUT秒以内に準備できなければ(設定ファイルの誤りなど)止めて、
+	古いプロセスがそのまま動き続ける
+
+	リスニングソケットのO_NONBLOCKはプロセス間で共有されるので、どのモードもノンブロッキングで扱う
+	(thread / poolはsettimeoutでacceptを待つ)
+"""
+
+LISTEN_FD = 'LISTEN_FD'
+READY_FD = 'READY_FD'
+
+# 古いプロセスから受け継いだリスニングソケット、なければNone
+def	inherited_listener() -> socket.socket | None:
+	fd = os.environ.pop(LISTEN_FD, None)
+	if fd is None:
+		return None
+	server_socket = socket.socket(fileno=int(fd))
+	server_socket.set_inheritable(False)
+	logging.info(f'inherited_listener: listening socket fd={fd} from pid={os.getppid()}')
+	return server_socket
+
+# 受付を始めたことを古いプロセスに知らせ、PID_FILEを書き換える
+def	notify_ready():
+	if config.PID_FILE:
+		temp = f'{config.PID_FILE}.{os.getpid()}'
+		with open(temp, 'w') as file:
+			file.write(f'{os.getpid()}\n')
+		os.replace(temp, config.PID_FILE)		# 読む側が書きかけを見ないよう置き換える
+	fd = os.environ.pop(READY_FD, None)
+	if fd is None:
+		return
+	try:
+		os.write(int(fd), b'1')
+	except OSError:
+		logging.exception('notify_ready: cannot notify the old process')
+	finally:
+		os.close(int(fd))
+
+# 新しいプロセスを起動し、受付を始めるまで待つ(始めたらTrue)
+def	spawn_successor(server_socket) -> bool:
+	ready_r, ready_w = os.pipe()
+	listen_fd = server_socket.fileno()
+	env = dict(os.environ, **{LISTEN_FD: str(listen_fd), READY_FD: str(ready_w)})
+	try:
+		# orig_argv: インタープリターのオプション(-Xなど)も含めた起動時の引数
+		proc = subprocess.Popen([sys.executable, *sys.orig_argv[1:]], env=env, pass_fds=(listen_fd, ready_w))
+	except OSError:
+		logging.exception('spawn_successor: cannot start a new process')
+		os.close(ready_r)
+		return False
+	finally:
+		os.close(ready_w)
+
+	try:
+		readable, _, _ = select.select([ready_r], [], [], config.RESTART_TIMEOUT)
+		ready = bool(readable) and os.read(ready_r, 1) == b'1'		# 先に終了したら空になる
+	finally:
+		os.close(ready_r)
+	if not ready:
+		logging.error(f'spawn_successor: new process pid={proc.pid} did not become ready, keep serving')
+		proc.kill()
+		proc.wait()
+		return False
+	logging.info(f'spawn_successor: new process pid={proc.pid} is accepting, draining pid={os.getpid()}')
+	return True
+
+class Handoff:
+	"""
+		SIGUSR2からの再起動の進み具合
+		シグナルハンドラーはrequestでフラグを立てるだけにし(スレッドの起動などはロックを取るので行わない)、
+		各モードのループがpollを呼んで新しいプロセスの起動を別スレッドで始める
+	"""
+	def	__init__(self):
+		self.requested = False
+		self.spawning = False
+		self.done = False
+
+	def	request(self, signum=None, frame=None):
+		self.requested = True
+
+	# 新しいプロセスが受付を始めていればTrue(呼び出し側は受付をやめてdrainする)
+	def	poll(self, server_socket) -> bool:
+		if self.requested and not self.spawning and not self.done:
+			self.requested = False
+			self.spawning = True
+			threading.Thread(target=self.spawn, args=(server_socket,), name='handoff', daemon=True).start()
+		return self.done
+
+	def	spawn(self, server_socket):
+		try:
+			self.done = spawn_successor(server_socket)
+		except Exception:
+			logging.exception('Exception spawn/Handoff:')
+		finally:
+			self.spawning = False
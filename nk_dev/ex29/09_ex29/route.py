@@ -1,18 +1,66 @@
-import re
 import html
+import ssl
+import json
+import asyncio
+import inspect
 import logging
-import mimetypes
+import functools
+import threading
 from pathlib import Path
+from collections import OrderedDict
 
 import config
-from http import Request
+from http import Request, Part
+from static_cache import static_cache
+from metrics import metrics
+from compress import CODINGS, is_compressible, negotiate, compress, encoded_etag
+from serialize import serialize_head
+from template import Template
 from textwrap import dedent
 
 routes = []
 STATIC_DIR = Path(__file__).parent / 'static'
+STATIC_ROOT = str(STATIC_DIR.resolve())
 config.setup_logging()
 
+IOV_MAX = 64		# 1回のsendmsgに渡すバッファの数の上限
+
+# ストリーミング中にボディの生成に失敗した(ヘッダーは送信済みなので500は返せず、接続を切る)
+class StreamAborted(ConnectionError):
+	pass
+
+# 送信した分だけバッファのリストを進める(部分送信に対応)
+def	advance_buffers(views: list, sent: int):
+	while sent:
+		length = len(views[0])
+		if sent < length:
+			views[0] = views[0][sent:]
+			return
+		sent -= length
+		views.pop(0)
+
+# sendallのsendmsg版、バッファを連結せずにまとめて送る(ブロッキングソケット用)
+def	sendmsg_all(client_socket, buffers):
+	if isinstance(client_socket, ssl.SSLSocket):
+		# TLSのソケットはsendmsgを使えない(どのみち暗号化でコピーするので、1つずつsendallする)
+		for buffer in buffers:
+			client_socket.sendall(buffer)
+		return
+	# ほとんどの場合は1回で送り切れるので、部分送信の時だけmemoryviewにする
+	sent = client_socket.sendmsg(buffers[:IOV_MAX])
+	if sent == sum(map(len, buffers)):
+		return
+	views = [memoryview(buffer) for buffer in buffers if buffer]
+	advance_buffers(views, sent)
+	while views:
+		advance_buffers(views, client_socket.sendmsg(views[:IOV_MAX]))
+
 class Response:
+	"""
+		body: str / bytes、またはstr / bytesを返すイテラブル(ジェネレーター)
+		イテラブルならContent-Lengthを付けずに Transfer-Encoding: chunked で少しずつ送る
+		(HTTP/1.0のクライアントにはchunkedを使わず、送り終えたら接続を閉じる)
+	"""
 	def	__init__(self, status=200, reason='OK', headers=None, body=''):
 		self.status = status
 		self.reason = reason
@@ -20,34 +68,384 @@ class Response:
 		self.body = body
 
 		if 'Connection' not in self.headers:
-			headers['Connection'] = 'close'
+			self.headers['Connection'] = 'close'
 		if 'Content-Type' not in self.headers:
-			headers['Content-Type'] = 'text/html; charset=utf-8'
+			self.headers['Content-Type'] = 'text/html; charset=utf-8'
+		if self.is_stream():
+			self.headers.pop('Content-Length', None)
+			self.headers['Transfer-Encoding'] = 'chunked'
+
+	def	is_stream(self) -> bool:
+		return not isinstance(self.body, (str, bytes, bytearray))
+
+	def	is_chunked(self) -> bool:
+		return self.headers.get('Transfer-Encoding') == 'chunked'
+
+	# HTTP/1.0向け: chunkedをやめ、接続を閉じてボディの終わりを伝える
+	def	unchunk(self):
+		self.headers.pop('Transfer-Encoding', None)
+
+	# ステータス行とヘッダー(空行まで)
+	# ヘッダーの検証はserialize_headで行い、CR / LFなどを含むとHeaderError(ヘッダーインジェクション防止)
+	def	head_bytes(self):
+		return serialize_head(self.status, self.reason, self.headers)
+
+	# ヘッダーとボディを連結せず、別々のバッファとして返す
+	def	buffers(self) -> list:
+		body = self.body
+		if isinstance(body, str):
+			body = body.encode('utf-8', errors='replace')
+		return [self.head_bytes(), body]
+
+	# sendmsgを使えない場合用(ボディのコピーを作る)
+	def	to_bytes(self):
+		return b''.join(buffer for frame in self.frames() for buffer in frame)
+
+	# 1回のsendmsgで送るバッファのリストを順に返す
+	# ストリーミングではSTREAM_CHUNKバイト(最大IOV_MAX個)ずつ1つのチャンクにまとめる
+	def	frames(self):
+		if not self.is_stream():
+			yield self.buffers()
+			return
+
+		chunked = self.is_chunked()
+		yield [self.head_bytes()]
+		batch = []
+		size = 0
+		try:
+			for piece in self.body:
+				if isinstance(piece, str):
+					piece = piece.encode('utf-8', errors='replace')
+				if not piece:
+					continue
+				batch.append(piece)
+				size += len(piece)
+				if config.STREAM_CHUNK <= size or IOV_MAX - 2 <= len(batch):
+					yield [f'{size:x}\r\n'.encode('ascii'), *batch, b'\r\n'] if chunked else batch
+					batch = []
+					size = 0
+		except Exception as e:
+			logging.exception('frames/Response: body generator failed')
+			raise StreamAborted('frames/Response: body generator failed') from e
+		if batch:
+			yield [f'{size:x}\r\n'.encode('ascii'), *batch, b'\r\n'] if chunked else batch
+		if chunked:
+			yield [b'0\r\n\r\n']
+
+	def	send(self, client_socket):
+		for frame in self.frames():
+			sendmsg_all(client_socket, frame)
+
+class FileResponse(Response):
+	"""
+		ボディをファイルから直接送るレスポンス
+		ヘッダーだけをsendallし、ボディはsocket.sendfile(os.sendfile)で
+		カーネルからそのまま送るので、Python側にファイルの中身をコピーしない
+
+		segments: 送る順番に並べたリスト
+			(offset, count)	- ファイルのoffsetからcountバイト
+			bytes			- そのまま送るバイト列(multipart/byterangesの区切りなど)
+	"""
+	def	__init__(self, status, reason, headers, file_path, segments):
+		super().__init__(status, reason, headers, body=b'')
+		self.file_path = file_path
+		self.segments = segments
 
 	def	to_bytes(self):
-		response = f'HTTP/1.1 {self.status} {self.reason}\r\n'
-		for label, detail in self.headers.items():
-			# ヘッダーインジェクション防止
-			response += f'{label}: {detail}\r\n'
-		response += '\r\n'
-		response = response.encode('utf-8', errors='replace')
-
-		if isinstance(self.body, bytes):
-			response += self.body
-		else:
-			response += self.body.encode('utf-8', errors='replace')
+		# sendfileを使えない場合用(ボディを読み込むのでメモリを使う)
+		response = bytearray(self.head_bytes())
+		with open(self.file_path, 'rb') as file:
+			for segment in self.segments:
+				if isinstance(segment, tuple):
+					file.seek(segment[0])
+					response += file.read(segment[1])
+				else:
+					response += segment
+		return bytes(response)
+
+	def	send(self, client_socket):
+		client_socket.sendall(self.head_bytes())
+		with open(self.file_path, 'rb') as file:
+			for segment in self.segments:
+				if isinstance(segment, tuple):
+					client_socket.sendfile(file, segment[0], segment[1])
+				else:
+					client_socket.sendall(segment)
+
+class CacheEntry:
+	"""
+		変更しないレスポンスをエンコード済みで持つ
+		ヘッダーの組み合わせ(keep-alive/closeなど)ごとに、ヘッダー部分のバイト列を一度だけ作る
+		(ボディは組み合わせごとにコピーせず、全て同じbytesを送る)
+	"""
+	MAX_VARIANTS = 8
+
+	def	__init__(self, response_obj: Response):
+		self.status = response_obj.status
+		self.reason = response_obj.reason
+		self.headers = dict(response_obj.headers)
+		body = response_obj.body
+		if response_obj.is_stream():
+			# キャッシュするものはストリーミングせず、まとめてContent-Lengthを付ける
+			body = b''.join(piece.encode('utf-8', errors='replace') if isinstance(piece, str) else piece for piece in body)
+			del self.headers['Transfer-Encoding']
+			self.headers['Content-Length'] = len(body)
+		self.body = body if isinstance(body, bytes) else body.encode('utf-8', errors='replace')
+		self.variants = {}
+		self.encodings = {}		# coding -> 圧縮したボディのCacheEntry(圧縮しても小さくならなければNone)
+
+	# 圧縮したボディのCacheEntryを一度だけ作る
+	def	encoded(self, coding: str):
+		if coding in self.encodings:
+			return self.encodings[coding]
+		body = compress(self.body, coding)
+		entry = None
+		if len(body) < len(self.body):
+			entry = CacheEntry(Response(self.status, self.reason, encoded_headers(self.headers, coding, body), body))
+		return self.encodings.setdefault(coding, entry)
+
+	def	head(self, headers: dict) -> bytes:
+		key = tuple(headers.items())
+		data = self.variants.get(key)
+		if data is None:
+			data = serialize_head(self.status, self.reason, headers)
+			if len(self.variants) < self.MAX_VARIANTS:
+				self.variants[key] = data
+		return data
+
+class CachedResponse(Response):
+	# CacheEntryを共有し、ヘッダーだけをリクエストごとにコピーする
+	# (set_connection_headerが書き換えても他のリクエストに影響しない)
+	def	__init__(self, entry: CacheEntry):
+		self.status = entry.status
+		self.reason = entry.reason
+		self.headers = dict(entry.headers)
+		self.body = entry.body
+		self.entry = entry
+
+	def	head_bytes(self):
+		return self.entry.head(self.headers)
+
+# 引数ごとに一度だけ作るレスポンス(エラーページなど)
+def	prerendered(builder):
+	entries = {}
+
+	@functools.wraps(builder)
+	def	wrapper(*args):
+		entry = entries.get(args)
+		if entry is None:
+			entry = entries.setdefault(args, CacheEntry(builder(*args)))
+		return CachedResponse(entry)
+	return wrapper
+
+class ResponseCache:
+	# cacheableなハンドラーのレスポンスを持つLRU(スレッド間で共有するのでlockで守る)
+	def	__init__(self, max_entries):
+		self.max_entries = max_entries
+		self.entries = OrderedDict()
+		self.lock = threading.Lock()
+		self.hits = 0
+		self.misses = 0
+
+	def	get(self, key) -> CacheEntry | None:
+		with self.lock:
+			entry = self.entries.get(key)
+			if entry is None:
+				self.misses += 1
+				return None
+			self.entries.move_to_end(key)
+			self.hits += 1
+			return entry
+
+	def	put(self, key, entry: CacheEntry):
+		with self.lock:
+			self.entries[key] = entry
+			self.entries.move_to_end(key)
+			while self.max_entries < len(self.entries):
+				self.entries.popitem(last=False)
+
+	def	stats(self) -> dict:
+		with self.lock:
+			return {'entries': len(self.entries), 'hits': self.hits, 'misses': self.misses}
+
+response_cache = ResponseCache(config.RESPONSE_CACHE_ENTRIES)
+metrics.register('static_cache', static_cache.stats)
+metrics.register('response_cache', response_cache.stats)
+
+# パスとクエリが同じなら同じレスポンスを返すハンドラーに付けるデコレーター
+# files: 中身に使っている静的ファイル(更新されたらキャッシュを作り直す)
+def	cacheable(files=()):
+	def	decorator(handler):
+		def	make_key(request_obj: Request) -> tuple:
+			query = tuple(sorted((label, tuple(detail)) for label, detail in request_obj.query.items()))
+			validators = []
+			for name in files:
+				file_entry = static_cache.get(Path(STATIC_ROOT) / name)		# static_searchと同じresolve()済みのキー
+				validators.append(file_entry.etag if file_entry else None)
+			return (handler.__name__, request_obj.path, query, tuple(validators))
+
+		# async defのハンドラーにはコルーチンを返すラッパーを被せる
+		if inspect.iscoroutinefunction(handler):
+			@functools.wraps(handler)
+			async def	async_wrapper(request_obj: Request, **kwargs) -> Response:
+				key = make_key(request_obj)
+				entry = response_cache.get(key)
+				if entry is None:
+					entry = CacheEntry(await handler(request_obj=request_obj, **kwargs))
+					response_cache.put(key, entry)
+				return CachedResponse(entry)
+			return async_wrapper
+
+		@functools.wraps(handler)
+		def	wrapper(request_obj: Request, **kwargs) -> Response:
+			key = make_key(request_obj)
+			entry = response_cache.get(key)
+			if entry is None:
+				entry = CacheEntry(handler(request_obj=request_obj, **kwargs))
+				response_cache.put(key, entry)
+			return CachedResponse(entry)
+		return wrapper
+	return decorator
+
+def	encoded_headers(headers: dict, coding: str, body: bytes) -> dict:
+	headers = dict(headers)
+	headers['Content-Encoding'] = coding
+	headers['Content-Length'] = len(body)
+	headers['Vary'] = 'Accept-Encoding'
+	return headers
+
+# ハンドラーのレスポンスをAccept-Encodingに応じて圧縮する
+# Varyが付いているもの(static_searchで交渉済み)、FileResponse、小さいもの、テキスト以外はそのまま
+def	compress_response(response_obj: Response, request_obj: Request) -> Response:
+	if response_obj.status != 200 or isinstance(response_obj, FileResponse):
+		return response_obj
+	headers = response_obj.headers
+	if 'Vary' in headers or 'Content-Encoding' in headers or not is_compressible(headers.get('Content-Type', '')):
+		return response_obj
+	# ストリーミングのボディはまとめて圧縮すると逐次送信にならないので、そのまま送る
+	if response_obj.is_stream() or int(headers.get('Content-Length', 0)) < config.COMPRESS_MIN_SIZE:
+		return response_obj
+	headers['Vary'] = 'Accept-Encoding'		# 圧縮しない場合も、共有キャッシュが取り違えないように
+	coding = negotiate(request_obj.headers.get('Accept-Encoding'), CODINGS)
+	if coding is None:
+		return response_obj
+
+	# キャッシュ済みのレスポンスは圧縮したものもキャッシュする
+	if isinstance(response_obj, CachedResponse):
+		entry = response_obj.entry.encoded(coding)
+		return CachedResponse(entry) if entry else response_obj
+
+	body = response_obj.body
+	if not isinstance(body, bytes):
+		body = body.encode('utf-8', errors='replace')
+	encoded = compress(body, coding)
+	if len(body) <= len(encoded):
+		return response_obj
+	return Response(response_obj.status, response_obj.reason, encoded_headers(headers, coding, encoded), encoded)
+
+# keep-aliveするかどうかをレスポンスヘッダーに反映
+# 実際にkeep-aliveするかどうかを返す
+# (chunkedを使わないストリーミングはボディの終わりを接続の切断で伝えるので閉じる)
+def	set_connection_header(response_obj: Response, keep_alive: bool) -> bool:
+	if response_obj.is_stream() and not response_obj.is_chunked():
+		keep_alive = False
+	if keep_alive:
+		response_obj.headers['Connection'] = 'keep-alive'
+		response_obj.headers['Keep-Alive'] = \
+			f'timeout={int(config.KEEPALIVE_TIMEOUT)}, max={config.MAX_KEEPALIVE_REQUESTS}'
+	else:
+		response_obj.headers['Connection'] = 'close'
+	return keep_alive
+
+class RouteNode:
+	# パスの1セグメント分のノード
+	__slots__ = ('children', 'param', 'param_node', 'handlers', 'path')
+
+	def	__init__(self):
+		self.children = {}		# 固定セグメント -> RouteNode(辞書で引く)
+		self.param = None		# <param>の名前
+		self.param_node = None	# <param>の次のノード
+		self.handlers = {}		# メソッド -> ハンドラー
+		self.path = None		# 登録されたパス(計測のラベルに使う)
+
+class Router:
+	"""
+		登録されたパスをセグメント単位のトライ木にしたルーター
+		- 固定セグメントは辞書で引き、<param>のセグメントは正規表現を使わずにそのまま取り出す
+		- 固定セグメントを優先し、行き止まりなら<param>側に戻って探す
+		- 同じパス・メソッドの二重登録や、同じ位置で名前の違う<param>は登録時にエラー
+	"""
+	def	__init__(self):
+		self.root = RouteNode()
+
+	@staticmethod
+	def	split(path: str) -> list:
+		path = path.strip('/')
+		return path.split('/') if path else []
+
+	def	add(self, path: str, methods, handler):
+		node = self.root
+		for segment in self.split(path):
+			if segment.startswith('<') and segment.endswith('>'):
+				name = segment[1:-1]
+				if not name.isidentifier():
+					raise ValueError(f'add/Router: invalid parameter {segment} in {path}')
+				if node.param is not None and node.param != name:
+					raise ValueError(f'add/Router: <{name}> conflicts with <{node.param}> in {path}')
+				if node.param_node is None:
+					node.param = name
+					node.param_node = RouteNode()
+				node = node.param_node
+			else:
+				node = node.children.setdefault(segment, RouteNode())
+
+		for method in methods:
+			if method in node.handlers:
+				raise ValueError(f'add/Router: {method} {path} is already registered')
+			node.handlers[method] = handler
+		node.path = path
+
+	# 見つかれば(ハンドラーの辞書, パラメーター, 登録されたパス)、パスがなければNone
+	def	find(self, path: str):
+		params = {}
+		node = self.walk(self.root, self.split(path), 0, params)
+		if node is None:
+			return None
+		return node.handlers, params, node.path
+
+	def	walk(self, node, segments, index, params):
+		if index == len(segments):
+			return node if node.handlers else None
+
+		segment = segments[index]
+		child = node.children.get(segment)
+		if child is not None:
+			found = self.walk(child, segments, index + 1, params)
+			if found is not None:
+				return found
+
+		if node.param_node is not None:
+			found = self.walk(node.param_node, segments, index + 1, params)
+			if found is not None:
+				params[node.param] = segment
+				return found
+		return None
 
-		return response
+router = Router()
 
 # ルーティング関数
-def	route(path: str):
+def	route(path: str, methods=('GET',)):
 	def	register(handler):
-		pattern = re.sub(r'<(\w+)>', r'(?P<\1>[^/]+)', path)
-		pattern = f'^{pattern}$'
-		routes.append((re.compile(pattern), handler))
+		router.add(path, methods, handler)
+		routes.append((path, tuple(methods), handler))
 		return handler
 	return register
 
+def	log_routes():
+	logging.info('routes:')
+	for path, methods, handler in routes:
+		logging.info(f'\t{",".join(methods):<10}{path:<30}:{handler.__name__:>15}')
+
 def	create_html(title, h1, content):
 
 	# dedent関数を使うと複数行のcontentへの対応が複雑化するので却下
@@ -67,10 +465,34 @@ def	create_html(title, h1, content):
 
 	return '\n'.join(html)
 
+# create_htmlのジェネレーター版、contentもイテラブルで受け取り順に返す
+def	stream_html(title, h1, content):
+	yield '\n'.join([
+		'<!DOCTYPE html>',
+		'<html lang="ja">',
+		'<head>',
+		'\t<meta charset="utf-8">',
+		f'\t<title>{title}</title>',
+		'</head>',
+		'<body>',
+		f'\t<h1>{h1}</h1>',
+		''
+	])
+	yield from content
+	yield '\n</body>\n</html>'
+
+# create_htmlと同じ枠のテンプレート(title, h1はエスケープ、contentは組み立て済みのHTML)
+PAGE = Template('page', create_html('{{title}}', '{{h1}}', '{{!content}}'))
+# ユーザーページ(レンダリング結果はhandle_userのcacheableが使い回す)
+USER_PAGE = Template(
+	'user',
+	create_html('User Page', 'Welcome {{user_id}} !', '\t<p>これはユーザーページのダミーです</p>\n')
+)
+
 @route('/')
+@cacheable(files=('index.html',))
 def handle_html(**kwargs) -> Response:	# ハンドラー捜索の際、一貫してアンパック引数を渡す
-	file_path = STATIC_DIR / 'index.html'
-	file_path = file_path.resolve()
+	file_path = Path(STATIC_ROOT) / 'index.html'
 	body = file_path.read_text('utf-8')
 	length = len(body.encode('utf-8', errors='replace'))
 
@@ -85,9 +507,9 @@ def handle_html(**kwargs) -> Response:	# ハンドラー捜索の際、一貫し
 	)
 
 @route('/about')
+@cacheable(files=('about.html',))
 def	handle_about(**kwargs) -> Response:
-	file_path = STATIC_DIR / 'about.html'
-	file_path = file_path.resolve()
+	file_path = Path(STATIC_ROOT) / 'about.html'
 	body = file_path.read_text('utf-8')
 	length = len(body.encode('utf-8', errors='replace'))
 
@@ -102,14 +524,10 @@ def	handle_about(**kwargs) -> Response:
 	)
 
 @route('/user/<user_id>')
+@cacheable()
 def	handle_user(user_id: str, **kwargs) -> Response:
-	user_id = html.escape(user_id)
-	title = 'User Page'
-	h1 = f'Welcome {user_id} !'
-	content = '\t<p>これはユーザーページのダミーです</p>\n'
-
-	body = create_html(title, h1, content)
-	length = len(body.encode('utf-8', errors='replace'))
+	body = USER_PAGE.render(user_id=user_id)		# user_idはテンプレートがエスケープする
+	length = len(body)
 
 	return Response(
 		status=200,
@@ -122,23 +540,38 @@ def	handle_user(user_id: str, **kwargs) -> Response:
 	)
 
 @route('/search')
+@cacheable()
 def	handle_search(request_obj: Request, **kwargs) -> Response:
-	title = 'Search Page'
-	h1 = 'Search Page'
-	content = '\t<p>これは検索ページのダミーです</p>\n'
-	content += '\t<p>以下はあなたが入力したクエリです</p>\n'
-	content += '\t<ul>\n'
-
-
-	for label, detail in request_obj.query.items():
-		label = html.escape(label)
-		detail = ','.join(detail)
-		detail = html.escape(detail)
-		content += f'\t\t<li>{label}: {detail}</li>\n'
-	content += '\t</ul>\n'
+	def	content():
+		yield '\t<p>これは検索ページのダミーです</p>\n'
+		yield '\t<p>以下はあなたが入力したクエリです</p>\n'
+		yield '\t<ul>\n'
+		for label, detail in request_obj.query.items():
+			label = html.escape(label)
+			detail = ','.join(detail)
+			detail = html.escape(detail)
+			yield f'\t\t<li>{label}: {detail}</li>\n'
+		yield '\t</ul>\n'
+
+	# cacheableなので、ストリーミングせずCacheEntryでまとめて1回だけエンコードされる
+	return Response(
+		status=200,
+		reason='OK',
+		headers={'Content-Type': 'text/html; charset=utf-8'},
+		body=stream_html('Search Page', 'Search Page', content())
+	)
 
-	body = create_html(title, h1, content)
-	length = len(body.encode('utf-8', errors='replace'))
+# async defのハンドラーの例
+# asyncモードではイベントループ上でawaitされ、thread/event/poolモードではasyncio.runで実行される
+@route('/async')
+async def	handle_async(**kwargs) -> Response:
+	await asyncio.sleep(0)		# 他の接続に処理を譲る
+	body = PAGE.render(
+		title='Async Page',
+		h1='Async Page',
+		content='\t<p>これはasync defのハンドラーが返したページです</p>\n'
+	)
+	length = len(body)
 
 	return Response(
 		status=200,
@@ -150,40 +583,154 @@ def	handle_search(request_obj: Request, **kwargs) -> Response:
 		body=body
 	)
 
+# ルートごと・段階ごとのp50/p95/p99とキャッシュの統計をJSONで返す
+# preforkモードでは応答したワーカー1つ分の値(pidで区別できる)
+@route('/__stats')
+def	handle_stats(**kwargs) -> Response:
+	body = json.dumps(metrics.stats(), indent=1)
+	length = len(body.encode('utf-8'))
+
+	return Response(
+		status=200,
+		reason='OK',
+		headers={
+			'Content-Type': 'application/json; charset=utf-8',
+			'Content-Length': length,
+			'Cache-Control': 'no-store'
+		},
+		body=body
+	)
+
 # POSTメソッドに対して入力内容をミラーしたhtmlを作成する
+# 入力が大きくてもページ全体を文字列にせず、chunkedで少しずつ送る
 def	handle_post_method(request_obj: Request) -> Response:
-	title = 'POST Handler'
-	h1 = '200 OK'
-	content = '\t<p>POSTメソッドは正常に処理されました</p>\n'
-	content += '\t<p>以下はあなたが入力したリクエストボディです</p>\n'
-	content += '\t<ul>\n'
+	def	content():
+		yield '\t<p>POSTメソッドは正常に処理されました</p>\n'
+		yield '\t<p>以下はあなたが入力したリクエストボディです</p>\n'
+		yield '\t<ul>\n'
+		for label, detail in request_obj.body.items():
+			label = html.escape(label)
+			if isinstance(detail, Part):
+				yield f'\t\t<li>{label}: len={detail.size}</li>\n'
+				continue
+			detail = ','.join(detail)
+			detail = html.escape(detail)
+			yield f'\t\t<li>{label}: {detail}</li>\n'
+		yield '\t<ul>\n'
 
+	return Response(
+		status=200,
+		reason='OK',
+		headers={'Content-Type': 'text/html; charset=utf-8'},
+		body=stream_html('POST Handler', '200 OK', content())
+	)
 
-	for label, detail in request_obj.body.items():
-		label = html.escape(label)
-		if isinstance(detail, bytes):
-			content += f'\t\t<li>{label}: len={len(detail)}</li>'
-			continue
-		detail = ','.join(detail)
-		detail = html.escape(detail)
-		content += f'\t\t<li>{label}: {detail}</li>\n'
-	content += '\t<ul>\n'
 
-	body = create_html(title, h1, content)
-	length = len(body.encode('utf-8', errors='replace'))
+# Rangeヘッダー(bytes=0-99, 100-, -500)を[(start, end), ...]にする(endを含む)
+# 満たせる範囲がなければ[]、解釈できなければNone(Rangeを無視して200で返す)
+def	parse_range(range_header: str, size: int) -> list | None:
+	unit, _, ranges = range_header.partition('=')
+	if unit.strip().lower() != 'bytes' or not ranges:
+		return None
+
+	result = []
+	for spec in ranges.split(','):
+		first, sep, last = spec.strip().partition('-')
+		if not sep or not (first.isdigit() or last.isdigit()):
+			return None
+		if first and last and not (first.isdigit() and last.isdigit()):
+			return None
+		if not first:					# -500: 末尾500バイト
+			length = int(last)
+			if length == 0:
+				continue
+			result.append((max(0, size - length), size - 1))
+			continue
+		start = int(first)
+		end = int(last) if last else size - 1
+		if last and end < start:
+			return None
+		if size <= start:				# 範囲外は無視
+			continue
+		result.append((start, min(end, size - 1)))
 
+	if config.MAX_RANGES < len(result):	# 細切れの範囲を大量に要求する攻撃への対策
+		return None
+	return result
+
+# If-Rangeがあれば、ファイルが変わっていない時だけRangeに応じる
+def	range_allowed(request_obj: Request, entry) -> bool:
+	if_range = request_obj.headers.get('If-Range')
+	if if_range is None:
+		return True
+	return if_range == entry.etag or if_range == entry.last_modified
+
+# 要求範囲に応じてボディの送り方(segments)とヘッダーを決める
+def	range_segments(ranges: list, entry, headers: dict) -> list:
+	if len(ranges) == 1:
+		start, end = ranges[0]
+		headers['Content-Range'] = f'bytes {start}-{end}/{entry.size}'
+		headers['Content-Length'] = end - start + 1
+		return [(start, end - start + 1)]
+
+	# 複数範囲はmultipart/byterangesで返す
+	boundary = entry.etag.strip('"')
+	segments = []
+	length = 0
+	for start, end in ranges:
+		part_head = (
+			f'\r\n--{boundary}\r\n'
+			f'Content-Type: {entry.mime_type}\r\n'
+			f'Content-Range: bytes {start}-{end}/{entry.size}\r\n\r\n'
+		).encode('ascii')
+		segments.append(part_head)
+		segments.append((start, end - start + 1))
+		length += len(part_head) + end - start + 1
+	tail = f'\r\n--{boundary}--\r\n'.encode('ascii')
+	segments.append(tail)
+	headers['Content-Type'] = f'multipart/byteranges; boundary={boundary}'
+	headers['Content-Length'] = length + len(tail)
+	return segments
+
+# メモリ上のボディからsegmentsの分を切り出す(キャッシュ済みの小さいファイル用)
+def	segments_to_bytes(body: bytes, segments: list) -> bytes:
+	view = memoryview(body)
+	parts = []
+	for segment in segments:
+		if isinstance(segment, tuple):
+			parts.append(view[segment[0]:segment[0] + segment[1]])
+		else:
+			parts.append(segment)
+	return b''.join(parts)
+
+# 静的ファイルを送れる圧縮形式(圧縮済みファイルがあるもの + その場で圧縮できるもの)
+def	static_codings(entry) -> tuple:
+	candidates = set(entry.encoded) | set(entry.siblings)
+	if entry.body is not None and config.COMPRESS_MIN_SIZE <= entry.size and is_compressible(entry.mime_type):
+		candidates.update(CODINGS)
+	return tuple(candidates)
+
+def	encoded_static(file_path, entry, coding, headers) -> Response | None:
+	headers['Content-Encoding'] = coding
+	if coding in entry.siblings:
+		sibling_path, size = entry.siblings[coding]
+		headers['Content-Length'] = size
+		return FileResponse(200, 'OK', headers, sibling_path, [(0, size)])
+
+	body = static_cache.encode(file_path, entry, coding)
+	if entry.size <= len(body):
+		del headers['Content-Encoding']
+		return None
+	headers['Content-Length'] = len(body)
 	return Response(
 		status=200,
 		reason='OK',
-		headers={
-			'Content-Type': 'text/html; charset=utf-8',
-			'Content-Length': length
-		},
+		headers=headers,
 		body=body
 	)
 
-
-def static_search(path: str) -> Response | None:
+# リクエストのパスをSTATIC_DIRの中のresolve()済みのパスにする、外を指していればNone
+def	static_path(path: str) -> Path | None:
 	# file_path変数を作成
 	path = path.lstrip('/')
 	file_path = STATIC_DIR / path
@@ -191,45 +738,99 @@ def static_search(path: str) -> Response | None:
 
 	# セキュリティチェック
 	try:
-		if not str(file_path).startswith(str(STATIC_DIR.resolve())):
-			logging.warning('static_search: Invalid path')
+		if not str(file_path).startswith(STATIC_ROOT):
+			logging.warning('static_path: Invalid path')
 			return None
 	except Exception as e:
-		logging.warning('Exception static_search: Invalid path')
+		logging.warning('Exception static_path: Invalid path')
 		return None
+	return file_path
 
-	# パスが存在するか確認
-	if not file_path.exists() or not file_path.is_file():
-		logging.info('static_search: path is not exists or not file')
-		return None
+# 静的ファイルがあるか(GET / HEAD以外のメソッドに405を返すかどうか)
+def	static_exists(path: str) -> bool:
+	file_path = static_path(path)
+	return file_path is not None and file_path.is_file()
 
-	# ファイル形式の確認
-	mime_type, _ = mimetypes.guess_type(file_path)
-	if not mime_type:
-		mime_type = 'application/octet-stream'	# ファイル形式が不明なら記述
+# HEAD向け: ヘッダー(Content-Lengthを含む)はそのままで、ボディを送らないレスポンス
+def	head_response(response_obj: Response) -> Response:
+	return Response(
+		status=response_obj.status,
+		reason=response_obj.reason,
+		headers=response_obj.headers,
+		body=b''
+	)
 
-	# ファイルの読み込み
-	try:
-		if mime_type.startswith('text/') or \
-			mime_type in ['application/javascript', 'application/json']:
-			body = file_path.read_text('utf-8')
-			length = len(body.encode('utf-8', errors='replace'))
-		else:
-			body = file_path.read_bytes()
-			length = len(body)
-	except IOError:
-		logging.error('static_search: Cannot read the file')
+def static_search(path: str, request_obj: Request | None = None) -> Response | None:
+	file_path = static_path(path)
+	if file_path is None:
 		return None
-	except Exception as e:
-		logging.error('Exception static_search: Cannot read the file')
+
+	# キャッシュから取得(なければ読み込んでキャッシュ)
+	# ファイルでなければNone、更新されていれば読み直される
+	# 大きなファイルはメタデータだけで、entry.bodyはNone
+	entry = static_cache.get(file_path)
+	if entry is None:
+		logging.info('static_search: path is not exists or not file')
 		return None
 
+	headers = {
+		'Content-Type': entry.mime_type,
+		'ETag': entry.etag,
+		'Last-Modified': entry.last_modified,
+		'Accept-Ranges': 'bytes'
+	}
+
+	# 圧縮できる表現があればAccept-Encodingで選ぶ(Rangeの時は圧縮しない)
+	candidates = static_codings(entry)
+	coding = None
+	if candidates:
+		headers['Vary'] = 'Accept-Encoding'
+		if request_obj is not None and 'Range' not in request_obj.headers:
+			coding = negotiate(request_obj.headers.get('Accept-Encoding'), candidates)
+	if coding:
+		headers['ETag'] = encoded_etag(entry.etag, coding)
+
+	# 条件付きリクエストならボディを送らずに304
+	if request_obj is not None and entry.not_modified(request_obj.headers, headers['ETag']):
+		return Response(
+			status=304,
+			reason='Not Modified',
+			headers=headers,
+			body=b''
+		)
+
+	if coding:
+		response_obj = encoded_static(file_path, entry, coding, headers)
+		if response_obj:
+			return response_obj
+		headers['ETag'] = entry.etag		# 圧縮しても小さくならなければそのまま送る
+
+	# Rangeがあれば206(満たせなければ416)
+	status, reason = 200, 'OK'
+	segments = [(0, entry.size)]
+	headers['Content-Length'] = entry.size
+	range_header = request_obj.headers.get('Range') if request_obj is not None else None
+	if range_header and range_allowed(request_obj, entry):
+		ranges = parse_range(range_header, entry.size)
+		if ranges == []:
+			return Response(
+				status=416,
+				reason='Range Not Satisfiable',
+				headers={'Content-Range': f'bytes */{entry.size}', 'Content-Length': 0},
+				body=b''
+			)
+		if ranges:
+			status, reason = 206, 'Partial Content'
+			segments = range_segments(ranges, entry, headers)
+
+	# 大きなファイルはsendfileで送る
+	if entry.body is None:
+		return FileResponse(status, reason, headers, file_path, segments)
+
+	body = entry.body if status == 200 else segments_to_bytes(entry.body, segments)
 	return Response(
-		status=200,
-		reason='OK',
-		headers={
-			'Content-Type': mime_type,
-			'Content-Length': length
-		},
+		status=status,
+		reason=reason,
+		headers=headers,
 		body=body
 	)
@@ -0,0 +1,68 @@
+import re
+import functools
+
+import config
+
+"""
+	レスポンスのステータス行とヘッダーのシリアライズ
+	serialize.py:
+		- HeaderErrorクラス
+		- status_line関数
+		- serialize_head関数
+
+	ヘッダー名はRFC 9110のtoken、値はHTAB以外の制御文字(CR / LFを含む)を拒否する(ヘッダーインジェクション防止)
+	検証とエンコードの結果はキャッシュし、同じものは2回目から検証しない
+		- ステータス行・ヘッダー名の "Label: " は全てキャッシュ
+		- 値の種類が少ないヘッダー(CACHED_LABELS)は行全体をキャッシュ
+		- Content-LengthやETagなど毎回変わる値は、その都度検証してつなぐ
+	ヘッダー部分は1回のjoinで1つのbytesにし、ボディとは連結しない(sendmsgで別のバッファとして送る)
+"""
+
+TOKEN = re.compile(r"[!#$%&'*+\-.^_`|~0-9A-Za-z]+")
+FORBIDDEN = re.compile(r'[\x00-\x08\x0a-\x1f\x7f]')
+CRLF = b'\r\n'
+
+# 値の種類が少なく、行全体をキャッシュするヘッダー
+CACHED_LABELS = frozenset({
+	'Connection', 'Keep-Alive', 'Content-Type', 'Transfer-Encoding', 'Content-Encoding',
+	'Vary', 'Cache-Control', 'Accept-Ranges', 'Allow', 'Retry-After'
+})
+
+# サーバー側の誤り(ハンドラーが不正なヘッダーを作った)なので、400ではなく500にする
+class HeaderError(Exception):
+	pass
+
+def	encode_detail(detail) -> bytes:
+	if isinstance(detail, int):
+		return str(detail).encode('ascii')
+	detail = str(detail)
+	if FORBIDDEN.search(detail):
+		raise HeaderError(f'encode_detail: invalid header value {detail!r}')
+	return detail.encode('utf-8', errors='replace')
+
+@functools.lru_cache(maxsize=config.HEADER_CACHE_ENTRIES)
+def	status_line(status: int, reason: str) -> bytes:
+	if FORBIDDEN.search(reason):
+		raise HeaderError(f'status_line: invalid reason {reason!r}')
+	return f'HTTP/1.1 {int(status)} {reason}\r\n'.encode('utf-8', errors='replace')
+
+@functools.lru_cache(maxsize=config.HEADER_CACHE_ENTRIES)
+def	label_prefix(label: str) -> bytes:
+	if not TOKEN.fullmatch(label):
+		raise HeaderError(f'label_prefix: invalid header name {label!r}')
+	return f'{label}: '.encode('ascii')
+
+@functools.lru_cache(maxsize=config.HEADER_CACHE_ENTRIES)
+def	cached_line(label: str, detail) -> bytes:
+	return label_prefix(label) + encode_detail(detail) + CRLF
+
+# ステータス行とヘッダー(空行まで)、不正なものがあればHeaderError
+def	serialize_head(status: int, reason: str, headers: dict) -> bytes:
+	parts = [status_line(status, reason)]
+	for label, detail in headers.items():
+		if label in CACHED_LABELS:
+			parts.append(cached_line(label, detail))
+		else:
+			parts += (label_prefix(label), encode_detail(detail), CRLF)
+	parts.append(CRLF)
+	return b''.join(parts)
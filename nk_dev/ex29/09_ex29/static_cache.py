@@ -0,0 +1,201 @@
+import os
+import stat
+import threading
+import mimetypes
+from collections import OrderedDict
+from email.utils import formatdate, parsedate_to_datetime
+
+import config
+from compress import SUFFIXES, compress
+
+"""
+	静的ファイルのLRUキャッシュ
+	static_cache.py:
+		- StaticEntryクラス(エンコード済みのボディとメタデータ)
+		- StaticCacheクラス
+
+	圧縮したボディもentry.encodedに持ち、1ファイルにつき1回だけ圧縮する
+	隣に .gz / .br / .zst のファイルがあり、元のファイルより新しければそれを使う
+	(小さいファイルは中身を読み込み、大きいファイルはsendfileで送るためパスを持つ)
+
+	キーはresolve()済みのパス
+	STATIC_CACHE_MAX_FILEより大きいファイルはボディを持たず、sendfileで送る
+	毎回os.statだけは行い、mtime・inode・サイズが変わっていたら読み直す
+	ヒットすればexists/is_file/guess_type/ファイル読み込みは行わない
+	handle_clientのスレッドから同時に呼ばれるので、辞書の操作はlockの中で行う
+"""
+
+class StaticEntry:
+	__slots__ = (
+		'body', 'mime_type', 'size', 'mtime', 'mtime_ns', 'inode', 'etag', 'last_modified',
+		'encoded', 'siblings'
+	)
+
+	def	__init__(self, body, mime_type, st):
+		self.body = body
+		self.encoded = {}		# coding -> 圧縮したボディ
+		self.siblings = {}		# coding -> (圧縮済みファイルのパス, サイズ)
+		self.mime_type = mime_type
+		self.size = st.st_size
+		self.mtime = int(st.st_mtime)
+		self.mtime_ns = st.st_mtime_ns
+		self.inode = st.st_ino
+		self.etag = f'"{st.st_ino:x}-{st.st_mtime_ns:x}-{st.st_size:x}"'
+		self.last_modified = formatdate(st.st_mtime, usegmt=True)
+
+	# キャッシュの合計サイズに数えるバイト数
+	def	cost(self) -> int:
+		size = len(self.body) if self.body is not None else 0
+		return size + sum(len(data) for data in self.encoded.values())
+
+	# ファイルが変わっていないか
+	def	matches(self, st) -> bool:
+		return self.mtime_ns == st.st_mtime_ns and self.inode == st.st_ino and self.size == st.st_size
+
+	# If-None-Match / If-Modified-Since に対して304を返せるか
+	# If-None-Matchがあれば、If-Modified-Sinceは見ない(RFC 9110 13.1.3)
+	# etag: 圧縮した表現を送る場合はそのETagで比べる
+	def	not_modified(self, headers, etag=None) -> bool:
+		if_none_match = headers.get('If-None-Match')
+		if if_none_match is not None:
+			tags = [tag.strip().removeprefix('W/') for tag in if_none_match.split(',')]
+			return '*' in tags or (etag or self.etag) in tags
+
+		if_modified_since = headers.get('If-Modified-Since')
+		if if_modified_since is not None:
+			try:
+				since = parsedate_to_datetime(if_modified_since).timestamp()
+			except (TypeError, ValueError):
+				return False
+			return self.mtime <= since
+		return False
+
+class StaticCache:
+	def	__init__(self, max_entries, max_bytes, max_file):
+		self.max_entries = max_entries
+		self.max_bytes = max_bytes
+		self.max_file = max_file		# これより大きいファイルはボディを持たない
+		self.entries = OrderedDict()
+		self.total = 0
+		self.lock = threading.Lock()
+		self.hits = 0
+		self.misses = 0
+		self.evictions = 0
+		self.invalidations = 0
+
+	# ファイルがなければNone
+	def	get(self, file_path) -> StaticEntry | None:
+		key = str(file_path)
+		try:
+			st = os.stat(key)
+		except OSError:
+			self.discard(key)
+			return None
+		if not stat.S_ISREG(st.st_mode):
+			return None
+
+		with self.lock:
+			entry = self.entries.get(key)
+			if entry is not None:
+				if entry.matches(st):
+					self.entries.move_to_end(key)
+					self.hits += 1
+					return entry
+				# 更新されていたら捨てて読み直す
+				self.remove(key)
+				self.invalidations += 1
+			self.misses += 1
+
+		entry = self.load(key)
+		if entry is not None:
+			self.store(key, entry)
+		return entry
+
+	# ファイルを開いてからfstatするので、statと中身が食い違わない
+	# max_fileより大きなファイルは読み込まずメタデータだけ(sendfileで送る)
+	def	load(self, key) -> StaticEntry | None:
+		mime_type, _ = mimetypes.guess_type(key)
+		if not mime_type:
+			mime_type = 'application/octet-stream'	# ファイル形式が不明なら記述
+		try:
+			with open(key, 'rb') as file:
+				st = os.fstat(file.fileno())
+				body = file.read() if st.st_size <= self.max_file else None
+		except OSError:
+			return None
+		entry = StaticEntry(body, mime_type, st)
+		self.load_siblings(key, entry, st)
+		return entry
+
+	# 元のファイルより新しい圧縮済みファイルを探す
+	def	load_siblings(self, key, entry, st):
+		for coding, suffix in SUFFIXES.items():
+			try:
+				with open(key + suffix, 'rb') as file:
+					sibling = os.fstat(file.fileno())
+					if not stat.S_ISREG(sibling.st_mode) or sibling.st_mtime_ns < st.st_mtime_ns:
+						continue
+					if entry.body is not None and sibling.st_size <= self.max_file:
+						entry.encoded[coding] = file.read()
+					else:
+						entry.siblings[coding] = (key + suffix, sibling.st_size)
+			except OSError:
+				continue
+
+	# 圧縮したボディを返す(なければ圧縮してキャッシュする)
+	# 圧縮はlockの外で行うので、同時に来たリクエストが同じファイルを圧縮することはある
+	def	encode(self, file_path, entry, coding) -> bytes:
+		data = entry.encoded.get(coding)
+		if data is not None:
+			return data
+		data = compress(entry.body, coding)
+		key = str(file_path)
+		with self.lock:
+			if self.entries.get(key) is entry and coding not in entry.encoded:
+				entry.encoded[coding] = data
+				self.total += len(data)
+				self.evict()
+		return data
+
+	def	store(self, key, entry):
+		with self.lock:
+			if key in self.entries:
+				self.remove(key)
+			self.entries[key] = entry
+			self.total += entry.cost()
+			self.evict()
+
+	# 件数・合計サイズの上限を超えたら古いものから捨てる(lockの中で呼ぶこと)
+	def	evict(self):
+		while self.max_entries < len(self.entries) or self.max_bytes < self.total:
+			oldest, _ = next(iter(self.entries.items()))
+			self.remove(oldest)
+			self.evictions += 1
+
+	# lockの中で呼ぶこと
+	def	remove(self, key):
+		entry = self.entries.pop(key)
+		self.total -= entry.cost()
+
+	def	discard(self, key):
+		with self.lock:
+			if key in self.entries:
+				self.remove(key)
+				self.invalidations += 1
+
+	def	stats(self) -> dict:
+		with self.lock:
+			return {
+				'entries': len(self.entries),
+				'bytes': self.total,
+				'hits': self.hits,
+				'misses': self.misses,
+				'evictions': self.evictions,
+				'invalidations': self.invalidations
+			}
+
+static_cache = StaticCache(
+	config.STATIC_CACHE_ENTRIES,
+	config.STATIC_CACHE_BYTES,
+	config.STATIC_CACHE_MAX_FILE
+)
@@ -0,0 +1,42 @@
+import re
+import html
+
+"""
+	小さなテンプレートエンジン
+	template.py:
+		- Templateクラス
+
+	テンプレートは作成時に1回だけ、静的な部分のバイト列とスロットの並びにコンパイルする
+		{{name}}	- 値をhtml.escapeしてから埋め込む
+		{{!name}}	- 値をそのまま埋め込む(組み立て済みのHTML)
+	コンパイルでは、静的な部分(bytes)とスロットの場所を並べたリストを作っておき、
+	renderはそのコピーのスロットの場所にだけエスケープ・エンコードした値を入れて、b''.joinで1回で連結する
+	(create_htmlのように毎回ページ全体を文字列で組み立ててからencodeし直さない)
+	レンダリング結果は覚えない(同じページを使い回すのはroute.cacheableの役目)
+"""
+
+SLOT = re.compile(r'\{\{(!?)\s*([A-Za-z_]\w*)\s*\}\}')
+
+class Template:
+	def	__init__(self, name: str, source: str):
+		self.name = name
+		self.fragments = []		# 静的な部分(bytes)と、スロットの場所(Noneを入れておく)
+		self.slots = []			# (fragmentsの位置, 値の名前, エスケープするか)
+		position = 0
+		for match in SLOT.finditer(source):
+			self.fragments.append(source[position:match.start()].encode('utf-8'))
+			self.slots.append((len(self.fragments), match.group(2), not match.group(1)))
+			self.fragments.append(None)
+			position = match.end()
+		self.fragments.append(source[position:].encode('utf-8'))
+		self.names = list(dict.fromkeys(name for _, name, _ in self.slots))
+
+	# render(**値)、足りない値はKeyError
+	def	render(self, **values) -> bytes:
+		parts = self.fragments.copy()
+		for index, name, escape in self.slots:
+			text = str(values[name])
+			if escape:
+				text = html.escape(text)
+			parts[index] = text.encode('utf-8', 'replace')
+		return b''.join(parts)
@@ -0,0 +1,124 @@
+import os
+import ssl
+import time
+import logging
+import threading
+import subprocess
+
+import config
+from metrics import metrics
+
+"""
+	TLSの終端
+	tls.py:
+		- create_context関数
+		- generate_self_signed関数(テスト用の自己署名証明書をopensslコマンドで作る)
+		- handshake関数(thread / poolモードのワーカーで呼ぶ)
+		- TLSStatsクラス(/__statsのtls)
+
+	TLS_CERT / TLS_KEY を設定すると thread / pool / async モードでTLSを話す(空ならこれまでどおり平文)
+	ハンドシェイクはacceptのループでは行わず、接続を受け取ったワーカースレッドがhandle_clientの最初に行う
+	(asyncモードではasyncioが接続ごとにイベントループ上で非同期に行う)
+	eventモードはノンブロッキングのsendmsgで書き込むのでTLSには対応しない(preforkも同じ)
+
+	ハンドシェイクの負担を減らすためのセッション再開:
+		TLS 1.3	- ハンドシェイクの後にNewSessionTicketをTLS_TICKETS枚送り、次の接続はPSKで再開する
+				  (証明書の送信と署名を省く)
+		TLS 1.2	- セッションチケット(RFC 5077)と、OpenSSLのサーバー側のセッションキャッシュ
+		チケットの鍵はSSLContext(プロセス)ごとなので、再起動の後は最初のハンドシェイクからになる
+
+	ALPN: TLS_ALPN(カンマ区切り)を優先順にクライアントと交渉し、選ばれたものをstatsに数える
+	今はhttp/1.1だけを載せている(h2などに対応する時は、ここに足して選ばれたプロトコルで処理を分ける)
+"""
+
+def	create_context() -> ssl.SSLContext | None:
+	if not config.TLS_CERT:
+		return None
+	context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+	context.minimum_version = ssl.TLSVersion.TLSv1_2
+	context.load_cert_chain(config.TLS_CERT, config.TLS_KEY or None)
+	context.set_alpn_protocols([protocol.strip() for protocol in config.TLS_ALPN.split(',') if protocol.strip()])
+	context.num_tickets = config.TLS_TICKETS
+	context.options |= ssl.OP_NO_COMPRESSION
+	logging.info(f'create_context: TLS enabled cert={config.TLS_CERT} alpn={config.TLS_ALPN} tickets={config.TLS_TICKETS}')
+	return context
+
+# directoryに自己署名証明書(cert.pem)と鍵(key.pem)を作り、そのパスを返す(既にあれば作らない)
+# 鍵はECDSA P-256(RSA 2048より署名が速く、フルハンドシェイクが軽い)
+def	generate_self_signed(directory, host='localhost') -> tuple:
+	cert = os.path.join(directory, 'cert.pem')
+	key = os.path.join(directory, 'key.pem')
+	if os.path.exists(cert) and os.path.exists(key):
+		return cert, key
+	os.makedirs(directory, exist_ok=True)
+	subprocess.run(
+		[
+			'openssl', 'req', '-x509', '-newkey', 'ec', '-pkeyopt', 'ec_paramgen_curve:prime256v1',
+			'-nodes', '-keyout', key, '-out', cert, '-days', '30', '-subj', f'/CN={host}',
+			'-addext', f'subjectAltName=DNS:{host},IP:127.0.0.1'
+		],
+		check=True, capture_output=True
+	)
+	return cert, key
+
+class TLSStats:
+	# ハンドシェイクの件数・再開できた件数・失敗・バージョン・ALPNの内訳(スレッド間で共有するのでlockで守る)
+	def	__init__(self):
+		self.lock = threading.Lock()
+		self.handshakes = 0
+		self.resumed = 0
+		self.failed = 0
+		self.seconds = {'full': 0.0, 'resumed': 0.0}
+		self.versions = {}
+		self.protocols = {}
+
+	# seconds: ハンドシェイクにかかった時間(asyncモードでは測れないのでNone)
+	def	record(self, ssl_object, seconds=None):
+		resumed = ssl_object.session_reused
+		version = ssl_object.version()
+		protocol = ssl_object.selected_alpn_protocol() or 'none'
+		with self.lock:
+			self.handshakes += 1
+			self.resumed += resumed
+			if seconds is not None:
+				self.seconds['resumed' if resumed else 'full'] += seconds
+			self.versions[version] = self.versions.get(version, 0) + 1
+			self.protocols[protocol] = self.protocols.get(protocol, 0) + 1
+
+	def	record_failure(self):
+		with self.lock:
+			self.failed += 1
+
+	def	stats(self) -> dict:
+		with self.lock:
+			full = self.handshakes - self.resumed
+			return {
+				'handshakes': self.handshakes,
+				'resumed': self.resumed,
+				'failed': self.failed,
+				'full_avg_ms': round(self.seconds['full'] / full * 1000, 3) if full else 0.0,
+				'resumed_avg_ms': round(self.seconds['resumed'] / self.resumed * 1000, 3) if self.resumed else 0.0,
+				'versions': dict(self.versions),
+				'alpn': dict(self.protocols)
+			}
+
+tls_stats = TLSStats()
+metrics.register('tls', tls_stats.stats)
+
+# ワーカースレッドでハンドシェイクを行い、TLSのソケットを返す(失敗したら閉じてNone)
+# 1件目のリクエストと同じくHEADER_TIMEOUTまでしか待たない
+def	handshake(client_socket, context):
+	begin = time.perf_counter()
+	try:
+		client_socket.settimeout(config.HEADER_TIMEOUT)
+		# OpenSSLはレコードごとに書き込むので、TCP_NODELAYは呼び出し側(handle_client)で付けておく
+		tls_socket = context.wrap_socket(client_socket, server_side=True, do_handshake_on_connect=False)
+		tls_socket.do_handshake()
+	except (ssl.SSLError, OSError) as e:
+		logging.warning(f'handshake: TLS handshake failed: {e}')
+		tls_stats.record_failure()
+		client_socket.close()
+		return None
+	tls_stats.record(tls_socket, time.perf_counter() - begin)
+	tls_socket.settimeout(config.TIMEOUT_INT)
+	return tls_socket
@@ -0,0 +1,106 @@
+import time
+import queue
+import socket
+import logging
+import threading
+from collections import deque
+
+"""
+	固定数のワーカースレッドと有限の受付キュー
+	worker_pool.py:
+		- WorkerPoolクラス
+
+	acceptした接続をキューに入れ、ワーカーがhandle_client(socket, address, キューに入れた時刻)で処理する
+	キューが一杯ならsubmitはFalseを返すので、呼び出し側は503を返してすぐ閉じる
+	(接続の急増でスレッドとメモリが際限なく増えるのを防ぐ)
+"""
+
+WAIT_SAMPLES = 4096		# 待ち時間のパーセンタイル計算に使う直近のサンプル数
+
+class WorkerPool:
+	def	__init__(self, handler, workers, queue_size):
+		self.handler = handler
+		self.workers = workers
+		self.queue = queue.Queue(maxsize=queue_size)
+		self.lock = threading.Lock()
+		self.accepted = 0
+		self.rejected = 0
+		self.max_depth = 0
+		self.waits = deque(maxlen=WAIT_SAMPLES)
+		self.max_wait = 0.0
+
+	def	start(self):
+		for index in range(self.workers):
+			thread = threading.Thread(target=self.work, name=f'worker-{index}', daemon=True)
+			thread.start()
+
+	# キューに入れられなければFalse(呼び出し側で503を返す)
+	def	submit(self, client_socket, client_address) -> bool:
+		try:
+			self.queue.put_nowait((client_socket, client_address, time.perf_counter()))
+		except queue.Full:
+			with self.lock:
+				self.rejected += 1
+			return False
+		with self.lock:
+			self.accepted += 1
+			self.max_depth = max(self.max_depth, self.queue.qsize())
+		return True
+
+	def	work(self):
+		while True:
+			client_socket, client_address, queued = self.queue.get()
+			wait = time.perf_counter() - queued
+			with self.lock:
+				self.waits.append(wait)
+				self.max_wait = max(self.max_wait, wait)
+			try:
+				self.handler(client_socket, client_address, queued)
+			except Exception:
+				logging.exception('Exception work/WorkerPool:')
+			finally:
+				self.queue.task_done()
+
+	# キューで待っている接続と処理中の接続の数(受付をやめた後、0になるまで待つ)
+	def	pending(self) -> int:
+		return self.queue.unfinished_tasks
+
+	def	stats(self) -> dict:
+		with self.lock:
+			waits = sorted(self.waits)
+			accepted = self.accepted
+			rejected = self.rejected
+			max_depth = self.max_depth
+			max_wait = self.max_wait
+
+		def	percentile(p):
+			if not waits:
+				return 0.0
+			return waits[min(len(waits) - 1, int(len(waits) * p / 100))] * 1000
+
+		return {
+			'workers': self.workers,
+			'queue_depth': self.queue.qsize(),
+			'queue_max_depth': max_depth,
+			'accepted': accepted,
+			'rejected': rejected,
+			'wait_p50_ms': round(percentile(50), 3),
+			'wait_p99_ms': round(percentile(99), 3),
+			'wait_max_ms': round(max_wait * 1000, 3)
+		}
+
+# 受け付けられない接続に、作っておいた503を送ってすぐ閉じる
+# 届いているリクエストを読み捨ててから閉じないと、RSTで503が相手に届かないことがある
+def	shed(client_socket, response_bytes):
+	try:
+		client_socket.setblocking(False)
+		try:
+			client_socket.recv(65536)
+		except BlockingIOError:
+			pass
+		client_socket.send(response_bytes)
+		client_socket.shutdown(socket.SHUT_WR)
+	except OSError:
+		pass
+	finally:
+		client_socket.close()
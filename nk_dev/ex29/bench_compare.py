@@ -0,0 +1,127 @@
+#!/usr/bin/env python3
+
+import sys
+import json
+import statistics
+from pathlib import Path
+
+import bench_load
+sys.path.append(str(Path(__file__).parent / '09_ex29'))		# 末尾に足す(09_ex29のhttp.pyで標準ライブラリを隠さない)
+from bench_common import launch, stop_server
+
+"""
+	サーバーのバージョン同士を同じ負荷で比べる
+	bench_compare.py:
+		- server_command関数(サーバーの指定から起動コマンドを作る)
+		- start_server関数(起動と停止はbench_common.launch / stop_server)
+		- main関数
+
+	使い方: bench_compare.py サーバー [サーバー ...] [bench_load.pyのオプション] [--rounds N]
+		例) bench_compare.py 08_ex29 09_ex29 -c 32 -d 10 --mix user=3,search=2,post=1
+		    bench_compare.py 09_ex29:thread 09_ex29:event 09_ex29:async -k --mix static=1,upload=1
+
+	サーバーの指定:
+		08_ex29					- 08_ex29/08_ex29.py(ポート8080固定、引数なし)
+		09_ex29[:モード]		- 09_ex29/09_ex29.py <モード> <COMPARE_PORT>(省略時はthread)
+		<ファイル>.py[@ポート]	- その他のサーバー(例: 07_ex29.py@8080、引数なしで起動)
+
+	サーバーごとに、そのディレクトリをカレントディレクトリにして子プロセスで起動し(出力は捨てる)、
+	接続できるようになったらbench_load.runで負荷をかけて止める
+	--roundsを2以上にすると、サーバーの順番を毎回入れ替えて繰り返し(温度・他の負荷の偏りを減らす)、
+	req/sが中央値の回をそのサーバーの代表として表に出す
+	全ての回の結果はJSON(--output、省略時は出さない)に残す
+
+	同じマシンでクライアントも動くので、1コアの環境ではクライアントの分だけサーバーの処理能力が下がる
+	(差の比較には使えるが、絶対値は別のマシンから測ったものより小さい)
+"""
+
+HERE = Path(__file__).parent
+COMPARE_PORT = 8094
+
+# サーバーの指定 → (起動コマンド, カレントディレクトリ, ポート)
+def	server_command(spec) -> tuple:
+	name, _, mode = spec.partition(':')
+	if name == '08_ex29':
+		return [sys.executable, '08_ex29.py'], HERE / '08_ex29', 8080
+	if name == '09_ex29':
+		return [sys.executable, '09_ex29.py', mode or 'thread', str(COMPARE_PORT)], HERE / '09_ex29', COMPARE_PORT
+	path, _, port = spec.partition('@')
+	path = (HERE / path).resolve()
+	if path.suffix != '.py' or not path.is_file():
+		raise ValueError(f'unknown server {spec!r}')
+	return [sys.executable, path.name], path.parent, int(port or 8080)
+
+def	start_server(spec) -> tuple:
+	command, directory, port = server_command(spec)
+	return launch(command, port, cwd=directory), port
+
+def	build_parser():
+	parser = bench_load.build_parser(add_help=False)
+	parser.description = 'Compare ex29 server versions on the same workload'
+	parser.add_argument('-h', '--help', action='help')
+	parser.add_argument('servers', nargs='+', help='08_ex29, 09_ex29[:mode] or <file>.py[@port]')
+	parser.add_argument('--rounds', type=int, default=1)
+	parser.set_defaults(output=None)
+	return parser
+
+def	non_2xx(result) -> int:
+	return sum(count for status, count in result['statuses'].items() if not status.startswith('2'))
+
+def	main():
+	options = build_parser().parse_args()
+	try:
+		for spec in options.servers:
+			server_command(spec)		# 起動する前に指定の誤りを見つける
+	except ValueError as e:
+		print(f'bench_compare: {e}', file=sys.stderr)
+		return 1
+
+	runs = {spec: [] for spec in options.servers}
+	for round_index in range(options.rounds):
+		order = options.servers if round_index % 2 == 0 else options.servers[::-1]
+		for spec in order:
+			proc, options.port = start_server(spec)
+			try:
+				result = bench_load.run(options)
+			finally:
+				stop_server(proc)
+			runs[spec].append(result)
+			print(
+				f'round {round_index + 1} {spec}: {result["rps"]} req/s, p99 {result["latency_ms"]["p99"]} ms, '
+				f'errors {result["error_count"]}', file=sys.stderr
+			)
+
+	# req/sが中央値の回を代表にする
+	chosen = {}
+	for spec, results in runs.items():
+		median = statistics.median_low([result['rps'] for result in results])
+		chosen[spec] = next(result for result in results if result['rps'] == median)
+
+	base = chosen[options.servers[0]]
+	print(
+		f'concurrency={options.concurrency} duration={options.duration}s keep_alive={options.keep_alive} '
+		f'mix={",".join(f"{kind}={weight:g}" for kind, weight in options.mix.items())} rounds={options.rounds}'
+	)
+	print(f'{"server":<18}{"req/s":>10}{"p50 ms":>9}{"p90 ms":>9}{"p99 ms":>9}{"errors":>8}{"non-2xx":>9}{"MB/s":>8}{"vs first":>10}')
+	for spec, result in chosen.items():
+		latency = result['latency_ms']
+		ratio = result['rps'] / base['rps'] if base['rps'] else 0.0
+		print(
+			f'{spec:<18}{result["rps"]:>10.1f}{latency["p50"]:>9.2f}{latency["p90"]:>9.2f}{latency["p99"]:>9.2f}'
+			f'{result["error_count"]:>8}{non_2xx(result):>9}{result["bytes_per_sec"] / 1e6:>8.2f}{ratio:>9.2f}x'
+		)
+	for spec, result in chosen.items():
+		kinds = ', '.join(
+			f'{kind} {entry["rps"]:.0f}/s p99 {entry["latency_ms"]["p99"]:.1f}ms {entry["statuses"]}'
+			for kind, entry in result['kinds'].items()
+		)
+		print(f'  {spec}: {kinds}')
+
+	if options.output:
+		with open(options.output, 'w') as file:
+			json.dump({'servers': options.servers, 'chosen': chosen, 'runs': runs}, file, indent=2)
+			file.write('\n')
+	return 0
+
+if __name__ == '__main__':
+	sys.exit(main())
@@ -0,0 +1,288 @@
+#!/usr/bin/env python3
+
+import sys
+import json
+import time
+import random
+import asyncio
+import argparse
+import concurrent.futures
+from pathlib import Path
+
+sys.path.append(str(Path(__file__).parent / '09_ex29'))		# 末尾に足す(09_ex29のhttp.pyで標準ライブラリを隠さない)
+from bench_common import parse_head, percentile
+
+"""
+	ex29のサーバー用の負荷生成ツール
+	bench_load.py:
+		- build_parser関数(オプションの定義、bench_compare.pyと共有)
+		- Requestsクラス(リクエストの種類ごとのバイト列を作る)
+		- read_response関数
+		- Recorderクラス(種類ごとの件数・レイテンシ・ステータス・エラー・受信バイト数)
+		- run関数(結果の辞書を返す)
+
+	使い方: bench_load.py [オプション]
+		例) bench_load.py --port 8080 -c 32 -d 10 -k --mix static=4,user=3,search=2,post=1,upload=1
+
+	asyncioで並列数(-c)本の接続をクローズドループで動かし、[秒数](-d)の間リクエストを送り続ける
+	(1本の接続は応答を受け取ってから次を送る)
+	--processes を2以上にすると、並列数を分けてプロセスごとにイベントループを動かし、結果を合算する
+	(クライアント側が1コアで頭打ちになる場合)
+
+	リクエストの種類(--mixで重みを指定):
+		static	- 静的ファイル(--static-path)
+		user	- /user/<id>(idはランダム)
+		search	- /search?q=<単語>
+		post	- application/x-www-form-urlencoded のPOST
+		upload	- multipart/form-data のPOST(--upload-sizeバイトのファイル1つ)
+
+	keep-alive(-k): サーバーがConnection: closeを返すか、Content-Lengthなしで閉じるまで接続を使い回す
+	(08_ex29のように1リクエストで閉じるサーバーでは毎回つなぎ直す)
+
+	結果はJSON(標準出力か--output)で、全体と種類ごとに
+		requests, rps, latency_ms(p50 / p90 / p99 / max / mean), statuses, errors, bytes, bytes_per_sec
+	レイテンシは接続(keep-aliveでは最初の1件だけ)から応答を読み終えるまで
+	errorsは接続・タイムアウト・応答の途中での切断など、応答を受け取れなかったもの(ステータスはstatusesで見る)
+"""
+
+KINDS = ('static', 'user', 'search', 'post', 'upload')
+WORDS = ('python', 'socket', 'server', 'thread', 'async', 'epoll', 'chunked', 'keep-alive')
+BOUNDARY = 'benchload7MA4YWxkTrZu0gW'
+MAX_SAMPLES = 1_000_000		# 種類ごとに保存するレイテンシの上限(超えた分はパーセンタイルに含めない)
+
+def	parse_mix(text) -> dict:
+	mix = {}
+	for item in text.split(','):
+		kind, _, weight = item.partition('=')
+		kind = kind.strip()
+		if kind not in KINDS:
+			raise argparse.ArgumentTypeError(f'unknown request kind {kind!r} ({", ".join(KINDS)})')
+		try:
+			mix[kind] = float(weight or 1)
+		except ValueError:
+			raise argparse.ArgumentTypeError(f'invalid weight {weight!r}')
+	if not any(mix.values()):
+		raise argparse.ArgumentTypeError('mix needs at least one positive weight')
+	return mix
+
+def	build_parser(add_help=True) -> argparse.ArgumentParser:
+	parser = argparse.ArgumentParser(description='HTTP load generator for the ex29 servers', add_help=add_help)
+	parser.add_argument('--host', default='127.0.0.1')
+	parser.add_argument('--port', type=int, default=8080)
+	parser.add_argument('-c', '--concurrency', type=int, default=32, help='number of connections')
+	parser.add_argument('-d', '--duration', type=float, default=10.0, help='seconds')
+	parser.add_argument('-k', '--keep-alive', action='store_true', help='reuse connections')
+	parser.add_argument('--mix', type=parse_mix, default=parse_mix('static=4,user=3,search=2,post=1'),
+		help='request kinds and weights, e.g. static=4,user=3,search=2,post=1,upload=1')
+	parser.add_argument('--static-path', default='/index.html')
+	parser.add_argument('--upload-size', type=int, default=64 * 1024, help='bytes of the uploaded file')
+	parser.add_argument('--timeout', type=float, default=10.0, help='seconds per request')
+	parser.add_argument('--processes', type=int, default=1, help='client processes (concurrency is split)')
+	parser.add_argument('--seed', type=int, default=None)
+	parser.add_argument('--output', default='-', help="JSON file ('-' for stdout)")
+	return parser
+
+class Requests:
+	"""
+		種類ごとのリクエストのバイト列を作る
+		uploadのボディは大きいので最初に1回だけ作り、ヘッダーだけ毎回付ける
+	"""
+	def	__init__(self, options, rng):
+		self.host = f'{options.host}:{options.port}'
+		self.static_path = options.static_path
+		self.connection = 'keep-alive' if options.keep_alive else 'close'
+		self.rng = rng
+		content = bytes(rng.randrange(256) for _ in range(256)) * (options.upload_size // 256 + 1)
+		self.upload_body = (
+			f'--{BOUNDARY}\r\nContent-Disposition: form-data; name="name"\r\n\r\nbench\r\n'
+			f'--{BOUNDARY}\r\nContent-Disposition: form-data; name="file"; filename="bench.bin"\r\n'
+			'Content-Type: application/octet-stream\r\n\r\n'
+		).encode('ascii') + content[:options.upload_size] + f'\r\n--{BOUNDARY}--\r\n'.encode('ascii')
+
+	def	head(self, method, path, extra='') -> bytes:
+		return f'{method} {path} HTTP/1.1\r\nHost: {self.host}\r\nConnection: {self.connection}\r\n{extra}\r\n'.encode('ascii')
+
+	def	build(self, kind) -> bytes:
+		if kind == 'static':
+			return self.head('GET', self.static_path)
+		if kind == 'user':
+			return self.head('GET', f'/user/{self.rng.randrange(1, 100000)}')
+		if kind == 'search':
+			return self.head('GET', f'/search?q={self.rng.choice(WORDS)}&page={self.rng.randrange(1, 10)}')
+		if kind == 'post':
+			body = f'name=user{self.rng.randrange(100000)}&message={"+".join(self.rng.sample(WORDS, 4))}'.encode('ascii')
+			extra = f'Content-Type: application/x-www-form-urlencoded\r\nContent-Length: {len(body)}\r\n'
+			return self.head('POST', '/form', extra) + body
+		extra = f'Content-Type: multipart/form-data; boundary={BOUNDARY}\r\nContent-Length: {len(self.upload_body)}\r\n'
+		return self.head('POST', '/upload', extra) + self.upload_body
+
+# 応答を1件読む(ステータス, 受信したバイト数, 接続を閉じるべきか)
+# Content-Length → chunked → 閉じられるまで、の順でボディの終わりを決める
+async def	read_response(reader) -> tuple:
+	head = await reader.readuntil(b'\r\n\r\n')
+	version, status, headers = parse_head(head[:-4])
+
+	size = len(head)
+	connection = headers.get('connection', '').lower()
+	close = connection == 'close' or (version == 'HTTP/1.0' and connection != 'keep-alive')
+	if 'content-length' in headers:
+		size += len(await reader.readexactly(int(headers['content-length'])))
+	elif 'chunked' in headers.get('transfer-encoding', '').lower():
+		while True:
+			line = await reader.readuntil(b'\r\n')
+			length = int(line.split(b';')[0], 16)
+			size += len(line) + len(await reader.readexactly(length + 2))
+			if not length:
+				break
+	else:
+		size += len(await reader.read())		# 長さがなければ閉じられるまでがボディ
+		close = True
+	return status, size, close
+
+def	new_entry() -> dict:
+	return {'latencies': [], 'statuses': {}, 'errors': {}, 'bytes': 0, 'sent': 0}
+
+# entryの件数・バイト数をtotalへ足す
+def	merge_entry(total, entry):
+	total['latencies'] += entry['latencies']
+	total['bytes'] += entry['bytes']
+	total['sent'] += entry['sent']
+	for field in ('statuses', 'errors'):
+		for label, count in entry[field].items():
+			total[field][label] = total[field].get(label, 0) + count
+
+class Recorder:
+	def	__init__(self):
+		self.kinds = {}
+
+	def	kind(self, kind) -> dict:
+		if kind not in self.kinds:
+			self.kinds[kind] = new_entry()
+		return self.kinds[kind]
+
+	def	record(self, kind, status, latency, received, sent):
+		entry = self.kind(kind)
+		if len(entry['latencies']) < MAX_SAMPLES:
+			entry['latencies'].append(latency)
+		entry['statuses'][str(status)] = entry['statuses'].get(str(status), 0) + 1
+		entry['bytes'] += received
+		entry['sent'] += sent
+
+	def	error(self, kind, name):
+		entry = self.kind(kind)
+		entry['errors'][name] = entry['errors'].get(name, 0) + 1
+
+# 1本の接続: deadlineまでリクエストを送り続ける
+async def	client(options, requests, recorder, deadline):
+	kinds = [kind for kind in KINDS if options.mix.get(kind)]
+	weights = [options.mix[kind] for kind in kinds]
+	reader = writer = None
+	while time.monotonic() < deadline:
+		kind = requests.rng.choices(kinds, weights)[0]
+		request = requests.build(kind)
+		begin = time.perf_counter()
+		try:
+			async with asyncio.timeout(options.timeout):
+				if writer is None:
+					reader, writer = await asyncio.open_connection(options.host, options.port)
+				writer.write(request)
+				await writer.drain()
+				status, received, close = await read_response(reader)
+		except (OSError, EOFError, TimeoutError, ValueError, asyncio.IncompleteReadError, asyncio.LimitOverrunError) as e:
+			recorder.error(kind, 'Timeout' if isinstance(e, TimeoutError) else type(e).__name__)
+			if writer is not None:
+				writer.close()
+			reader = writer = None
+			continue
+		recorder.record(kind, status, time.perf_counter() - begin, received, len(request))
+		if close or not options.keep_alive:
+			writer.close()
+			reader = writer = None
+	if writer is not None:
+		writer.close()
+
+async def	run_clients(options, concurrency, seed) -> tuple:
+	rng = random.Random(seed)
+	requests = Requests(options, rng)
+	recorder = Recorder()
+	begin = time.monotonic()
+	deadline = begin + options.duration
+	await asyncio.gather(*(client(options, requests, recorder, deadline) for _ in range(concurrency)))
+	return recorder.kinds, time.monotonic() - begin
+
+# 1プロセス分(--processesの子プロセスでも動く)
+def	run_process(options, concurrency, seed) -> tuple:
+	return asyncio.run(run_clients(options, concurrency, seed))
+
+def	summarize(entry, elapsed) -> dict:
+	latencies = sorted(entry['latencies'])
+	requests = sum(entry['statuses'].values())
+	return {
+		'requests': requests,
+		'rps': round(requests / elapsed, 1),
+		'latency_ms': {
+			'p50': round(percentile(latencies, 50) * 1000, 3),
+			'p90': round(percentile(latencies, 90) * 1000, 3),
+			'p99': round(percentile(latencies, 99) * 1000, 3),
+			'max': round(latencies[-1] * 1000, 3) if latencies else 0.0,
+			'mean': round(sum(latencies) / len(latencies) * 1000, 3) if latencies else 0.0
+		},
+		'statuses': dict(sorted(entry['statuses'].items())),
+		'errors': dict(sorted(entry['errors'].items())),
+		'bytes': entry['bytes'],
+		'bytes_per_sec': round(entry['bytes'] / elapsed, 1),
+		'sent_bytes': entry['sent']
+	}
+
+# 負荷をかけて結果の辞書を返す
+def	run(options) -> dict:
+	seed = options.seed if options.seed is not None else random.randrange(1 << 30)
+	processes = max(1, min(options.processes, options.concurrency))
+	shares = [options.concurrency // processes + (index < options.concurrency % processes) for index in range(processes)]
+	if processes == 1:
+		parts = [run_process(options, shares[0], seed)]
+	else:
+		with concurrent.futures.ProcessPoolExecutor(max_workers=processes) as executor:
+			futures = [executor.submit(run_process, options, share, seed + index) for index, share in enumerate(shares)]
+			parts = [future.result() for future in futures]
+
+	merged = {}
+	overall = new_entry()
+	for kinds, _ in parts:
+		for kind, entry in kinds.items():
+			merge_entry(merged.setdefault(kind, new_entry()), entry)
+			merge_entry(overall, entry)
+	elapsed = max(part[1] for part in parts)
+
+	result = {
+		'target': f'{options.host}:{options.port}',
+		'concurrency': options.concurrency,
+		'duration': round(elapsed, 3),
+		'keep_alive': options.keep_alive,
+		'mix': options.mix,
+		'processes': processes,
+		'seed': seed
+	}
+	result.update(summarize(overall, elapsed))
+	result['error_count'] = sum(overall['errors'].values())
+	result['kinds'] = {kind: summarize(merged[kind], elapsed) for kind in KINDS if kind in merged}
+	return result
+
+def	main():
+	options = build_parser().parse_args()
+	result = run(options)
+	text = json.dumps(result, indent=2)
+	if options.output == '-':
+		print(text)
+	else:
+		with open(options.output, 'w') as file:
+			file.write(text + '\n')
+		print(
+			f'{result["target"]}: {result["rps"]} req/s, p50 {result["latency_ms"]["p50"]} ms, '
+			f'p99 {result["latency_ms"]["p99"]} ms, errors {result["error_count"]}, {result["bytes_per_sec"] / 1e6:.2f} MB/s',
+			file=sys.stderr
+		)
+	return 0
+
+if __name__ == '__main__':
+	sys.exit(main())